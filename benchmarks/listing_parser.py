@@ -0,0 +1,66 @@
+"""Compares the listing parser with xmltodict on a page of 1000 keys.
+
+Run from the repository root: python benchmarks/listing_parser.py
+"""
+import sys
+import timeit
+import tracemalloc
+
+import xmltodict
+
+sys.path.insert(0, '.')
+from s3compat.waterbutler_provider.listing import ListingParser  # noqa: E402
+
+CONTENTS = '''<Contents>
+  <Key>folder/file-{0:06d}.dat</Key>
+  <LastModified>2016-02-05T15:08:50.000Z</LastModified>
+  <ETag>&quot;d41d8cd98f00b204e9800998ecf8427e&quot;</ETag>
+  <Size>{0}</Size>
+  <Owner><ID>owner</ID><DisplayName>owner</DisplayName></Owner>
+  <StorageClass>STANDARD</StorageClass>
+</Contents>'''
+
+
+def listing(keys=1000):
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            '<Name>bucket</Name><Prefix>folder/</Prefix><Marker></Marker>'
+            '<MaxKeys>1000</MaxKeys><Delimiter>/</Delimiter><IsTruncated>false</IsTruncated>'
+            + ''.join(CONTENTS.format(i) for i in range(keys))
+            + '</ListBucketResult>').encode('utf-8')
+
+
+def parse_xmltodict(body):
+    parsed = xmltodict.parse(body, strip_whitespace=False)['ListBucketResult']
+    return [content['Key'] for content in parsed.get('Contents', [])]
+
+
+def parse_streaming(body, chunk_size=64 * 1024):
+    parser = ListingParser()
+    keys = []
+    for offset in range(0, len(body), chunk_size):
+        keys.extend(record['Key'] for element, record
+                    in parser.feed(body[offset:offset + chunk_size]) if element == 'Contents')
+    parser.feed(b'', final=True)
+    return keys
+
+
+def peak_memory(parse, body):
+    tracemalloc.start()
+    parse(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    body = listing()
+    assert parse_xmltodict(body) == parse_streaming(body)
+    for name, parse in [('xmltodict', parse_xmltodict), ('ListingParser', parse_streaming)]:
+        seconds = min(timeit.repeat(lambda: parse(body), number=20, repeat=5)) / 20
+        print('{:<14} {:8.2f} ms/page {:8.0f} KiB peak'.format(
+            name, seconds * 1000, peak_memory(parse, body) / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -149,10 +149,35 @@ class NodeSettings(BaseOAuthNodeSettings, BaseStorageAddon):
     def serialize_waterbutler_settings(self):
         if not self.folder_id:
             raise exceptions.AddonError('Cannot serialize settings for S3 Compatible Storage addon')
-        return {
+        settings = {
             'bucket': self.folder_id,
             'encrypt_uploads': self.encrypt_uploads
         }
+        service = self._find_service()
+        multipart_upload = {
+            name: service['multipartUpload'][key]
+            for key, name in [('minPartSize', 'min_part_size'),
+                              ('maxPartSize', 'max_part_size'),
+                              ('targetPartCount', 'target_part_count')]
+            if key in service.get('multipartUpload', {})
+        }
+        if multipart_upload:
+            settings['multipart_upload'] = multipart_upload
+        if 'signatureVersion' in service:
+            settings['signature_version'] = str(service['signatureVersion'])
+            if self.folder_location:
+                settings['region'] = self.folder_location
+        return settings
+
+    def _find_service(self):
+        """The entry of settings.json for the host of this node, or an empty dict."""
+        if not self.has_auth:
+            return {}
+        try:
+            return find_service_by_host(self.external_account.provider_id.split('\t')[0])
+        except KeyError:
+            # Unlisted service, use the default settings
+            return {}
 
     def create_waterbutler_log(self, auth, action, metadata):
         url = self.owner.web_url_for('addon_view_or_download_file', path=metadata['path'], provider='s3compat')
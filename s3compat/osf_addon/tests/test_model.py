@@ -237,3 +237,29 @@ class TestNodeSettings(OAuthAddonNodeSettingsTestSuiteMixin, unittest.TestCase):
         expected = {'bucket': self.node_settings.folder_id,
                     'encrypt_uploads': self.node_settings.encrypt_uploads}
         assert_equal(settings, expected)
+
+    @mock.patch('s3compat.osf_addon.models.find_service_by_host')
+    def test_serialize_settings_multipart_upload(self, mock_service):
+        mock_service.return_value = {'name': 'Dummy',
+                                     'host': 'dummy.example.com',
+                                     'multipartUpload': {'minPartSize': 8388608,
+                                                         'targetPartCount': 100}}
+        settings = self.node_settings.serialize_waterbutler_settings()
+        expected = {'bucket': self.node_settings.folder_id,
+                    'encrypt_uploads': self.node_settings.encrypt_uploads,
+                    'multipart_upload': {'min_part_size': 8388608,
+                                         'target_part_count': 100}}
+        assert_equal(settings, expected)
+
+    @mock.patch('s3compat.osf_addon.models.find_service_by_host')
+    def test_serialize_settings_signature_version(self, mock_service):
+        mock_service.return_value = {'name': 'Dummy',
+                                     'host': 'dummy.example.com',
+                                     'signatureVersion': 4}
+        self.node_settings.folder_location = 'dummy-1'
+        settings = self.node_settings.serialize_waterbutler_settings()
+        expected = {'bucket': self.node_settings.folder_id,
+                    'encrypt_uploads': self.node_settings.encrypt_uploads,
+                    'signature_version': '4',
+                    'region': 'dummy-1'}
+        assert_equal(settings, expected)
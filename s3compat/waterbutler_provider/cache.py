@@ -0,0 +1,382 @@
+"""Cache of metadata requests
+
+WaterButler creates a provider per request and one operation often sends the same HEAD or
+listing request several times, so the provider keeps their results in a process-wide cache for a
+short time.  Entries are keyed by ``(host, bucket, key, variant, credentials)``, where the
+variant is the ``versionId`` of a HEAD request (None for the latest version) or
+``('list', marker)`` for a page of the listing of the folder ``key``, and credentials is a digest
+of the keys the metadata was requested with, so that it is only served to the same user.
+
+Concurrent requests for metadata which is not cached yet share one request, see
+:class:`SingleFlight`.
+
+Keys and folders found missing are remembered apart, by a negative cache whose backend may be
+shared by the worker processes of a host.  Its entries are keyed by strings built by the
+provider from the endpoint, bucket and key, and by the digest of the credentials they were
+looked up with.
+"""
+import time
+import sqlite3
+import asyncio
+import functools
+import importlib
+import threading
+import collections
+
+from . import settings
+
+
+def listing_variant(marker=None):
+    """Returns the variant of the cache key of a listing page starting after ``marker``.
+    """
+    return ('list', marker)
+
+
+def is_listing_variant(variant):
+    return isinstance(variant, tuple) and variant[0] == 'list'
+
+
+def parent_prefixes(key):
+    """Returns the prefixes of the folders containing ``key``: 'A/B/c' -> ['A/B/', 'A/', ''].
+    """
+    parts = key.rstrip('/').split('/')[:-1]
+    return ['/'.join(parts[:i]) + '/' if i else '' for i in range(len(parts), -1, -1)]
+
+
+class MetadataCache:
+    """Keeps values for ``ttl`` seconds, evicting the least recently used entries beyond
+    ``max_entries``.  ``hits`` and ``misses`` count the lookups.  A ``ttl`` of 0 disables it.
+
+    ``generation`` is incremented by every invalidation, which stamps the keys it affects with
+    it, so that `changed_since` tells whether a value fetched from a given generation on may
+    have been changed meanwhile, and should be left out of the cache.  Only the last
+    ``max_entries`` stamps are kept; values fetched from before a forgotten one count as
+    changed.
+
+    The entries are indexed by object key and by the folders containing it, so that an
+    invalidation only visits the entries it drops.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        # (host, bucket, key, recursive) -> generation of the last invalidation of the key
+        self._stamps = collections.OrderedDict()
+        self._forgotten = 0
+        # (host, bucket, key) -> keys of the entries of the object key
+        self._by_key = {}
+        # (host, bucket, folder) -> object keys of the entries in the folder, at any depth
+        self._by_folder = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the value cached under ``key``, or None.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        if key not in self._entries:
+            self._index(key)
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _index(self, key):
+        host, bucket, object_key = key[:3]
+        entry_keys = self._by_key.setdefault((host, bucket, object_key), set())
+        if not entry_keys:
+            for folder in parent_prefixes(object_key):
+                self._by_folder.setdefault((host, bucket, folder), set()).add(object_key)
+        entry_keys.add(key)
+
+    def _remove(self, key):
+        del self._entries[key]
+        host, bucket, object_key = key[:3]
+        entry_keys = self._by_key[(host, bucket, object_key)]
+        entry_keys.discard(key)
+        if entry_keys:
+            return
+        del self._by_key[(host, bucket, object_key)]
+        for folder in parent_prefixes(object_key):
+            object_keys = self._by_folder[(host, bucket, folder)]
+            object_keys.discard(object_key)
+            if not object_keys:
+                del self._by_folder[(host, bucket, folder)]
+
+    def invalidate(self, host, bucket, key, recursive=False):
+        """Drops the entries of ``key`` and the listings of the folders containing it, whatever
+        the credentials they were requested with.  If ``recursive``, ``key`` is a folder whose
+        contents are dropped as well.
+        """
+        self.generation += 1
+        self._stamp((host, bucket, key, recursive))
+        for folder in parent_prefixes(key):
+            self._stamp((host, bucket, folder, False))
+        object_keys = {key}
+        if recursive:
+            object_keys.update(self._by_folder.get((host, bucket, key), ()))
+        for object_key in object_keys:
+            for entry_key in list(self._by_key.get((host, bucket, object_key), ())):
+                self._remove(entry_key)
+        for folder in parent_prefixes(key):
+            for entry_key in list(self._by_key.get((host, bucket, folder), ())):
+                if is_listing_variant(entry_key[3]):
+                    self._remove(entry_key)
+
+    def _stamp(self, stamp_key):
+        self._stamps[stamp_key] = self.generation
+        self._stamps.move_to_end(stamp_key)
+        while len(self._stamps) > self.max_entries:
+            self._forgotten = self._stamps.popitem(last=False)[1]
+
+    def changed_since(self, key, generation):
+        """Returns whether an invalidation since ``generation`` affected the entry ``key``: one
+        of its object key, of a folder containing it, recursively, or below it if it is a
+        listing.
+        """
+        if generation < self._forgotten:
+            return True
+        host, bucket, object_key = key[:3]
+        stamp_keys = [(host, bucket, object_key, False)] + [
+            (host, bucket, folder, True) for folder in [object_key] + parent_prefixes(object_key)
+        ]
+        return any(self._stamps.get(stamp_key, 0) > generation for stamp_key in stamp_keys)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_key.clear()
+        self._by_folder.clear()
+        self._stamps.clear()
+        self._forgotten = self.generation
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+_metadata_cache = None
+
+
+def get_metadata_cache():
+    """Returns the process-wide cache configured by ``METADATA_CACHE_TTL`` and
+    ``METADATA_CACHE_MAX_ENTRIES``.
+    """
+    global _metadata_cache
+    if _metadata_cache is None:
+        _metadata_cache = MetadataCache(settings.METADATA_CACHE_TTL,
+                                        settings.METADATA_CACHE_MAX_ENTRIES)
+    return _metadata_cache
+
+
+class SingleFlight:
+    """Runs one call at a time per key: concurrent calls for a key which is being fetched wait
+    for that fetch and share its result, or its exception.  ``shared`` counts them.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def run(self, key, fetch):
+        """Returns the result of the coroutine function ``fetch``, unless a call for ``key`` is
+        already running, whose result is returned instead.
+        """
+        call_key = (asyncio.get_event_loop(), key)
+        task = self._calls.get(call_key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._calls[call_key] = task
+            task.add_done_callback(functools.partial(self._done, call_key))
+        else:
+            self.shared += 1
+        # A caller which is cancelled does not cancel the fetch shared with the others
+        return await asyncio.shield(task)
+
+    def _done(self, call_key, task):
+        if self._calls.get(call_key) is task:
+            del self._calls[call_key]
+        if not task.cancelled():
+            # Retrieved, even if all the callers were cancelled
+            task.exception()
+
+
+_single_flight = SingleFlight()
+
+
+def get_single_flight():
+    """Returns the process-wide :class:`SingleFlight` of metadata requests.
+    """
+    return _single_flight
+
+
+class BaseNegativeCache:
+    """Interface of negative cache backends, which remember keys found missing for
+    ``NEGATIVE_CACHE_TTL`` seconds.  Configure a custom backend by setting ``NEGATIVE_CACHE`` to
+    its dotted path; it is constructed with ``NEGATIVE_CACHE_PATH``.
+
+    The provider calls backends whose ``blocking`` is True in the default executor of the loop.
+    """
+
+    blocking = False
+
+    def __init__(self, path):
+        self.path = path
+
+    def contains(self, key, credentials):
+        """Returns whether ``key`` has been found missing with ``credentials`` less than
+        ``NEGATIVE_CACHE_TTL`` seconds ago.
+        """
+        raise NotImplementedError
+
+    def add(self, key, credentials):
+        raise NotImplementedError
+
+    def discard(self, keys):
+        """Forgets that the keys in ``keys`` were missing, with any credentials, after they have
+        been written.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryNegativeCache(BaseNegativeCache):
+    """Keeps the missing keys in the memory of the process, at most
+    ``METADATA_CACHE_MAX_ENTRIES`` of them.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        # (key, credentials) -> expiry
+        self._expiries = collections.OrderedDict()
+        # key -> credentials of its entries
+        self._credentials = {}
+
+    def contains(self, key, credentials):
+        expiry = self._expiries.get((key, credentials))
+        if expiry is None:
+            return False
+        if expiry < time.monotonic():
+            self._remove((key, credentials))
+            return False
+        return True
+
+    def add(self, key, credentials):
+        self._expiries[(key, credentials)] = time.monotonic() + settings.NEGATIVE_CACHE_TTL
+        self._expiries.move_to_end((key, credentials))
+        self._credentials.setdefault(key, set()).add(credentials)
+        while len(self._expiries) > settings.METADATA_CACHE_MAX_ENTRIES:
+            self._remove(next(iter(self._expiries)))
+
+    def _remove(self, entry):
+        del self._expiries[entry]
+        key, credentials = entry
+        self._credentials[key].discard(credentials)
+        if not self._credentials[key]:
+            del self._credentials[key]
+
+    def discard(self, keys):
+        for key in keys:
+            for credentials in self._credentials.pop(key, ()):
+                del self._expiries[(key, credentials)]
+
+    def clear(self):
+        self._expiries.clear()
+        self._credentials.clear()
+
+
+class SQLiteNegativeCache(BaseNegativeCache):
+    """Keeps the missing keys in a SQLite database, which may be shared by the worker processes
+    of one host, so that writes through any of them are seen by all.
+    """
+
+    blocking = True
+
+    # Expired entries are purged every this many additions
+    PURGE_INTERVAL = 100
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._local = threading.local()
+        self._additions = 0
+        with self._connection() as connection:
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(missing)')]
+            if columns and 'credentials' not in columns:
+                # Entries of a previous version, without credentials
+                connection.execute('DROP TABLE missing')
+            connection.execute('CREATE TABLE IF NOT EXISTS missing '
+                               '(key TEXT, credentials TEXT, expiry REAL, '
+                               'PRIMARY KEY (key, credentials))')
+
+    def _connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = sqlite3.connect(self.path, timeout=10)
+        return self._local.connection
+
+    def contains(self, key, credentials):
+        row = self._connection().execute(
+            'SELECT expiry FROM missing WHERE key = ? AND credentials = ?',
+            (key, credentials)).fetchone()
+        return row is not None and row[0] >= time.time()
+
+    def add(self, key, credentials):
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO missing VALUES (?, ?, ?)',
+                               (key, credentials, now + settings.NEGATIVE_CACHE_TTL))
+            self._additions += 1
+            if self._additions % self.PURGE_INTERVAL == 0:
+                connection.execute('DELETE FROM missing WHERE expiry < ?', (now, ))
+
+    def discard(self, keys):
+        with self._connection() as connection:
+            connection.executemany('DELETE FROM missing WHERE key = ?',
+                                   [(key, ) for key in keys])
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM missing')
+
+
+NEGATIVE_CACHE_BACKENDS = {
+    'memory': MemoryNegativeCache,
+    'sqlite': SQLiteNegativeCache,
+}
+
+_negative_cache = None
+
+
+def get_negative_cache():
+    """Returns the process-wide negative cache configured by ``NEGATIVE_CACHE``.
+    """
+    global _negative_cache
+    if _negative_cache is None:
+        backend = NEGATIVE_CACHE_BACKENDS.get(settings.NEGATIVE_CACHE)
+        if backend is None:
+            module_name, class_name = settings.NEGATIVE_CACHE.rsplit('.', 1)
+            backend = getattr(importlib.import_module(module_name), class_name)
+        _negative_cache = backend(settings.NEGATIVE_CACHE_PATH)
+    return _negative_cache
@@ -0,0 +1,288 @@
+"""Journal of multipart upload sessions
+
+The journal remembers the upload ID and the uploaded parts of a multipart upload, so that a
+failed upload of the same content to the same key can resume the session instead of starting
+over.  Entries are keyed by a string built by the provider from the endpoint, bucket, key and
+size of the upload.
+
+An upload claims its entry for ``UPLOAD_JOURNAL_LEASE`` seconds, renewed with each part, so
+that concurrent uploads of the same key and size do not share a session.  Expired entries are
+handed back to the provider by `expired`, to abort their sessions before forgetting them.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import importlib
+import threading
+
+from . import settings
+
+
+class BaseUploadJournal:
+    """Interface of upload journal backends.  Configure a custom backend by setting
+    ``UPLOAD_JOURNAL`` to its dotted path; it is constructed with ``UPLOAD_JOURNAL_PATH``.
+
+    The provider calls backends whose ``blocking`` is True in the default executor of the loop.
+    """
+
+    blocking = False
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key):
+        """Returns ``(upload_id, {part_number: etag})`` for the session recorded under ``key``,
+        or None if there is none or it is older than ``RESUMABLE_UPLOAD_TTL``.
+        """
+        raise NotImplementedError
+
+    def claim(self, key):
+        """Claims ``key`` for an upload until its lease runs out.  Returns False if another
+        upload holds it.
+        """
+        raise NotImplementedError
+
+    def release(self, key):
+        """Gives up the claim on ``key``, keeping its session for a later upload to resume.
+        """
+        raise NotImplementedError
+
+    def start(self, key, upload_id):
+        """Records a new session under ``key``, replacing any previous one.  Returns the upload
+        ID of the replaced session, if any, which the caller should abort.
+        """
+        raise NotImplementedError
+
+    def add_part(self, key, part_number, etag):
+        """Records an uploaded part and renews the claim on ``key``.
+        """
+        raise NotImplementedError
+
+    def remove(self, key):
+        """Forgets the session recorded under ``key``, keeping any claim on it.
+        """
+        raise NotImplementedError
+
+    def expired(self, prefix):
+        """Returns ``[(key, upload_id)]`` for the unclaimed sessions older than
+        ``RESUMABLE_UPLOAD_TTL`` whose keys start with ``prefix``.  They are kept until removed.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _is_expired(created):
+        return created + settings.RESUMABLE_UPLOAD_TTL < time.time()
+
+
+class SQLiteUploadJournal(BaseUploadJournal):
+    """Stores sessions in a SQLite database, which may be shared by the worker processes of one
+    host.
+    """
+
+    blocking = True
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS uploads '
+                               '(key TEXT PRIMARY KEY, upload_id TEXT, created REAL, '
+                               'lease REAL DEFAULT 0)')
+            connection.execute('CREATE TABLE IF NOT EXISTS parts '
+                               '(key TEXT, part_number INTEGER, etag TEXT, '
+                               'PRIMARY KEY (key, part_number))')
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(uploads)')]
+            if 'lease' not in columns:
+                connection.execute('ALTER TABLE uploads ADD COLUMN lease REAL DEFAULT 0')
+
+    def _connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = sqlite3.connect(self.path, timeout=10)
+        return self._local.connection
+
+    def get(self, key):
+        connection = self._connection()
+        row = connection.execute('SELECT upload_id, created FROM uploads WHERE key = ?',
+                                 (key, )).fetchone()
+        if row is None or row[0] is None or self._is_expired(row[1]):
+            return None
+        parts = connection.execute('SELECT part_number, etag FROM parts WHERE key = ?', (key, ))
+        return row[0], dict(parts.fetchall())
+
+    def claim(self, key):
+        now = time.time()
+        with self._connection() as connection:
+            # A claim on a key without a session yet holds a row without an upload ID
+            connection.execute('INSERT OR IGNORE INTO uploads VALUES (?, NULL, ?, 0)',
+                               (key, now))
+            cursor = connection.execute('UPDATE uploads SET lease = ? WHERE key = ? AND lease < ?',
+                                        (now + settings.UPLOAD_JOURNAL_LEASE, key, now))
+            return cursor.rowcount == 1
+
+    def release(self, key):
+        with self._connection() as connection:
+            connection.execute('UPDATE uploads SET lease = 0 WHERE key = ?', (key, ))
+            connection.execute('DELETE FROM uploads WHERE key = ? AND upload_id IS NULL', (key, ))
+
+    def start(self, key, upload_id):
+        with self._connection() as connection:
+            row = connection.execute('SELECT upload_id FROM uploads WHERE key = ?',
+                                     (key, )).fetchone()
+            connection.execute('DELETE FROM parts WHERE key = ?', (key, ))
+            connection.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)',
+                               (key, upload_id, time.time(),
+                                time.time() + settings.UPLOAD_JOURNAL_LEASE))
+        if row is None or row[0] == upload_id:
+            return None
+        return row[0]
+
+    def add_part(self, key, part_number, etag):
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO parts VALUES (?, ?, ?)',
+                               (key, part_number, etag))
+            connection.execute('UPDATE uploads SET lease = ? WHERE key = ?',
+                               (time.time() + settings.UPLOAD_JOURNAL_LEASE, key))
+
+    def remove(self, key):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM parts WHERE key = ?', (key, ))
+            connection.execute('UPDATE uploads SET upload_id = NULL WHERE key = ?', (key, ))
+            connection.execute('DELETE FROM uploads WHERE key = ? AND lease < ?',
+                               (key, time.time()))
+
+    def expired(self, prefix):
+        now = time.time()
+        rows = self._connection().execute(
+            'SELECT key, upload_id FROM uploads '
+            'WHERE upload_id IS NOT NULL AND created < ? AND lease < ? AND substr(key, 1, ?) = ?',
+            (now - settings.RESUMABLE_UPLOAD_TTL, now, len(prefix), prefix))
+        return rows.fetchall()
+
+
+class FileUploadJournal(BaseUploadJournal):
+    """Stores each session as a JSON file in the directory ``path``.  Claims are lock files
+    created exclusively next to them, holding the end of their lease.
+    """
+
+    blocking = True
+
+    def __init__(self, path):
+        super().__init__(path)
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key, extension='.json'):
+        return os.path.join(self.path, hashlib.sha256(key.encode('utf-8')).hexdigest() + extension)
+
+    def _read(self, key):
+        try:
+            with open(self._file(key), 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, key, entry):
+        fd, temp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(entry, fp)
+        os.replace(temp_path, self._file(key))
+
+    def _lease(self, key):
+        try:
+            with open(self._file(key, '.lock'), 'r') as fp:
+                return float(fp.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _renew(self, key):
+        fd, temp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(str(time.time() + settings.UPLOAD_JOURNAL_LEASE))
+        os.replace(temp_path, self._file(key, '.lock'))
+
+    def get(self, key):
+        entry = self._read(key)
+        if entry is None or entry['key'] != key or self._is_expired(entry['created']):
+            return None
+        return entry['upload_id'], {int(n): etag for n, etag in entry['parts'].items()}
+
+    def claim(self, key):
+        lock_path = self._file(key, '.lock')
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if self._lease(key) >= time.time():
+                return False
+            # The lease ran out, as after a crash: take the lock over
+            self._renew(key)
+            return True
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(str(time.time() + settings.UPLOAD_JOURNAL_LEASE))
+        return True
+
+    def release(self, key):
+        try:
+            os.remove(self._file(key, '.lock'))
+        except FileNotFoundError:
+            pass
+
+    def start(self, key, upload_id):
+        entry = self._read(key)
+        self._write(key, {'key': key, 'upload_id': upload_id, 'created': time.time(),
+                          'parts': {}})
+        if entry is None or entry['key'] != key or entry['upload_id'] == upload_id:
+            return None
+        return entry['upload_id']
+
+    def add_part(self, key, part_number, etag):
+        entry = self._read(key)
+        if entry is None:
+            return
+        entry['parts'][str(part_number)] = etag
+        self._write(key, entry)
+        self._renew(key)
+
+    def remove(self, key):
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def expired(self, prefix):
+        sessions = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.path, name), 'r') as fp:
+                    entry = json.load(fp)
+            except (OSError, ValueError):
+                continue
+            key = entry['key']
+            if (key.startswith(prefix) and self._is_expired(entry['created']) and
+                    self._lease(key) < time.time()):
+                sessions.append((key, entry['upload_id']))
+        return sessions
+
+
+JOURNAL_BACKENDS = {
+    'sqlite': SQLiteUploadJournal,
+    'file': FileUploadJournal,
+}
+
+_journal = None
+
+
+def get_upload_journal():
+    """Returns the process-wide journal configured by ``UPLOAD_JOURNAL``.
+    """
+    global _journal
+    if _journal is None:
+        backend = JOURNAL_BACKENDS.get(settings.UPLOAD_JOURNAL)
+        if backend is None:
+            module_name, class_name = settings.UPLOAD_JOURNAL.rsplit('.', 1)
+            backend = getattr(importlib.import_module(module_name), class_name)
+        _journal = backend(settings.UPLOAD_JOURNAL_PATH)
+    return _journal
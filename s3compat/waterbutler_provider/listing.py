@@ -0,0 +1,231 @@
+"""Incremental parser of listing responses
+
+``ListBucketResult`` and ``ListVersionsResult`` documents are parsed with expat as their body is
+read, yielding each ``Contents``, ``CommonPrefixes``, ``Version`` or ``DeleteMarker`` element as
+soon as it is complete, instead of building the whole document as nested dicts first.
+"""
+import os
+import asyncio
+import xml.parsers.expat
+
+# Size of the reads from a response body
+READ_SIZE = 64 * 1024  # 64 KiB
+
+# Pages listed ahead by each shard of a sharded listing, before they are consumed.
+SHARD_BUFFERED_PAGES = 4
+
+RECORD_ELEMENTS = frozenset(['Contents', 'CommonPrefixes', 'Version', 'DeleteMarker'])
+
+
+class ListingParser:
+    """Parses a listing fed chunk by chunk.
+
+    Records are ``(element, fields)`` pairs, where ``fields`` maps the names of the children of
+    the element to their text, or to a dict of their own children (as ``Owner``).  Empty elements
+    are None, as with xmltodict.  The other children of the document root, such as
+    ``IsTruncated`` or ``NextMarker``, are collected into ``fields``.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.fields = {}
+        self._records = []
+        self._depth = 0
+        self._record = None
+        self._nested = None
+        self._text = []
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._text.append
+
+    def feed(self, data, final=False):
+        """Parses the next chunk of the document.
+
+        :rtype: list
+        :return: the records completed by this chunk
+        """
+        self._parser.Parse(data, final)
+        records, self._records = self._records, []
+        return records
+
+    async def parse(self, resp):
+        """Yields the records of the body of the response ``resp`` as it is read.  ``fields`` is
+        complete once all the records have been consumed.
+        """
+        while True:
+            chunk = await resp.content.read(READ_SIZE)
+            for record in self.feed(chunk, final=not chunk):
+                yield record
+            if not chunk:
+                break
+
+    def _start(self, name, attributes):
+        self._depth += 1
+        del self._text[:]
+        if self._depth == 1:
+            self.root = name
+        elif self._depth == 2 and name in RECORD_ELEMENTS:
+            self._record = {}
+        elif self._depth == 3 and self._record is not None:
+            self._nested = {}
+
+    def _end(self, name):
+        text = ''.join(self._text) or None
+        del self._text[:]
+        depth = self._depth
+        self._depth -= 1
+        if depth == 2:
+            if self._record is not None:
+                self._records.append((name, self._record))
+                self._record = None
+            else:
+                self.fields[name] = text
+        elif depth == 3 and self._record is not None:
+            # A dict of the children of the field, if it has any
+            self._record[name] = self._nested or text
+            self._nested = None
+        elif depth == 4 and self._nested is not None:
+            self._nested[name] = text
+
+
+async def read_listing(resp):
+    """Parses a whole listing response.
+
+    :rtype: tuple
+    :return: the root element name, the top-level fields and the list of records
+    """
+    parser = ListingParser()
+    records = [record async for record in parser.parse(resp)]
+    return parser.root, parser.fields, records
+
+
+def split_keys(keys, start, upper, count):
+    """Returns up to ``count`` keys splitting the keys listed after ``keys``, which is a page of
+    a listing, into ranges expected to hold about as many keys as the page.
+
+    The page is extrapolated: the keys of the page vary from some position on, so the next
+    ranges are found by incrementing the character before it, as an odometer on the characters
+    seen where the keys of the page vary.  For a page from 'run_000000' to 'run_000999', they
+    are 'run_001', 'run_002' and so on.
+
+    :param int start: the length of the prefix shared by all the keys of the listing
+    :param str upper: the last key of the range being listed, or None
+    """
+    first, last = keys[0], keys[-1]
+    position = max(len(os.path.commonprefix([first, last])) - 1, start)
+    if position >= len(last):
+        return []
+    # The characters of the columns which vary within the page
+    alphabet = set()
+    for column in range(position, max(len(key) for key in keys)):
+        chars = set(key[column] for key in keys if len(key) > column)
+        if len(chars) > 1:
+            alphabet |= chars
+    if not alphabet:
+        return []
+    alphabet = sorted(alphabet)
+    digits = list(last[start:position + 1])
+    boundaries = []
+    while len(boundaries) < count:
+        i = len(digits) - 1
+        while i >= 0:
+            larger = [char for char in alphabet if char > digits[i]]
+            if larger:
+                digits[i] = larger[0]
+                break
+            digits[i] = alphabet[0]
+            i -= 1
+        if i < 0:
+            break
+        boundary = last[:start] + ''.join(digits)
+        if upper is not None and boundary >= upper:
+            break
+        boundaries.append(boundary)
+    return boundaries
+
+
+class _Shard:
+
+    def __init__(self, start_after, upper):
+        self.start_after = start_after
+        self.upper = upper
+        self.queue = asyncio.Queue(SHARD_BUFFERED_PAGES)
+
+
+class ShardedListing:
+    """Lists the keys starting with ``prefix`` with up to ``concurrency`` requests at once.
+
+    The keys are listed by shards, each listing a range of keys from its own ``start-after``.
+    A shard whose range turns out to hold more than a page splits the rest of it with
+    :func:`split_keys`, while there are fewer than ``concurrency`` shards, so that the ranges
+    holding many keys end up listed by several shards.  Pages are yielded in key order.
+
+    :param list_page: coroutine function ``list_page(start_after, token)`` listing the page of
+        ``token``, or the first page after ``start_after``, and returning its ``Contents``
+        records and the token of the next page, or None for the last page
+    """
+
+    def __init__(self, list_page, prefix, concurrency, start_after=None):
+        self.list_page = list_page
+        self.prefix = prefix
+        self.start_after = start_after
+        self.concurrency = concurrency
+        self._requests = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+
+    async def pages(self):
+        shards = [self._start(self.start_after, None)]
+        try:
+            while shards:
+                shard = shards.pop(0)
+                while True:
+                    kind, value = await shard.queue.get()
+                    if kind == 'page':
+                        yield value
+                        continue
+                    if kind == 'split':
+                        shards[0:0] = value
+                    elif kind == 'error':
+                        raise value
+                    break
+        finally:
+            for task in self._tasks:
+                task.cancel()
+
+    def _start(self, start_after, upper):
+        shard = _Shard(start_after, upper)
+        task = asyncio.ensure_future(self._list(shard))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return shard
+
+    async def _list(self, shard):
+        try:
+            start_after = shard.start_after
+            token = None
+            while True:
+                async with self._requests:
+                    records, token = await self.list_page(start_after, token)
+                in_range = [record for record in records
+                            if shard.upper is None or record['Key'] <= shard.upper]
+                if in_range:
+                    await shard.queue.put(('page', in_range))
+                if token is None or len(in_range) < len(records):
+                    break
+                start_after = records[-1]['Key']
+                boundaries = split_keys([record['Key'] for record in records],
+                                        len(self.prefix), shard.upper,
+                                        self.concurrency - len(self._tasks))
+                if boundaries:
+                    lowers = [start_after] + boundaries
+                    uppers = boundaries + [shard.upper]
+                    await shard.queue.put(('split', [self._start(lower, upper) for lower, upper
+                                                     in zip(lowers, uppers)]))
+                    return
+            await shard.queue.put(('end', None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            await shard.queue.put(('error', exc))
@@ -2,6 +2,12 @@ import os
 
 from waterbutler.core import metadata
 
+# Object metadata holding the digests of the content computed at upload, by hash name
+CONTENT_HASH_HEADERS = {
+    'md5': 'x-amz-meta-md5',
+    'sha256': 'x-amz-meta-sha256',
+}
+
 
 class S3CompatMetadata(metadata.BaseMetadata):
 
@@ -19,6 +25,37 @@ class S3CompatMetadata(metadata.BaseMetadata):
         raw[key] = raw[key][len(provider.prefix):].lstrip('/')
 
 
+class S3CompatListingMetadata(S3CompatMetadata):
+    """Metadata of an item of a folder listing.
+
+    Listings are made of thousands of items, so the record parsed from the listing is kept as
+    ``raw`` without being copied, and is never modified: it may also be held by the metadata
+    cache.  The prefix of the provider is stripped from the key of the record when it is read.
+    """
+
+    # Element of the record holding the key of the item
+    KEY_ELEMENT = 'Key'
+
+    def __init__(self, provider, raw):
+        self._provider_name = provider.NAME
+        self._prefix = provider.prefix
+        super().__init__(raw)
+
+    @property
+    def provider(self):
+        return self._provider_name
+
+    @property
+    def key(self):
+        """The key of the item relative to the prefix of the provider
+        """
+        return self.raw[self.KEY_ELEMENT][len(self._prefix):].lstrip('/')
+
+    @property
+    def path(self):
+        return '/' + self.key
+
+
 class S3CompatFileMetadataHeaders(S3CompatMetadata, metadata.BaseFileMetadata):
 
     def __init__(self, provider, path, headers):
@@ -53,24 +90,28 @@ class S3CompatFileMetadataHeaders(S3CompatMetadata, metadata.BaseFileMetadata):
     def etag(self):
         return self.raw['Etag'].replace('"', '')
 
+    @property
+    def hashes(self):
+        """The digests of the content stored as object metadata at upload, by hash name.
+        """
+        headers = {name.lower(): value for name, value in self.raw.items()}
+        return {name: headers[header] for name, header in CONTENT_HASH_HEADERS.items()
+                if headers.get(header)}
+
     @property
     def extra(self):
-        return {
-            'md5': self.raw['Etag'].replace('"', ''),
+        hashes = self.hashes
+        extra = {
+            # The ETag is not the MD5 of objects uploaded by parts
+            'md5': hashes.get('md5', self.raw['Etag'].replace('"', '')),
             'encryption': self.raw.get('x-amz-server-side-encryption', '')
         }
+        if hashes:
+            extra['hashes'] = hashes
+        return extra
 
 
-class S3CompatFileMetadata(S3CompatMetadata, metadata.BaseFileMetadata):
-
-    def __init__(self, provider, raw):
-        new_raw = dict(raw)
-        self.convert_prefix(provider, new_raw, 'Key')
-        super().__init__(new_raw)
-
-    @property
-    def path(self):
-        return '/' + self.raw['Key'].lstrip('/')
+class S3CompatFileMetadata(S3CompatListingMetadata, metadata.BaseFileMetadata):
 
     @property
     def size(self):
@@ -99,20 +140,11 @@ class S3CompatFileMetadata(S3CompatMetadata, metadata.BaseFileMetadata):
         }
 
 
-class S3CompatFolderKeyMetadata(S3CompatMetadata, metadata.BaseFolderMetadata):
-
-    def __init__(self, provider, raw):
-        new_raw = dict(raw)
-        self.convert_prefix(provider, new_raw, 'Key')
-        super().__init__(new_raw)
+class S3CompatFolderKeyMetadata(S3CompatListingMetadata, metadata.BaseFolderMetadata):
 
     @property
     def name(self):
-        return self.raw['Key'].split('/')[-2]
-
-    @property
-    def path(self):
-        return '/' + self.raw['Key'].lstrip('/')
+        return self.key.split('/')[-2]
 
     @property
     def created(self):
@@ -123,20 +155,13 @@ class S3CompatFolderKeyMetadata(S3CompatMetadata, metadata.BaseFolderMetadata):
         return self.raw.get('modified_at')
 
 
-class S3CompatFolderMetadata(S3CompatMetadata, metadata.BaseFolderMetadata):
+class S3CompatFolderMetadata(S3CompatListingMetadata, metadata.BaseFolderMetadata):
 
-    def __init__(self, provider, raw):
-        new_raw = dict(raw)
-        self.convert_prefix(provider, new_raw, 'Prefix')
-        super().__init__(new_raw)
+    KEY_ELEMENT = 'Prefix'
 
     @property
     def name(self):
-        return self.raw['Prefix'].split('/')[-2]
-
-    @property
-    def path(self):
-        return '/' + self.raw['Prefix'].lstrip('/')
+        return self.key.split('/')[-2]
 
     @property
     def created(self):
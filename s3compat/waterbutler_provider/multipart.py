@@ -0,0 +1,44 @@
+"""Planning of multipart uploads
+"""
+import math
+
+# Maximum number of parts of a multipart upload in Amazon S3
+MAX_PARTS = 10000
+
+
+def plan_part_sizes(size, min_part_size, max_part_size, target_part_count, max_parts=MAX_PARTS):
+    """Returns the sizes of the parts to split an upload of ``size`` bytes into.
+
+    The part size aims at ``target_part_count`` parts within ``min_part_size`` and
+    ``max_part_size``, and grows as needed to stay within ``max_parts``.  The size is then spread
+    evenly over the parts, so that the upload does not end with a small leftover part: 130 MB
+    with 64 MB parts gives two parts of 65 MB.
+
+    :raises ValueError: if ``size`` cannot be uploaded in ``max_parts`` parts
+    """
+    part_size = min(max(min_part_size, math.ceil(size / target_part_count)), max_part_size)
+    part_size = max(part_size, math.ceil(size / max_parts))
+    if part_size > max_part_size:
+        raise ValueError('{} bytes cannot be uploaded in {} parts of at most {} bytes'.format(
+            size, max_parts, max_part_size))
+
+    count = max(1, size // part_size)
+    if math.ceil(size / count) > max_part_size:
+        count = math.ceil(size / max_part_size)
+    # Parts differ by at most one byte, the larger ones first
+    part_size, remainder = divmod(size, count)
+    return [part_size + 1] * remainder + [part_size] * (count - remainder)
+
+
+def stream_part_sizes(min_part_size, max_part_size, max_parts=MAX_PARTS, growth_interval=1000):
+    """Yields the sizes of the parts of an upload whose size is not known in advance.
+
+    Parts start at ``min_part_size`` and double every ``growth_interval`` parts, up to
+    ``max_part_size``, so that the upload is not limited to ``max_parts`` parts of the minimum
+    size.  At most ``max_parts`` sizes are yielded.
+    """
+    part_size = min(min_part_size, max_part_size)
+    for number in range(max_parts):
+        if number and number % growth_interval == 0:
+            part_size = min(part_size * 2, max_part_size)
+        yield part_size
@@ -0,0 +1,60 @@
+"""Connection pools shared by the provider instances of a process
+
+WaterButler creates a provider, and with it a client session, for every request.  Passing the
+same connector to those sessions lets requests to a storage service reuse open connections,
+instead of repeating the TCP and TLS handshakes each time.
+"""
+import asyncio
+
+import aiohttp
+
+from . import settings
+
+
+class SharedTCPConnector(aiohttp.TCPConnector):
+    """Connector which outlives the sessions using it: closing a session does not close it.
+    """
+
+    def close(self):
+        # Sessions close their connector when they are closed
+        closed = asyncio.get_event_loop().create_future()
+        closed.set_result(None)
+        return closed
+
+    def close_shared(self):
+        return super().close()
+
+
+_connectors = {}
+
+
+def get_connector(scheme, host, port):
+    """Returns the connector shared by requests to ``scheme://host:port`` in the running event
+    loop.  Idle connections are kept alive for ``CONNECTION_POOL_KEEPALIVE_TIMEOUT`` seconds, at
+    most ``CONNECTION_POOL_LIMIT_PER_HOST`` connections are opened at once, and host names are
+    resolved once per ``CONNECTION_POOL_DNS_CACHE_TTL`` seconds.
+    """
+    loop = asyncio.get_event_loop()
+    key = (scheme, host, port)
+    entry = _connectors.get(key)
+    if entry is not None and entry[0] is loop and not entry[1].closed:
+        return entry[1]
+    connector = SharedTCPConnector(
+        limit=0,
+        limit_per_host=settings.CONNECTION_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=settings.CONNECTION_POOL_KEEPALIVE_TIMEOUT,
+        use_dns_cache=True,
+        ttl_dns_cache=settings.CONNECTION_POOL_DNS_CACHE_TTL,
+    )
+    _connectors[key] = (loop, connector)
+    return connector
+
+
+async def close_connectors():
+    """Closes all shared connectors, for shutdown and tests.
+    """
+    entries = list(_connectors.values())
+    _connectors.clear()
+    for loop, connector in entries:
+        if loop is asyncio.get_event_loop():
+            await connector.close_shared()
@@ -1,4 +1,6 @@
 import os
+import base64
+import asyncio
 import hashlib
 import functools
 from urllib import parse
@@ -7,6 +9,7 @@ import logging
 import xml.sax.saxutils
 
 import xmltodict
+import aiohttp
 
 from boto.compat import BytesIO  # type: ignore
 from boto.s3.connection import S3Connection, OrdinaryCallingFormat, NoHostProvided
@@ -18,7 +21,16 @@ from waterbutler.core import streams, provider, exceptions
 from waterbutler.core.path import WaterButlerPath
 from waterbutler.core.utils import make_disposition
 from . import settings
-from .metadata import (S3CompatRevision,
+from .cache import (get_metadata_cache, get_negative_cache, get_single_flight,
+                    listing_variant, parent_prefixes)
+from .journal import get_upload_journal
+from .listing import ListingParser, ShardedListing
+from .multipart import plan_part_sizes, stream_part_sizes
+from .pool import get_connector
+from .signer import SigV4Signer
+from .streams import HashingStream, PartBuffer, RangeDownloadStream, ThreadedHash
+from .metadata import (CONTENT_HASH_HEADERS,
+                       S3CompatRevision,
                        S3CompatFileMetadata,
                        S3CompatFolderMetadata,
                        S3CompatFolderKeyMetadata,
@@ -27,6 +39,151 @@ from .metadata import (S3CompatRevision,
 
 logger = logging.getLogger(__name__)
 
+# HTTP statuses with which endpoints reject Multi-Object Delete requests they do not implement.
+BULK_DELETE_UNSUPPORTED_STATUSES = (400, 405, 501)
+
+# HTTP statuses with which endpoints which do not implement ListObjectsV2 reject it.
+LIST_OBJECTS_V2_UNSUPPORTED_STATUSES = (400, 405, 501)
+
+# HTTP statuses of failed part uploads which are worth retrying.
+PART_UPLOAD_RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# ETags which S3 gives to objects uploaded by parts: the MD5 of the MD5 digests of the parts, and
+# the number of parts.
+COMPOSITE_ETAG_RE = re.compile(r'^([0-9a-f]{32})-([0-9]+)$')
+
+# ETags which are the MD5 of the content, as for parts and objects uploaded in one request.
+MD5_ETAG_RE = re.compile(r'^[0-9a-f]{32}$')
+
+# Features detected per storage endpoint.  Shared by all provider instances in the process, as
+# WaterButler creates a new provider for every request.
+_endpoint_capabilities = {}
+
+
+async def _bounded_gather(coros, limit):
+    """Awaits the given coroutines with at most ``limit`` of them running at once and returns
+    their results in order.  If one fails, the others are cancelled before its error is raised.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    tasks = [asyncio.ensure_future(run(coro)) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+
+def _chunked(items, size):
+    """Splits a list into lists of at most ``size`` items.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _stream_size(stream):
+    """Returns the size of ``stream``, or None if it is not known in advance, as for requests
+    sent with chunked transfer encoding or archives generated on the fly.
+    """
+    try:
+        size = stream.size
+    except (TypeError, ValueError):
+        # RequestStreamReader without Content-Length
+        return None
+    return None if size is None else int(size)
+
+
+def _etag_is_md5(headers):
+    """Returns whether the response ``headers`` of an upload may have the MD5 of the content as
+    ETag, which they do not when the content is encrypted with SSE-KMS or SSE-C.
+    """
+    return not headers.get('x-amz-server-side-encryption', '').startswith('aws:kms') and \
+        not headers.get('x-amz-server-side-encryption-customer-algorithm')
+
+
+class _TaskPool:
+    """Runs coroutines in the background, at most ``size`` of them at once.
+
+    A producer calls `acquire` before preparing each job and `start` to run it, so that it is
+    paced by the pool.  The first failure of a job is raised by the next `acquire` or by `join`.
+    With ``max_bytes``, a producer also calls `reserve` for the memory each job holds, before it
+    is prepared, so that the jobs being prepared or running hold at most ``max_bytes`` bytes.
+    """
+
+    def __init__(self, size, max_bytes=None):
+        self._slots = asyncio.Semaphore(size)
+        self._tasks = {}
+        self._errors = []
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._bytes_freed = asyncio.Event()
+
+    async def acquire(self):
+        await self._slots.acquire()
+        if self._errors:
+            self._slots.release()
+            raise self._errors[0]
+
+    def release(self):
+        """Gives back a slot which has been acquired but is not used to start a job.
+        """
+        self._slots.release()
+
+    async def reserve(self, nbytes):
+        """Waits until ``nbytes`` more bytes fit within ``max_bytes`` and reserves them for the
+        next job.  A job larger than ``max_bytes`` is let through once nothing else is reserved.
+        """
+        if self._max_bytes is not None:
+            while self._bytes and self._bytes + nbytes > self._max_bytes:
+                self._bytes_freed.clear()
+                await self._bytes_freed.wait()
+                if self._errors:
+                    raise self._errors[0]
+        self._bytes += nbytes
+
+    def unreserve(self, nbytes):
+        """Gives back bytes which have been reserved but are not used to start a job.
+        """
+        self._bytes -= nbytes
+        self._bytes_freed.set()
+
+    def start(self, coro, nbytes=0):
+        """Runs ``coro`` in the background, holding the slot acquired for it and the ``nbytes``
+        bytes reserved for it until it ends.
+        """
+        task = asyncio.ensure_future(coro)
+        self._tasks[task] = nbytes
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        self.unreserve(self._tasks.pop(task, 0))
+        self._slots.release()
+        if not task.cancelled() and task.exception() is not None:
+            self._errors.append(task.exception())
+
+    async def join(self):
+        """Waits for all started jobs and raises the first failure, if any.
+        """
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+        if self._errors:
+            raise self._errors[0]
+
+    async def cancel(self):
+        """Cancels the running jobs and waits for them to settle.
+        """
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
 
 class S3CompatConnection(S3Connection):
     def __init__(self, aws_access_key_id=None, aws_secret_access_key=None,
@@ -77,6 +234,17 @@ class S3CompatProvider(provider.BaseProvider):
     NAME = 's3compat'
     CHUNK_SIZE = settings.CHUNK_SIZE
     CONTIGUOUS_UPLOAD_SIZE_LIMIT = settings.CONTIGUOUS_UPLOAD_SIZE_LIMIT
+    MULTIPART_CONCURRENCY = settings.MULTIPART_CONCURRENCY
+    MULTIPART_MAX_BUFFER_SIZE = settings.MULTIPART_MAX_BUFFER_SIZE
+    MULTIPART_MAX_PART_SIZE = settings.MULTIPART_MAX_PART_SIZE
+    MULTIPART_TARGET_PART_COUNT = settings.MULTIPART_TARGET_PART_COUNT
+    MULTIPART_COPY_THRESHOLD = settings.MULTIPART_COPY_THRESHOLD
+    MULTIPART_COPY_CONCURRENCY = settings.MULTIPART_COPY_CONCURRENCY
+    LISTING_SHARD_CONCURRENCY = settings.LISTING_SHARD_CONCURRENCY
+    PARALLEL_DOWNLOAD_CONCURRENCY = settings.PARALLEL_DOWNLOAD_CONCURRENCY
+    PARALLEL_DOWNLOAD_PART_SIZE = settings.PARALLEL_DOWNLOAD_PART_SIZE
+    SIGNATURE_VERSION = settings.SIGNATURE_VERSION
+    SIGNATURE_REGION = settings.SIGNATURE_REGION
 
     def __init__(self, auth, credentials, settings, **kwargs):
         """
@@ -87,7 +255,9 @@ class S3CompatProvider(provider.BaseProvider):
 
         :param dict auth: Not used
         :param dict credentials: Dict containing `access_key` and `secret_key`
-        :param dict settings: Dict containing `bucket`
+        :param dict settings: Dict containing `bucket`, and optionally `multipart_upload` with
+            the `min_part_size`, `max_part_size` and `target_part_count` of the service, and
+            `signature_version` and `region` to sign requests with
         """
         super().__init__(auth, credentials, settings, **kwargs)
 
@@ -97,6 +267,10 @@ class S3CompatProvider(provider.BaseProvider):
         if m is not None:
             host = m.group(1)
             port = int(m.group(2))
+        self.endpoint = '{}:{}'.format(host, port)
+        self.scheme = 'https' if port == 443 else 'http'
+        self.host = host
+        self.port = port
         self.connection = S3CompatConnection(credentials['access_key'],
                                              credentials['secret_key'],
                                              calling_format=OrdinaryCallingFormat(),
@@ -107,6 +281,118 @@ class S3CompatProvider(provider.BaseProvider):
         self.encrypt_uploads = self.settings.get('encrypt_uploads', False)
         self.prefix = settings.get('prefix', '')
 
+        signature_version = str(settings.get('signature_version', self.SIGNATURE_VERSION))
+        if signature_version.lower() in ('4', 'v4', 's3v4'):
+            self.signer = SigV4Signer(credentials['access_key'], credentials['secret_key'],
+                                      settings.get('region') or self.SIGNATURE_REGION)
+        else:
+            # SigV2, signed by boto
+            self.signer = None
+        # Identifies the credentials in the keys of the shared caches, without keeping them
+        self.credentials_digest = hashlib.sha256('{}:{}'.format(
+            credentials['access_key'], credentials['secret_key']).encode('utf-8')).hexdigest()
+
+    async def make_request(self, method, url, *args, **kwargs):
+        """Sends the request over the connections shared with the other providers of this
+        process for the same storage service, unless ``CONNECTION_POOL`` is disabled.
+
+        With SigV4 all the query parameters are signed, so ``params`` are added to the URL
+        generated by `_url_for` instead of being sent separately.
+        """
+        if self.signer is not None and kwargs.get('params') and callable(url):
+            url = functools.partial(url, params=kwargs.pop('params'))
+        if settings.CONNECTION_POOL and 'connector' not in kwargs:
+            kwargs['connector'] = get_connector(self.scheme, self.host, self.port)
+        return await super().make_request(method, url, *args, **kwargs)
+
+    def _url_for(self, key=''):
+        """Returns the function generating presigned URLs of ``key``, or of the bucket if ``key``
+        is empty.  It takes the arguments of boto's ``generate_url``: ``expires_in, method,
+        headers=None, query_parameters=None, response_headers=None``.
+        """
+        if self.signer is None:
+            return self.bucket.new_key(key).generate_url if key else self.bucket.generate_url
+        return functools.partial(self._presign_url, key)
+
+    def _presign_url(self, key, expires_in, method='GET', headers=None, query_parameters=None,
+                     response_headers=None, params=None):
+        query = dict(query_parameters or {})
+        query.update(response_headers or {})
+        query.update(params or {})
+        path = '/{}/{}'.format(parse.quote(self.settings['bucket']), parse.quote(key))
+        host = self.host if self.port in (80, 443) else '{}:{}'.format(self.host, self.port)
+        return self.signer.presign_url(method, self.scheme, host, path, expires_in,
+                                       query=query, headers=headers)
+
+    def _authorize_url(self, method, url, headers):
+        """Returns the URL to send a request for the presigned ``url`` to, adding the headers
+        authorizing it to ``headers`` if needed.
+        """
+        if self.signer is None:
+            return self.connection.add_auth(method, url, headers)
+        return url
+
+    def _get_capability(self, name, default=None):
+        """Returns what has been detected about feature ``name`` of this endpoint, if anything.
+        """
+        return _endpoint_capabilities.get(self.endpoint, {}).get(name, default)
+
+    def _set_capability(self, name, value):
+        _endpoint_capabilities.setdefault(self.endpoint, {})[name] = value
+
+    @property
+    def metadata_cache(self):
+        return get_metadata_cache()
+
+    def _cache_key(self, key, variant=None):
+        return (self.endpoint, self.settings['bucket'], key, variant, self.credentials_digest)
+
+    async def _cached_metadata(self, cache_key, fetch, kind='metadata'):
+        """Returns the metadata cached under ``cache_key``, or fetches it with the coroutine
+        function ``fetch`` and caches it, unless it is None.  Concurrent calls for the same
+        ``kind`` of fetch of the same key share one fetch and its result.
+        """
+        value = self.metadata_cache.get(cache_key)
+        if value is not None:
+            return value
+
+        async def fetch_and_cache():
+            generation = self.metadata_cache.generation
+            value = await fetch()
+            # Not cached if it may have changed while it was fetched
+            if value is not None and \
+                    not self.metadata_cache.changed_since(cache_key, generation):
+                self.metadata_cache.set(cache_key, value)
+            return value
+
+        if not settings.METADATA_SINGLE_FLIGHT:
+            return await fetch_and_cache()
+        return await get_single_flight().run((kind, cache_key), fetch_and_cache)
+
+    async def _invalidate_metadata(self, key, recursive=False):
+        """Drops the cached metadata of ``key`` and of the folders containing it, after it has
+        been written or deleted.
+        """
+        self.metadata_cache.invalidate(self.endpoint, self.settings['bucket'], key,
+                                       recursive=recursive)
+        if settings.NEGATIVE_CACHE_TTL > 0:
+            await self._call_negative_cache('discard', [
+                self._negative_cache_key(prefix) for prefix in [key] + parent_prefixes(key)
+            ])
+
+    def _negative_cache_key(self, key):
+        return '{}/{}/{}'.format(self.endpoint, self.settings['bucket'], key.lstrip('/'))
+
+    async def _call_negative_cache(self, name, *args):
+        """Calls the method ``name`` of the negative cache, in the default executor of the loop
+        if the backend blocks.
+        """
+        negative_cache = get_negative_cache()
+        method = functools.partial(getattr(negative_cache, name), *args)
+        if not negative_cache.blocking:
+            return method()
+        return await asyncio.get_event_loop().run_in_executor(None, method)
+
     async def validate_v1_path(self, path, **kwargs):
         wbpath = WaterButlerPath(path, prepend=self.prefix)
         if path == '/':
@@ -115,26 +401,51 @@ class S3CompatProvider(provider.BaseProvider):
         implicit_folder = path.endswith('/')
 
         prefix = wbpath.full_path.lstrip('/')  # '/' -> '', '/A/B' -> 'A/B'
+        negative_cache_key = self._negative_cache_key(prefix)
+        use_negative_cache = settings.NEGATIVE_CACHE_TTL > 0
+        if use_negative_cache and await self._call_negative_cache(
+                'contains', negative_cache_key, self.credentials_digest):
+            raise exceptions.NotFoundError(str(prefix))
+        generation = self.metadata_cache.generation
+
         if implicit_folder:
-            params = {'prefix': prefix, 'delimiter': '/'}
-            resp = await self.make_request(
-                'GET',
-                functools.partial(self.bucket.generate_url, settings.TEMP_URL_SECS, 'GET'),
-                params=params,
-                expects=(200, 404, ),
-                throws=exceptions.MetadataError,
-            )
+            async def fetch():
+                resp = await self.make_request(
+                    'GET',
+                    functools.partial(self._url_for(), settings.TEMP_URL_SECS, 'GET'),
+                    params={'prefix': prefix, 'delimiter': '/'},
+                    expects=(200, 404, ),
+                    throws=exceptions.MetadataError,
+                )
+                await resp.release()
+                return resp.status
+
+            if settings.METADATA_SINGLE_FLIGHT:
+                status = await get_single_flight().run(
+                    ('validate', self._cache_key(prefix)), fetch)
+            else:
+                status = await fetch()
+            found = status != 404
         else:
-            resp = await self.make_request(
-                'HEAD',
-                functools.partial(self.bucket.new_key(prefix).generate_url, settings.TEMP_URL_SECS, 'HEAD'),
-                expects=(200, 404, ),
-                throws=exceptions.MetadataError,
-            )
+            async def fetch():
+                resp = await self.make_request(
+                    'HEAD',
+                    functools.partial(self._url_for(prefix), settings.TEMP_URL_SECS, 'HEAD'),
+                    expects=(200, 404, ),
+                    throws=exceptions.MetadataError,
+                )
+                await resp.release()
+                return dict(resp.headers) if resp.status == 200 else None
 
-        await resp.release()
+            found = await self._cached_metadata(self._cache_key(prefix), fetch,
+                                                kind='validate') is not None
 
-        if resp.status == 404:
+        if not found:
+            # Unless something was written meanwhile
+            if use_negative_cache and \
+                    not self.metadata_cache.changed_since(self._cache_key(prefix), generation):
+                await self._call_negative_cache('add', negative_cache_key,
+                                                self.credentials_digest)
             raise exceptions.NotFoundError(str(prefix))
 
         return wbpath
@@ -146,24 +457,110 @@ class S3CompatProvider(provider.BaseProvider):
         return True
 
     def can_intra_copy(self, dest_provider, path=None):
-        return False
+        """Objects are copied within the storage when both providers use the same endpoint with
+        the same credentials, which can then read the source bucket.
+        """
+        return isinstance(dest_provider, type(self)) and \
+            self.endpoint == dest_provider.endpoint and \
+            self.credentials.get('access_key') == dest_provider.credentials.get('access_key')
 
     def can_intra_move(self, dest_provider, path=None):
-        return False
+        # Moves are copies followed by a delete of the source, in batches for folders
+        return self.can_intra_copy(dest_provider, path)
 
     async def intra_copy(self, dest_provider, source_path, dest_path):
         """Copy key from one S3 Compatible Storage bucket to another. The credentials specified in
         `dest_provider` must have read access to `source.bucket`.
+
+        Folders are copied key by key, with up to ``INTRA_COPY_CONCURRENCY`` copies at once,
+        replacing the destination folder as WaterButler does when copying through itself.
+        Objects of ``MULTIPART_COPY_THRESHOLD`` bytes or more are copied by parts.
         """
+        if source_path.is_dir:
+            return await self._intra_copy_folder(dest_provider, source_path, dest_path)
+
         exists = await dest_provider.exists(dest_path)
+        source_metadata = await self.metadata(source_path)
+        await self._copy_object(dest_provider, source_path.full_path, dest_path.full_path,
+                                size=source_metadata.size_as_int)
+        return (await dest_provider.metadata(dest_path)), not exists
+
+    async def _intra_copy_folder(self, dest_provider, source_path, dest_path):
+        source_prefix = source_path.full_path.lstrip('/')
+        dest_prefix = dest_path.full_path.lstrip('/')
+        if self.settings['bucket'] == dest_provider.settings['bucket'] and \
+                (dest_prefix.startswith(source_prefix) or source_prefix.startswith(dest_prefix)):
+            # Replacing a destination containing the source would delete the source, and the
+            # listing of a source containing the destination would see the copies as they
+            # are made
+            raise exceptions.IntraCopyError(
+                'Cannot copy the folder {} to {}, which overlaps it'.format(
+                    source_path.full_path, dest_path.full_path),
+                code=400,
+            )
+
+        exists = await dest_provider.exists(dest_path)
+        if exists:
+            await dest_provider.delete(dest_path)
+
+        found = False
+        pool = _TaskPool(settings.INTRA_COPY_CONCURRENCY)
+        try:
+            async for contents in self._iter_objects(source_prefix):
+                for content in contents:
+                    found = True
+                    await pool.acquire()
+                    pool.start(self._copy_object(
+                        dest_provider, content['Key'],
+                        dest_prefix + content['Key'][len(source_prefix):],
+                        size=int(content.get('Size') or 0),
+                    ))
+            await pool.join()
+        except BaseException:
+            await pool.cancel()
+            raise
+        finally:
+            await dest_provider._invalidate_metadata(dest_prefix, recursive=True)
+
+        if not found:
+            # The source folder only exists as a common prefix, as on MinIO
+            await dest_provider.create_folder(dest_path, folder_precheck=False)
 
-        dest_key = dest_provider.bucket.new_key(dest_path.full_path)
+        folder = S3CompatFolderMetadata(dest_provider, {'Prefix': dest_prefix})
+        children = await dest_provider._metadata_folder(dest_path)
+        if children and isinstance(children[-1], str):
+            children.pop()  # token of the next page
+        folder._children = children
+        return folder, not exists
 
+    def _copy_source(self, key):
         # ensure no left slash when joining paths
-        source_path = '/' + os.path.join(self.settings['bucket'], source_path.full_path)
-        headers = {'x-amz-copy-source': parse.quote(source_path)}
+        return parse.quote('/' + os.path.join(self.settings['bucket'], key.lstrip('/')))
+
+    async def _copy_object(self, dest_provider, source_key, dest_key, size=0, metadata=None,
+                           etag=None):
+        """Copies the object ``source_key`` of this bucket to ``dest_key`` of the bucket of
+        ``dest_provider`` with a CopyObject request, or by parts if it is ``size`` bytes long and
+        that is at least ``MULTIPART_COPY_THRESHOLD``.
+
+        :param dict metadata: ``x-amz-meta-*`` headers replacing the metadata of the source
+        :param str etag: if given, the source is only copied if it has this ETag
+        """
+        if size >= self.MULTIPART_COPY_THRESHOLD:
+            await self._multipart_copy(dest_provider, source_key, dest_key, size,
+                                       metadata=metadata, etag=etag)
+            return
+
+        headers = {'x-amz-copy-source': self._copy_source(source_key)}
+        if etag is not None:
+            headers['x-amz-copy-source-if-match'] = etag
+        if metadata is not None:
+            headers.update(metadata)
+            headers['x-amz-metadata-directive'] = 'REPLACE'
+        if dest_provider.encrypt_uploads:
+            headers['x-amz-server-side-encryption'] = 'AES256'
         url = functools.partial(
-            dest_key.generate_url,
+            dest_provider._url_for(dest_key),
             settings.TEMP_URL_SECS,
             'PUT',
             headers=headers,
@@ -177,10 +574,105 @@ class S3CompatProvider(provider.BaseProvider):
         )
 
         response_body = await resp.read()
+        await dest_provider._invalidate_metadata(dest_key)
         self._check_for_200_error(response_body, "CopyObject", exceptions.IntraCopyError)
 
         await resp.release()
-        return (await dest_provider.metadata(dest_path)), not exists
+
+    async def _multipart_copy(self, dest_provider, source_key, dest_key, size, metadata=None,
+                              etag=None):
+        """Copies the object ``source_key`` of ``size`` bytes as a multipart upload to
+        ``dest_provider``, whose parts are byte ranges of the source copied with UploadPartCopy
+        requests, up to ``MULTIPART_COPY_CONCURRENCY`` at once.  The parts are sized by the
+        ``_plan_parts`` of the destination.  As the headers of the source are not copied with the
+        parts, the upload is initiated with its ``Content-Type`` and ``Content-Disposition``, and
+        with ``metadata`` or else its ``x-amz-meta-*`` headers.  Each part is only copied from
+        the source with the ETag ``etag``, or the one it had when the copy started, so that the
+        copy fails rather than mixes two versions if the source is replaced meanwhile.
+
+        Docs: https://docs.aws.amazon.com/AmazonS3/latest/API/API_UploadPartCopy.html
+        """
+        dest_path = WaterButlerPath('/' + dest_key.lstrip('/'))
+        try:
+            parts = dest_provider._plan_parts(size)
+        except exceptions.UploadError as e:
+            raise exceptions.IntraCopyError(e.message, code=e.code)
+        # The parts must be copied from the current version of the source, not a cached one
+        await self._invalidate_metadata(source_key)
+        source = await self._metadata_file(WaterButlerPath('/' + source_key.lstrip('/')))
+        if etag is None:
+            etag = '"{}"'.format(source.etag)
+        headers = {name: value for name, value in source.raw.items()
+                   if name.lower() in ('content-type', 'content-disposition') or
+                   (metadata is None and name.lower().startswith('x-amz-meta-'))}
+        headers.update(metadata or {})
+        session_upload_id = await dest_provider._create_upload_session(dest_path,
+                                                                       headers=headers)
+
+        pool = _TaskPool(self.MULTIPART_COPY_CONCURRENCY)
+        results = []
+        try:
+            first_byte = 0
+            for part_number, part_size in enumerate(parts, 1):
+                await pool.acquire()
+                results.append(pool.start(self._upload_part_copy(
+                    dest_provider, dest_path, session_upload_id, part_number, source_key,
+                    first_byte, first_byte + part_size - 1, etag,
+                )))
+                first_byte += part_size
+            await pool.join()
+            await dest_provider._complete_multipart_upload(
+                dest_path, session_upload_id, [result.result() for result in results])
+        except BaseException as err:
+            # Also when cancelled, so that no part is left behind the abort
+            await pool.cancel()
+            msg = 'An unexpected error has occurred during the multi-part copy.'
+            logger.error('{} upload_id={} error={!r}'.format(msg, session_upload_id, err))
+            await dest_provider._abort_chunked_upload(dest_path, session_upload_id)
+            if not isinstance(err, Exception):
+                raise
+            raise exceptions.IntraCopyError(msg)
+        finally:
+            await dest_provider._invalidate_metadata(dest_path.full_path)
+
+    async def _upload_part_copy(self, dest_provider, dest_path, session_upload_id, part_number,
+                                source_key, first_byte, last_byte, etag):
+        """Copies bytes ``first_byte`` to ``last_byte`` of ``source_key`` as the part
+        ``part_number`` of the multipart upload to ``dest_path``, if the source still has the
+        ETag ``etag``.
+
+        :rtype: dict
+        :return: the metadata of the part, as expected by `_complete_multipart_upload`
+        """
+        headers = {
+            'x-amz-copy-source': self._copy_source(source_key),
+            'x-amz-copy-source-range': 'bytes={}-{}'.format(first_byte, last_byte),
+            'x-amz-copy-source-if-match': etag,
+        }
+        params = {
+            'partNumber': str(part_number),
+            'uploadId': session_upload_id,
+        }
+        url = functools.partial(
+            dest_provider._url_for(dest_path.full_path),
+            settings.TEMP_URL_SECS,
+            'PUT',
+            query_parameters=params,
+            headers=headers,
+        )
+        resp = await self.make_request(
+            'PUT', url,
+            skip_auto_headers={'CONTENT-TYPE'},
+            headers=headers,
+            expects=(200, ),
+            throws=exceptions.IntraCopyError,
+        )
+
+        response_body = await resp.read()
+        self._check_for_200_error(response_body, "UploadPartCopy", exceptions.IntraCopyError)
+        await resp.release()
+        parsed = xmltodict.parse(response_body, strip_whitespace=False)
+        return {'ETAG': parsed['CopyPartResult']['ETag']}
 
     @staticmethod
     def _check_for_200_error(response_body,
@@ -211,8 +703,10 @@ class S3CompatProvider(provider.BaseProvider):
         raises FileNotFoundError if the status from S3 is not 200
 
         :param path: ( :class:`.WaterButlerPath` ) Path to the key you want to download
+        :param accept_url: ( :class:`bool` ) Return a presigned URL instead of a stream, if
+            ``DOWNLOAD_REDIRECT`` is enabled
         :param kwargs: (dict) Additional arguments that are ignored
-        :rtype: :class:`waterbutler.core.streams.ResponseStreamReader`
+        :rtype: :class:`waterbutler.core.streams.ResponseStreamReader` or :class:`str`
         :raises: :class:`waterbutler.core.exceptions.DownloadError`
         """
         if not path.is_file:
@@ -222,22 +716,6 @@ class S3CompatProvider(provider.BaseProvider):
         if revision is None and 'version' in kwargs:
             revision = kwargs['version']
 
-        try:
-            pre_size, pre_etag = await self._get_content_whole_size(path, revision)
-            if range is not None:
-                # MEMO: range type is (int, int)
-                # see: core/provider.py _build_range_header()
-                s, e = range
-                if s is None or e is None:
-                    pre_size = None
-                elif s < 0 or s >= pre_size or e < 0 or e >= pre_size or e < s:
-                    pre_size = None
-                else:
-                    pre_size = e - s + 1
-        except exceptions.MetadataError:
-            pre_size = None
-            pre_etag = None
-
         if not revision or revision.lower() == 'latest':
             query_parameters = None
         else:
@@ -249,14 +727,23 @@ class S3CompatProvider(provider.BaseProvider):
         }
 
         url = functools.partial(
-            self.bucket.new_key(path.full_path).generate_url,
+            self._url_for(path.full_path),
             settings.TEMP_URL_SECS,
             query_parameters=query_parameters,
             response_headers=response_headers
         )
 
+        if accept_url and settings.DOWNLOAD_REDIRECT:
+            # The client downloads straight from the storage service
+            return url('GET')
+
+        if range is None and self.PARALLEL_DOWNLOAD_CONCURRENCY > 1:
+            download_stream = await self._download_ranges(url)
+            if download_stream is not None:
+                return download_stream
+
         headers = {}
-        raw_url = self.connection.add_auth('GET', url('GET'), headers)
+        raw_url = self._authorize_url('GET', url('GET'), headers)
 
         resp = await self.make_request(
             'GET',
@@ -267,22 +754,101 @@ class S3CompatProvider(provider.BaseProvider):
             throws=exceptions.DownloadError,
         )
 
-        try:
-            get_etag = resp.headers['ETag'].replace('"', '')
-            if get_etag != pre_etag:
-                pre_size = None
-        except KeyError:
-            pre_size = None
-
         download_stream = streams.ResponseStreamReader(resp)
 
         if hasattr(download_stream, '_size') and download_stream._size is None:
             # if the GetObject API doesn't return Content-Length header,
-            # use metadata content-size or range size instead of it.
-            download_stream._size = pre_size
+            # use Content-Range or metadata content-size instead of it.
+            download_stream._size = await self._get_download_size(path, revision, range, resp)
 
         return download_stream
 
+    async def _download_ranges(self, url):
+        """Downloads an object as ranges of ``PARALLEL_DOWNLOAD_PART_SIZE`` bytes, fetched over
+        up to ``PARALLEL_DOWNLOAD_CONCURRENCY`` connections at once.  The first range also tells
+        the size of the object; the other ranges are only fetched if it is larger than one part,
+        and must match the ETag of the first one.
+
+        :param url: function returning the presigned GET URL of the object
+        :rtype: :class:`.RangeDownloadStream` or
+            :class:`waterbutler.core.streams.ResponseStreamReader`, or None if the object cannot
+            be downloaded by ranges
+        """
+        part_size = self.PARALLEL_DOWNLOAD_PART_SIZE
+        headers = {}
+        raw_url = self._authorize_url('GET', url('GET'), headers)
+        resp = await self.make_request(
+            'GET',
+            raw_url,
+            range=(0, part_size - 1),
+            headers=headers,
+            expects=(200, 206, 416),
+            throws=exceptions.DownloadError,
+        )
+        if resp.status == 416:
+            # Empty object
+            await resp.release()
+            return None
+        if resp.status == 200:
+            # The whole object is in the response
+            return streams.ResponseStreamReader(resp)
+        content_range = re.match(r'^bytes 0-\d+/(\d+)$', resp.headers.get('Content-Range', ''))
+        if content_range is None:
+            # The total size is unknown, as with "bytes 0-N/*": download it in one request
+            await resp.release()
+            return None
+
+        etag = resp.headers.get('ETag')
+        content_type = resp.headers.get('Content-Type', 'application/octet-stream')
+        first_part = await resp.read()
+
+        async def fetch(start, end):
+            headers = {'If-Match': etag} if etag else {}
+            raw_url = self._authorize_url('GET', url('GET'), headers)
+            resp = await self.make_request(
+                'GET',
+                raw_url,
+                range=(start, end),
+                headers=headers,
+                expects=(206, ),
+                throws=exceptions.DownloadError,
+            )
+            data = await resp.read()
+            if len(data) != end - start + 1:
+                raise exceptions.DownloadError('Download of bytes {}-{} ended after {} bytes.'
+                                               .format(start, end, len(data)))
+            return data
+
+        return RangeDownloadStream(fetch, int(content_range.group(1)), part_size,
+                                   self.PARALLEL_DOWNLOAD_CONCURRENCY, first_part=first_part,
+                                   content_type=content_type)
+
+    async def _get_download_size(self, path, revision, range, resp):
+        """Returns the size of the content of a GET response without Content-Length, from its
+        Content-Range header or else from the metadata of the key, or None if it is unknown.
+        """
+        content_range = re.match(r'^bytes (\d+)-(\d+)/', resp.headers.get('Content-Range', ''))
+        if content_range is not None:
+            return int(content_range.group(2)) - int(content_range.group(1)) + 1
+
+        try:
+            size, etag = await self._get_content_whole_size(path, revision)
+        except exceptions.MetadataError:
+            return None
+        if resp.headers.get('ETag', '').replace('"', '') != etag:
+            # The key has changed since the GET
+            return None
+        if range is not None:
+            # MEMO: range type is (int, int)
+            # see: core/provider.py _build_range_header()
+            s, e = range
+            if s is None or e is None:
+                return None
+            elif s < 0 or s >= size or e < 0 or e >= size or e < s:
+                return None
+            return e - s + 1
+        return size
+
     async def _get_content_whole_size(self, path: WaterButlerPath, revision=None):
         """ get content whole size from path.
         """
@@ -304,18 +870,36 @@ class S3CompatProvider(provider.BaseProvider):
         """
         path, exists = await self.handle_name_conflict(path, conflict=conflict)
 
-        if stream.size < self.CONTIGUOUS_UPLOAD_SIZE_LIMIT:
-            await self._contiguous_upload(stream, path)
-        else:
-            await self._chunked_upload(stream, path)
+        hashes = {}
+        if settings.STORE_CONTENT_HASHES:
+            hashes = {name: ThreadedHash(getattr(hashlib, name)) for name in CONTENT_HASH_HEADERS}
+
+        size = _stream_size(stream)
+        try:
+            if size is None:
+                size, etag = await self._streaming_upload(stream, path, hashes=hashes)
+            elif size < self.CONTIGUOUS_UPLOAD_SIZE_LIMIT:
+                etag = await self._contiguous_upload(stream, path, hashes=hashes)
+            else:
+                etag = await self._chunked_upload(stream, path, hashes=hashes)
+            if hashes:
+                await self._store_content_hashes(path, size, hashes, etag)
+        finally:
+            await self._invalidate_metadata(path.full_path)
 
         return (await self.metadata(path, **kwargs)), not exists
 
-    async def _contiguous_upload(self, stream, path):
-        """Uploads the given stream in one request.
+    async def _contiguous_upload(self, stream, path, hashes=None):
+        """Uploads the given stream in one request.  Its MD5 digest is computed in worker
+        threads as it is sent, see `ThreadedHash`.
+
+        :param dict hashes: `ThreadedHash` instances to update with the stream as well, by name
+        :rtype: str
+        :return: the ETag of the object
         """
 
-        stream.add_writer('md5', streams.HashStreamWriter(hashlib.md5))
+        hashes = dict(hashes or {})
+        hashes.setdefault('md5', ThreadedHash(hashlib.md5))
 
         headers = {'Content-Length': str(stream.size)}
 
@@ -325,7 +909,7 @@ class S3CompatProvider(provider.BaseProvider):
             headers['x-amz-server-side-encryption'] = 'AES256'
 
         upload_url = functools.partial(
-            self.bucket.new_key(path.full_path).generate_url,
+            self._url_for(path.full_path),
             settings.TEMP_URL_SECS,
             'PUT',
             headers=headers,
@@ -333,7 +917,7 @@ class S3CompatProvider(provider.BaseProvider):
         resp = await self.make_request(
             'PUT',
             upload_url,
-            data=stream,
+            data=HashingStream(stream, hashes),
             skip_auto_headers={'CONTENT-TYPE'},
             headers=headers,
             expects=(200, 201, ),
@@ -342,46 +926,267 @@ class S3CompatProvider(provider.BaseProvider):
         await resp.release()
 
         # md5 is returned as ETag header as long as server side encryption is not used.
-        if stream.writers['md5'].hexdigest != resp.headers['ETag'].replace('"', ''):
+        if await hashes['md5'].hexdigest() != resp.headers['ETag'].replace('"', ''):
             raise exceptions.UploadChecksumMismatchError()
+        return resp.headers['ETag']
 
-    async def _chunked_upload(self, stream, path):
+    async def _chunked_upload(self, stream, path, hashes=None):
         """Uploads the given stream to S3 over multiple chunks
+
+        If ``RESUMABLE_UPLOADS`` is enabled, the session is recorded in the upload journal and
+        kept when the upload fails, so that a retried upload of the same size to the same key
+        resumes it and only sends the parts which are missing.  While another upload holds the
+        journal entry, the upload goes through a session of its own which is not recorded.
+
+        Parts are sent with their Content-MD5, except those streamed by `_stream_parts`, and the
+        ETags of the parts and of the completed object are checked against the MD5 digests of the
+        parts, unless they are encrypted with SSE-KMS or SSE-C.
+
+        :param dict hashes: `ThreadedHash` instances to update with the stream, by name
         """
+        if hashes:
+            stream = HashingStream(stream, hashes)
+
+        journal_key = None
+        session_upload_id = None
+        uploaded_parts = {}
+        if settings.RESUMABLE_UPLOADS:
+            await self._abort_expired_upload_sessions()
+            journal_key = self._upload_journal_key(path, stream.size)
+            if not await self._call_upload_journal('claim', journal_key):
+                logger.info('The upload session of {} is in use, starting another one which is '
+                            'not resumable'.format(journal_key))
+                journal_key = None
 
-        # Step 1. Create a multi-part upload session
-        session_upload_id = await self._create_upload_session(path)
+        try:
+            if journal_key is not None:
+                session_upload_id, uploaded_parts = await self._resume_upload_session(
+                    path, journal_key)
+
+            if session_upload_id is None:
+                # Step 1. Create a multi-part upload session
+                session_upload_id = await self._create_upload_session(path)
+                if journal_key is not None:
+                    replaced_upload_id = await self._call_upload_journal(
+                        'start', journal_key, session_upload_id)
+                    if replaced_upload_id is not None:
+                        await self._abort_chunked_upload(path, replaced_upload_id)
+            else:
+                logger.info('Resuming multi-part upload: upload_id={} uploaded_parts={}'.format(
+                    session_upload_id, len(uploaded_parts)))
+        except Exception:
+            if journal_key is not None:
+                await self._call_upload_journal('release', journal_key)
+            raise
 
         try:
             # Step 2. Break stream into chunks and upload them one by one
-            parts_metadata = await self._upload_parts(stream, path, session_upload_id)
+            md5_digests = []
+            parts_metadata = await self._upload_parts(stream, path, session_upload_id,
+                                                      uploaded_parts=uploaded_parts,
+                                                      journal_key=journal_key,
+                                                      md5_digests=md5_digests)
             # Step 3. Commit the parts and end the upload session
-            await self._complete_multipart_upload(path, session_upload_id, parts_metadata)
+            etag = await self._complete_multipart_upload(path, session_upload_id,
+                                                         parts_metadata)
         except Exception as err:
             msg = 'An unexpected error has occurred during the multi-part upload.'
             logger.error('{} upload_id={} error={!r}'.format(msg, session_upload_id, err))
+            if journal_key is not None:
+                await self._call_upload_journal('release', journal_key)
+                if isinstance(err, exceptions.UploadChecksumMismatchError):
+                    raise
+                msg += '  The uploaded parts have been kept, retry the upload to resume it.'
+                raise exceptions.UploadError(msg)
             aborted = await self._abort_chunked_upload(path, session_upload_id)
             if aborted:
                 msg += '  The abort action failed to clean up the temporary file parts generated ' \
                        'during the upload process.  Please manually remove them.'
+            if isinstance(err, exceptions.UploadChecksumMismatchError):
+                raise
             raise exceptions.UploadError(msg)
 
-    async def _create_upload_session(self, path):
+        if journal_key is not None:
+            await self._call_upload_journal('remove', journal_key)
+            await self._call_upload_journal('release', journal_key)
+
+        await self._check_composite_etag(path, etag, md5_digests, parts_metadata)
+        return etag
+
+    async def _streaming_upload(self, stream, path, hashes=None):
+        """Uploads a stream whose size is not known in advance.  The first part is buffered
+        before anything is sent: a stream ending within it is uploaded in one request, a longer
+        one as a multipart upload of parts sized by `_stream_part_sizes`.  Such uploads are not
+        resumable, as the upload journal identifies sessions by the size of the upload.
+
+        :param dict hashes: `ThreadedHash` instances to update with the stream, by name
+        :rtype: (int, str)
+        :return: the size of the upload and the ETag of the object
+        """
+        stream = HashingStream(stream, hashes or {})
+        part_sizes = list(self._stream_part_sizes())
+
+        first_part = PartBuffer()
+        try:
+            if await first_part.fill(stream, part_sizes[0]) < part_sizes[0]:
+                try:
+                    etag = await self._contiguous_upload(first_part.stream(), path)
+                finally:
+                    first_part.close()
+                return first_part.size, etag
+            session_upload_id = await self._create_upload_session(path)
+        except BaseException:
+            first_part.close()
+            raise
+        try:
+            md5_digests = []
+            parts_metadata = await self._upload_parts(
+                stream, path, session_upload_id, md5_digests=md5_digests,
+                part_sizes=part_sizes, first_part=first_part)
+            etag = await self._complete_multipart_upload(path, session_upload_id,
+                                                         parts_metadata)
+        except Exception as err:
+            msg = 'An unexpected error has occurred during the multi-part upload.'
+            logger.error('{} upload_id={} error={!r}'.format(msg, session_upload_id, err))
+            aborted = await self._abort_chunked_upload(path, session_upload_id)
+            if aborted:
+                msg += '  The abort action failed to clean up the temporary file parts generated ' \
+                       'during the upload process.  Please manually remove them.'
+            if isinstance(err, exceptions.UploadChecksumMismatchError) or \
+                    isinstance(err, exceptions.UploadError) and err.code == 413:
+                raise
+            raise exceptions.UploadError(msg)
+
+        await self._check_composite_etag(path, etag, md5_digests, parts_metadata)
+        return stream.bytes_read, etag
+
+    async def _store_content_hashes(self, path, size, hashes, etag):
+        """Stores the digests of ``hashes`` as the metadata of the object uploaded to ``path``
+        with the ETag ``etag``, by copying it onto itself.  The copy is conditional on that ETag,
+        so that the digests are not stored on an object replaced since.  The upload is kept if
+        that fails, for any reason.
+        """
+        if etag is None:
+            logger.warning('Not storing the content hashes of {}, the upload has no '
+                           'ETag'.format(path.full_path))
+            return
+        try:
+            metadata = {CONTENT_HASH_HEADERS[name]: await threaded_hash.hexdigest()
+                        for name, threaded_hash in hashes.items()}
+            await self._copy_object(self, path.full_path, path.full_path, size=size,
+                                    metadata=metadata, etag=etag)
+        except Exception as err:
+            logger.warning('Could not store the content hashes of {}: {!r}'.format(
+                path.full_path, err))
+
+    async def _check_composite_etag(self, path, etag, md5_digests, parts_metadata):
+        """Checks the ETag of an object uploaded by parts against the MD5 digests of its parts,
+        and deletes the object if they do not match.  The ETag is not the MD5 of the digests of
+        the parts if they are encrypted with SSE-KMS or SSE-C, as told by the response headers
+        of their uploads, and is not checked then.
+        """
+        if not all(_etag_is_md5(part) for part in parts_metadata):
+            logger.debug('The parts are encrypted with SSE-KMS or SSE-C, the upload is not '
+                         'checked: {}'.format(path.full_path))
+            return
+        match = COMPOSITE_ETAG_RE.match((etag or '').strip('"'))
+        if match is None:
+            logger.debug('Not a composite ETag, the upload is not checked: {}'.format(etag))
+            return
+        expected = hashlib.md5(b''.join(md5_digests)).hexdigest()
+        if match.group(1) == expected and int(match.group(2)) == len(md5_digests):
+            return
+
+        logger.error('The ETag of {} does not match its parts, deleting it: etag={} '
+                     'expected="{}-{}"'.format(path.full_path, etag, expected, len(md5_digests)))
+        try:
+            await self._delete_key(path.full_path)
+        except exceptions.DeleteError as err:
+            logger.warning('Could not delete the mismatched upload {}: {!r}'.format(
+                path.full_path, err))
+        raise exceptions.UploadChecksumMismatchError()
+
+    def _upload_journal_prefix(self):
+        return '{}/{}/'.format(self.endpoint, self.settings['bucket'])
+
+    def _upload_journal_key(self, path, size):
+        return '{}{}:{}'.format(self._upload_journal_prefix(), path.full_path.lstrip('/'), size)
+
+    async def _abort_expired_upload_sessions(self):
+        """Aborts the sessions of this bucket which were left in the upload journal for longer
+        than ``RESUMABLE_UPLOAD_TTL``, so that the storage frees their parts, and forgets them.
+        """
+        prefix = self._upload_journal_prefix()
+        for journal_key, session_upload_id in await self._call_upload_journal('expired', prefix):
+            key = journal_key[len(prefix):].rpartition(':')[0]
+            logger.info('Aborting the expired upload session: key={} upload_id={}'.format(
+                key, session_upload_id))
+            if await self._abort_chunked_upload(WaterButlerPath('/' + key), session_upload_id):
+                await self._call_upload_journal('remove', journal_key)
+
+    async def _call_upload_journal(self, name, *args):
+        """Calls the method ``name`` of the upload journal, in the default executor of the loop
+        if the backend blocks.
+        """
+        journal = get_upload_journal()
+        method = functools.partial(getattr(journal, name), *args)
+        if not journal.blocking:
+            return method()
+        return await asyncio.get_event_loop().run_in_executor(None, method)
+
+    async def _resume_upload_session(self, path, journal_key):
+        """Returns the upload ID and the uploaded parts, as ``{part_number: etag}``, of the
+        session recorded in the upload journal under ``journal_key``.  Only the parts which are
+        both recorded in the journal and listed by the storage count as uploaded.  Returns
+        ``(None, {})`` if there is no session to resume.
+        """
+
+        entry = await self._call_upload_journal('get', journal_key)
+        if entry is None:
+            return None, {}
+        session_upload_id, journaled_parts = entry
+
+        listed_parts = {}
+        part_number_marker = None
+        while True:
+            resp_xml, session_deleted = await self._list_uploaded_chunks(
+                path, session_upload_id, part_number_marker=part_number_marker)
+            if session_deleted:
+                await self._call_upload_journal('remove', journal_key)
+                return None, {}
+            parsed = xmltodict.parse(resp_xml, strip_whitespace=False)['ListPartsResult']
+            parts = parsed.get('Part', [])
+            if isinstance(parts, dict):
+                parts = [parts]
+            for part in parts:
+                listed_parts[int(part['PartNumber'])] = part['ETag']
+            if parsed.get('IsTruncated') != 'true' or not parts:
+                break
+            part_number_marker = parsed.get('NextPartNumberMarker') or parts[-1]['PartNumber']
+
+        return session_upload_id, {
+            part_number: etag for part_number, etag in listed_parts.items()
+            if journaled_parts.get(part_number) == etag
+        }
+
+    async def _create_upload_session(self, path, headers=None):
         """This operation initiates a multipart upload and returns an upload ID. This upload ID is
         used to associate all of the parts in the specific multipart upload. You specify this upload
         ID in each of your subsequent upload part requests (see Upload Part). You also include this
         upload ID in the final request to either complete or abort the multipart upload request.
 
         Docs: https://docs.aws.amazon.com/AmazonS3/latest/API/mpUploadInitiate.html
+
+        :param dict headers: headers of the object, such as ``x-amz-meta-*`` metadata
         """
 
-        headers = {}
+        headers = dict(headers or {})
         # "Initiate Multipart Upload" supports AWS server-side encryption
         if self.encrypt_uploads:
-            headers = {'x-amz-server-side-encryption': 'AES256'}
+            headers['x-amz-server-side-encryption'] = 'AES256'
         params = {'uploads': ''}
         upload_url = functools.partial(
-            self.bucket.new_key(path.full_path).generate_url,
+            self._url_for(path.full_path),
             settings.TEMP_URL_SECS,
             'POST',
             query_parameters=params,
@@ -401,54 +1206,262 @@ class S3CompatProvider(provider.BaseProvider):
         # Session upload id is the only info we need
         return session_data['InitiateMultipartUploadResult']['UploadId']
 
-    async def _upload_parts(self, stream, path, session_upload_id):
-        """Uploads all parts/chunks of the given stream to S3 one by one.
+    async def _upload_parts(self, stream, path, session_upload_id, uploaded_parts=None,
+                            journal_key=None, md5_digests=None, part_sizes=None,
+                            first_part=None):
+        """Uploads all parts/chunks of the given stream to S3.
+
+        The stream can only be read sequentially, so each part is read in order into a
+        `PartBuffer`, which also lets `_upload_part` retry it.  Up to ``MULTIPART_CONCURRENCY``
+        parts are sent at once in the background, while the next part is read.  Reading a part
+        waits until its size fits within ``MULTIPART_MAX_BUFFER_SIZE`` along with the parts in
+        flight, so that the buffered parts are bounded by their actual sizes.  Parts may complete
+        out of order, but the returned metadata is ordered by part number.  When a single part can
+        be in flight, parts of a stream of known size are sent by `_stream_parts` instead.
+
+        :param dict uploaded_parts: ETags of the parts already uploaded in this session, by part
+            number.  Those parts are still read from the stream, but only sent again if their
+            content does not match.
+        :param str journal_key: key under which uploaded parts are recorded in the upload journal
+        :param list md5_digests: if given, receives the MD5 digest of each part, in order
+        :param list part_sizes: sizes of the parts of a stream of unknown size, which is read
+            until it ends, the last part being shorter.  By default the parts are planned from the
+            size of the stream.
+        :param PartBuffer first_part: the first part, already read from the stream
+        """
+
+        uploaded_parts = uploaded_parts or {}
+        until_eof = part_sizes is not None
+        if not until_eof:
+            part_sizes = self._plan_parts(stream.size)
+            logger.debug('Multipart upload segment sizes: {}'.format(part_sizes))
+            if self._multipart_slots(max(part_sizes)) == 1:
+                return await self._stream_parts(stream, path, session_upload_id, part_sizes,
+                                                uploaded_parts=uploaded_parts,
+                                                journal_key=journal_key,
+                                                md5_digests=md5_digests)
+
+        async def send(part, chunk_number):
+            try:
+                return await self._upload_part(part, path, session_upload_id, chunk_number,
+                                               journal_key=journal_key)
+            finally:
+                part.close()
+
+        pool = _TaskPool(self.MULTIPART_CONCURRENCY, max_bytes=self.MULTIPART_MAX_BUFFER_SIZE)
+        results = []
+        try:
+            if first_part is not None:
+                await pool.reserve(first_part.size)
+            for chunk_number, chunk_size in enumerate(part_sizes, 1):
+                if first_part is not None:
+                    part, first_part = first_part, None
+                    reserved = part.size
+                else:
+                    # The parts of a stream of unknown size grow, each one is bounded by its size
+                    await pool.reserve(chunk_size)
+                    reserved = chunk_size
+                    part = PartBuffer()
+                    try:
+                        filled = await part.fill(stream, chunk_size)
+                        if not until_eof and filled != chunk_size:
+                            raise exceptions.UploadError('Upload stream ended before part {} '
+                                                         'was complete.'.format(chunk_number))
+                    except BaseException:
+                        part.close()
+                        raise
+                    if filled == 0:
+                        # The stream of unknown size ended with the previous part
+                        part.close()
+                        pool.unreserve(reserved)
+                        break
+                if md5_digests is not None:
+                    md5_digests.append(part.md5_digest)
+                if chunk_number in uploaded_parts and \
+                        uploaded_parts[chunk_number].replace('"', '') == part.md5:
+                    part.close()
+                    pool.unreserve(reserved)
+                    results.append({'ETAG': uploaded_parts[chunk_number]})
+                    continue
+                try:
+                    await pool.acquire()
+                except BaseException:
+                    part.close()
+                    raise
+                logger.debug('  uploading part {} with size {}'.format(chunk_number, part.size))
+                results.append(pool.start(send(part, chunk_number), nbytes=reserved))
+                if part.size < chunk_size:
+                    break
+            else:
+                if until_eof and await stream.read(1):
+                    raise exceptions.UploadError('Upload stream is too large to be uploaded in '
+                                                 '{} parts.'.format(chunk_number), code=413)
+            await pool.join()
+        except BaseException:
+            if first_part is not None:
+                first_part.close()
+            # Let in-flight parts settle so that the abort does not race with them
+            await pool.cancel()
+            raise
+        return [result.result() if isinstance(result, asyncio.Future) else result
+                for result in results]
+
+    async def _stream_parts(self, stream, path, session_upload_id, part_sizes,
+                            uploaded_parts=None, journal_key=None, md5_digests=None):
+        """Uploads the parts of the given stream one at a time, each one sent as it is read from
+        the stream, so that reading the stream overlaps with sending it.  The parts are buffered
+        as they are sent, for `_upload_part` to retry them.  The parts already uploaded in a
+        resumed session are read before they are sent, to compare them with their ETags.
+
+        See `_upload_parts` for the parameters.
+        """
+        uploaded_parts = uploaded_parts or {}
+        results = []
+        for chunk_number, chunk_size in enumerate(part_sizes, 1):
+            part = PartBuffer()
+            try:
+                if chunk_number in uploaded_parts:
+                    if await part.fill(stream, chunk_size) != chunk_size:
+                        raise exceptions.UploadError('Upload stream ended before part {} '
+                                                     'was complete.'.format(chunk_number))
+                    if uploaded_parts[chunk_number].replace('"', '') == part.md5:
+                        results.append({'ETAG': uploaded_parts[chunk_number]})
+                    else:
+                        results.append(await self._upload_part(part, path, session_upload_id,
+                                                               chunk_number,
+                                                               journal_key=journal_key))
+                else:
+                    logger.debug('  uploading part {} with size {}'.format(chunk_number,
+                                                                           chunk_size))
+                    results.append(await self._upload_part(part, path, session_upload_id,
+                                                           chunk_number, journal_key=journal_key,
+                                                           data=part.tee(stream, chunk_size)))
+            finally:
+                part.close()
+            if md5_digests is not None:
+                md5_digests.append(part.md5_digest)
+        return results
+
+    def _stream_part_sizes(self):
+        """Returns an iterator of the sizes of the parts of a multipart upload of unknown size,
+        from the minimum and maximum part sizes used by `_plan_parts`.
+        """
+        overrides = self.settings.get('multipart_upload') or {}
+        return stream_part_sizes(
+            int(overrides.get('min_part_size', self.CHUNK_SIZE)),
+            int(overrides.get('max_part_size', self.MULTIPART_MAX_PART_SIZE)),
+        )
+
+    def _plan_parts(self, size):
+        """Returns the sizes of the parts of a multipart upload of ``size`` bytes.  The limits
+        default to ``CHUNK_SIZE``, ``MULTIPART_MAX_PART_SIZE`` and ``MULTIPART_TARGET_PART_COUNT``,
+        and can be overridden per service by the ``multipart_upload`` settings.
         """
+        overrides = self.settings.get('multipart_upload') or {}
+        try:
+            return plan_part_sizes(
+                size,
+                int(overrides.get('min_part_size', self.CHUNK_SIZE)),
+                int(overrides.get('max_part_size', self.MULTIPART_MAX_PART_SIZE)),
+                int(overrides.get('target_part_count', self.MULTIPART_TARGET_PART_COUNT)),
+            )
+        except ValueError as e:
+            raise exceptions.UploadError(str(e), code=413)
 
-        metadata = []
-        parts = [self.CHUNK_SIZE for i in range(0, stream.size // self.CHUNK_SIZE)]
-        if stream.size % self.CHUNK_SIZE:
-            parts.append(stream.size - (len(parts) * self.CHUNK_SIZE))
-        logger.debug('Multipart upload segment sizes: {}'.format(parts))
-        for chunk_number, chunk_size in enumerate(parts):
-            logger.debug('  uploading part {} with size {}'.format(chunk_number + 1, chunk_size))
-            metadata.append(await self._upload_part(stream, path, session_upload_id,
-                                                    chunk_number + 1, chunk_size))
-        return metadata
+    def _multipart_slots(self, part_size):
+        """Returns how many parts of ``part_size`` bytes may be in flight at once, bounded by both
+        ``MULTIPART_CONCURRENCY`` and the memory allowed by ``MULTIPART_MAX_BUFFER_SIZE``, which
+        also holds the part read ahead.
+        """
+        return max(1, min(self.MULTIPART_CONCURRENCY,
+                          self.MULTIPART_MAX_BUFFER_SIZE // part_size - 1))
 
-    async def _upload_part(self, stream, path, session_upload_id, chunk_number, chunk_size):
-        """Uploads a single part/chunk of the given stream to S3.
+    async def _upload_part(self, part, path, session_upload_id, chunk_number, journal_key=None,
+                           data=None):
+        """Uploads a single part/chunk to S3.  Requests failing with a transient error are retried
+        up to ``PART_UPLOAD_MAX_RETRIES`` times, waiting ``PART_UPLOAD_RETRY_BACKOFF`` seconds
+        before the first retry and twice as long before each next one.
 
+        :param PartBuffer part: the content of the part
         :param int chunk_number: sequence number of chunk. 1-indexed.
+        :param str journal_key: if given, the part is recorded in the upload journal under it
+        :param TeeStream data: if given, the stream of the part, filling ``part`` as it is sent.
+            It is sent without a Content-MD5, which is not known yet; retries send ``part``.
+        :raises: :class:`waterbutler.core.exceptions.UploadChecksumMismatchError` if the ETag of
+            the part is an MD5 which does not match its content
         """
 
-        cutoff_stream = streams.CutoffStream(stream, cutoff=chunk_size)
-
-        headers = {'Content-Length': str(chunk_size)}
         params = {
             'partNumber': str(chunk_number),
             'uploadId': session_upload_id,
         }
-        upload_url = functools.partial(
-            self.bucket.new_key(path.full_path).generate_url,
-            settings.TEMP_URL_SECS,
-            'PUT',
-            query_parameters=params,
-            headers=headers
-        )
-        resp = await self.make_request(
-            'PUT',
-            upload_url,
-            data=cutoff_stream,
-            skip_auto_headers={'CONTENT-TYPE'},
-            headers=headers,
-            # params=params,
-            expects=(200, 201,),
-            throws=exceptions.UploadError,
-        )
+        attempt = 0
+        while True:
+            if data is not None:
+                headers = {'Content-Length': str(data.size)}
+                body = data
+            else:
+                headers = {
+                    'Content-Length': str(part.size),
+                    'Content-MD5': base64.b64encode(part.md5_digest).decode('ascii'),
+                }
+                body = part.stream()
+            upload_url = functools.partial(
+                self._url_for(path.full_path),
+                settings.TEMP_URL_SECS,
+                'PUT',
+                query_parameters=params,
+                headers=headers
+            )
+            try:
+                resp = await self.make_request(
+                    'PUT',
+                    upload_url,
+                    data=body,
+                    skip_auto_headers={'CONTENT-TYPE'},
+                    headers=headers,
+                    # params=params,
+                    # The stream cannot be replayed by make_request, retries are done here
+                    retry=0,
+                    expects=(200, 201,),
+                    throws=exceptions.UploadError,
+                )
+                break
+            except (exceptions.UploadError, aiohttp.ClientError, asyncio.TimeoutError) as err:
+                transient = not isinstance(err, exceptions.UploadError) or \
+                    err.code in PART_UPLOAD_RETRY_STATUSES
+                if not transient or attempt >= settings.PART_UPLOAD_MAX_RETRIES:
+                    raise
+                if data is not None:
+                    await self._drain_part(data, chunk_number)
+                    data = None
+                delay = settings.PART_UPLOAD_RETRY_BACKOFF * (2 ** attempt)
+                attempt += 1
+                logger.warning('Retrying part {} in {} seconds (retry {}/{}): {!r}'.format(
+                    chunk_number, delay, attempt, settings.PART_UPLOAD_MAX_RETRIES, err))
+                await asyncio.sleep(delay)
+
         await resp.release()
+        if data is not None:
+            await self._drain_part(data, chunk_number)
+        etag = resp.headers['ETag'].strip('"').lower()
+        if _etag_is_md5(resp.headers) and MD5_ETAG_RE.match(etag) and etag != part.md5:
+            # Not rejected by the storage if it was sent without Content-MD5
+            logger.error('The ETag of part {} does not match its content: etag={} '
+                         'expected={}'.format(chunk_number, etag, part.md5))
+            raise exceptions.UploadChecksumMismatchError()
+        if journal_key is not None:
+            await self._call_upload_journal('add_part', journal_key, chunk_number,
+                                            resp.headers['ETag'])
         return resp.headers
 
+    @staticmethod
+    async def _drain_part(data, chunk_number):
+        await data.drain()
+        if data.part.size != data.size:
+            raise exceptions.UploadError('Upload stream ended before part {} '
+                                         'was complete.'.format(chunk_number))
+
     async def _abort_chunked_upload(self, path, session_upload_id):
         """This operation aborts a multipart upload. After a multipart upload is aborted, no
         additional parts can be uploaded using that upload ID. The storage consumed by any
@@ -471,7 +1484,7 @@ class S3CompatProvider(provider.BaseProvider):
         headers = {}
         params = {'uploadId': session_upload_id}
         abort_url = functools.partial(
-            self.bucket.new_key(path.full_path).generate_url,
+            self._url_for(path.full_path),
             settings.TEMP_URL_SECS,
             'DELETE',
             query_parameters=params,
@@ -523,21 +1536,25 @@ class S3CompatProvider(provider.BaseProvider):
                      'upload_id={}'.format(iteration_count, session_upload_id))
         return False
 
-    async def _list_uploaded_chunks(self, path, session_upload_id):
+    async def _list_uploaded_chunks(self, path, session_upload_id, part_number_marker=None):
         """This operation lists the parts that have been uploaded for a specific multipart upload.
 
         Docs: https://docs.aws.amazon.com/AmazonS3/latest/API/mpUploadListParts.html
+
+        :param part_number_marker: list only the parts after this part number
         """
 
         headers = {}
         params = {'uploadId': session_upload_id}
         list_url = functools.partial(
-            self.bucket.new_key(path.full_path).generate_url,
+            self._url_for(path.full_path),
             settings.TEMP_URL_SECS,
             'GET',
             query_parameters=params,
             headers=headers
         )
+        if part_number_marker is not None:
+            params = dict(params, **{'part-number-marker': str(part_number_marker)})
 
         resp = await self.make_request(
             'GET',
@@ -557,6 +1574,9 @@ class S3CompatProvider(provider.BaseProvider):
         """This operation completes a multipart upload by assembling previously uploaded parts.
 
         Docs: https://docs.aws.amazon.com/AmazonS3/latest/API/mpUploadComplete.html
+
+        :rtype: str
+        :return: the ETag of the object, or None if the response has none
         """
 
         payload = ''.join([
@@ -576,7 +1596,7 @@ class S3CompatProvider(provider.BaseProvider):
         }
         params = {'uploadId': session_upload_id}
         complete_url = functools.partial(
-            self.bucket.new_key(path.full_path).generate_url,
+            self._url_for(path.full_path),
             settings.TEMP_URL_SECS,
             'POST',
             query_parameters=params,
@@ -597,6 +1617,8 @@ class S3CompatProvider(provider.BaseProvider):
         self._check_for_200_error(response_body, "CompleteMultipartUpload", exceptions.UploadError)
 
         await resp.release()
+        result = xmltodict.parse(response_body, strip_whitespace=False)
+        return (result.get('CompleteMultipartUploadResult') or {}).get('ETag')
 
     async def delete(self, path, confirm_delete=0, **kwargs):
         """Deletes the key at the specified path
@@ -611,41 +1633,32 @@ class S3CompatProvider(provider.BaseProvider):
                     code=400
                 )
 
-        if path.is_file:
-            resp = await self.make_request(
-                'DELETE',
-                self.bucket.new_key(path.full_path).generate_url(settings.TEMP_URL_SECS, 'DELETE'),
-                expects=(200, 204, ),
-                throws=exceptions.DeleteError,
-            )
-            await resp.release()
-        else:
-            await self._delete_folder(path, **kwargs)
+        try:
+            if path.is_file:
+                await self._delete_key(path.full_path)
+            else:
+                await self._delete_folder(path, **kwargs)
+        finally:
+            await self._invalidate_metadata(path.full_path, recursive=not path.is_file)
+
+    async def _delete_key(self, key):
+        resp = await self.make_request(
+            'DELETE',
+            functools.partial(self._url_for(key), settings.TEMP_URL_SECS, 'DELETE'),
+            expects=(200, 204, ),
+            throws=exceptions.DeleteError,
+        )
+        await resp.release()
 
     async def _folder_prefix_exists(self, folder_prefix):
         # Even if the storage is MinIO, Contents with a leaf folder is
         # returned when a last slash of a prefix is removed.
-        query_params = {
-            'prefix': folder_prefix.rstrip('/'),  # 'A/B/' -> 'A/B'
-            'delimiter': '/'}
-        resp = await self.make_request(
-            'GET',
-            self.bucket.generate_url(settings.TEMP_URL_SECS, 'GET'),
-            params=query_params,
-            expects=(200, ),
-            throws=exceptions.MetadataError,
+        contents, prefixes, token = await self._list_objects(
+            folder_prefix.rstrip('/'),  # 'A/B/' -> 'A/B'
+            delimiter='/',
         )
-        contents = await resp.read()
-        parsed = xmltodict.parse(contents, strip_whitespace=False)['ListBucketResult']
-        common_prefixes = parsed.get('CommonPrefixes', [])
-        # common_prefixes is dict when returned prefix is one.
-        if not isinstance(common_prefixes, list):
-            common_prefixes = [common_prefixes]
-        for common_prefix in common_prefixes:
-            val = common_prefix.get('Prefix')
-            if val == folder_prefix:  # with last slash
-                return True
-        return False
+        return any(prefix.get('Prefix') == folder_prefix  # with last slash
+                   for prefix in prefixes)
 
     async def _delete_folder(self, path, **kwargs):
         """Query for recursive contents of folder and delete in batches of 1000
@@ -653,7 +1666,7 @@ class S3CompatProvider(provider.BaseProvider):
         Called from: func: delete if not path.is_file
 
         Calls: func: self.make_request
-               func: self.bucket.generate_url
+               func: self._url_for
 
         :param *ProviderPath path: Path to be deleted
 
@@ -665,52 +1678,246 @@ class S3CompatProvider(provider.BaseProvider):
         """
         if not path.full_path.endswith('/'):
             raise exceptions.InvalidParameters('not a folder: {}'.format(str(path)))
-        more_to_come = True
-        content_keys = []
         prefix = path.full_path.lstrip('/')  # '/' -> '', '/A/B/' -> 'A/B/'
-        query_params = {'prefix': prefix}
-        marker = None
-
-        while more_to_come:
-            if marker is not None:
-                query_params['marker'] = marker
-
-            resp = await self.make_request(
-                'GET',
-                self.bucket.generate_url(settings.TEMP_URL_SECS, 'GET'),
-                params=query_params,
-                expects=(200, ),
-                throws=exceptions.MetadataError,
-            )
 
-            contents = await resp.read()
-            parsed = xmltodict.parse(contents, strip_whitespace=False)['ListBucketResult']
-            more_to_come = parsed.get('IsTruncated') == 'true'
-            contents = parsed.get('Contents', [])
-
-            if isinstance(contents, dict):
-                contents = [contents]
-
-            content_keys.extend([content['Key'] for content in contents])
-            if len(content_keys) > 0:
-                marker = content_keys[-1]
+        # Each page of keys is handed to the deleters as soon as it is listed, and the next page
+        # is listed while they run.  Listing waits while all deleters are busy, so only a few
+        # pages are held in memory whatever the size of the folder.
+        # Folder keys are deleted after their contents, deepest first, as some storages refuse
+        # to delete a folder which is not empty.  Only those are kept until the end.
+        folder_keys = {}
+        found = False
+        pool = _TaskPool(settings.DELETE_CONCURRENCY)
+        try:
+            async for content_keys in self._iter_folder_keys(prefix):
+                found = found or len(content_keys) > 0
+                object_keys = []
+                for content_key in content_keys:
+                    if content_key.endswith('/'):
+                        folder_keys.setdefault(content_key.count('/'), []).append(content_key)
+                    else:
+                        object_keys.append(content_key)
+                for batch in _chunked(object_keys, settings.BULK_DELETE_MAX_KEYS):
+                    await pool.acquire()
+                    pool.start(self._delete_batch(batch))
+            await pool.join()
+        except BaseException:
+            await pool.cancel()
+            raise
 
         # Query against non-existant folder does not return 404
-        if len(content_keys) == 0:
+        if not found:
             # MinIO cannot return Contents with a leaf folder itself.
             if await self._folder_prefix_exists(prefix):
-                content_keys = [prefix]
+                folder_keys = {prefix.count('/'): [prefix]}
             else:
                 raise exceptions.NotFoundError(str(path))
 
-        for content_key in content_keys[::-1]:
-            resp = await self.make_request(
-                'DELETE',
-                self.bucket.new_key(content_key).generate_url(settings.TEMP_URL_SECS, 'DELETE'),
-                expects=(200, 204, ),
-                throws=exceptions.DeleteError,
-            )
-            await resp.release()
+        for depth in sorted(folder_keys, reverse=True):
+            for batch in _chunked(folder_keys[depth], settings.BULK_DELETE_MAX_KEYS):
+                await self._delete_batch(batch)
+
+    async def _iter_folder_keys(self, prefix):
+        """Lists the keys under ``prefix`` recursively, yielding them one page at a time.
+        """
+        async for contents in self._iter_objects(prefix):
+            yield [content['Key'] for content in contents]
+
+    async def _iter_objects(self, prefix):
+        """Lists the keys under ``prefix`` recursively, yielding their ``Contents`` records one
+        page at a time, in key order.  With ``LISTING_SHARD_CONCURRENCY`` above 1, ranges of the
+        keys are listed concurrently, see :class:`.listing.ShardedListing`.
+        """
+        if self.LISTING_SHARD_CONCURRENCY > 1:
+            async def list_page(start_after, token):
+                contents, prefixes, token = await self._list_objects(
+                    prefix, token=token, start_after=start_after,
+                )
+                return contents, token
+
+            listing = ShardedListing(list_page, prefix, self.LISTING_SHARD_CONCURRENCY)
+            async for contents in listing.pages():
+                yield contents
+            return
+
+        token = None
+        while True:
+            contents, prefixes, token = await self._list_objects(prefix, token=token)
+            yield contents
+            if token is None:
+                break
+
+    async def _list_objects(self, prefix, delimiter=None, token=None, start_after=None,
+                            max_keys=None):
+        """Lists a page of the keys starting with ``prefix``, with ListObjectsV2 if the endpoint
+        supports it and ListObjects otherwise.  Support is detected with the first listing of
+        the endpoint, and remembered.
+
+        :param str token: the token of the page, returned with the previous one
+        :param str start_after: the key to list from, exclusive, when there is no ``token``
+        :rtype: tuple
+        :return: the ``Contents`` and ``CommonPrefixes`` records of the page, and the token of
+            the next page, or None for the last page
+        """
+        if self._get_capability('list_objects_v2') is not False:
+            try:
+                page = await self._list_objects_page(prefix, delimiter, token, start_after,
+                                                     max_keys, v2=True)
+            except exceptions.MetadataError as err:
+                if self._get_capability('list_objects_v2') or \
+                        err.code not in LIST_OBJECTS_V2_UNSUPPORTED_STATUSES:
+                    raise
+                logger.info('ListObjectsV2 is not supported by {}, falling back to '
+                            'ListObjects: {!r}'.format(self.endpoint, err))
+                page = None
+            if page is not None:
+                self._set_capability('list_objects_v2', True)
+                return page
+            self._set_capability('list_objects_v2', False)
+        return await self._list_objects_page(prefix, delimiter, token, start_after, max_keys,
+                                             v2=False)
+
+    async def _list_objects_page(self, prefix, delimiter, token, start_after, max_keys, v2):
+        """Sends one ListObjects request, or ListObjectsV2 request if ``v2``.  Returns None if
+        the endpoint answered a ListObjectsV2 request with a ListObjects result, as endpoints
+        which ignore ``list-type`` do.
+
+        Docs: https://docs.aws.amazon.com/AmazonS3/latest/API/API_ListObjectsV2.html
+        """
+        params = {'prefix': prefix}
+        if delimiter is not None:
+            params['delimiter'] = delimiter
+        if max_keys is not None:
+            params['max-keys'] = str(max_keys)
+        if v2:
+            params['list-type'] = '2'
+            params['fetch-owner'] = 'false'
+            if token:
+                params['continuation-token'] = token
+            elif start_after:
+                params['start-after'] = start_after
+        elif token or start_after:
+            params['marker'] = token or start_after
+
+        resp = await self.make_request(
+            'GET',
+            functools.partial(self._url_for(), settings.TEMP_URL_SECS, 'GET'),
+            params=params,
+            expects=(200, ),
+            throws=exceptions.MetadataError,
+        )
+
+        parser = ListingParser()
+        contents = []
+        prefixes = []
+        async for element, record in parser.parse(resp):
+            if element == 'Contents':
+                contents.append(record)
+            elif element == 'CommonPrefixes':
+                prefixes.append(record)
+
+        if v2 and 'KeyCount' not in parser.fields and \
+                'NextContinuationToken' not in parser.fields and \
+                not self._get_capability('list_objects_v2'):
+            return None
+
+        next_token = None
+        if parser.fields.get('IsTruncated') == 'true':
+            if v2:
+                next_token = parser.fields.get('NextContinuationToken')
+            else:
+                # NextMarker is only returned with a delimiter, and not by all endpoints.  A
+                # truncated page without any item cannot be continued, the listing ends there.
+                next_token = parser.fields.get('NextMarker') or max(
+                    [content['Key'] for content in contents[-1:]] +
+                    [common_prefix['Prefix'] for common_prefix in prefixes[-1:]],
+                    default=None
+                )
+                if next_token is None:
+                    logger.warning('Truncated listing of {} without a marker to continue '
+                                   'it'.format(prefix))
+        return contents, prefixes, next_token
+
+    async def _delete_batch(self, keys):
+        """Deletes a batch of keys with one Multi-Object Delete request.  If the endpoint turns
+        out not to support it, the keys are deleted with concurrent single DELETE requests and
+        the endpoint is remembered as not supporting it.
+
+        :raises: :class:`waterbutler.core.exceptions.DeleteError` if any key cannot be deleted
+        """
+        if self._get_capability('bulk_delete') is not False:
+            try:
+                errors = await self._bulk_delete(keys)
+            except exceptions.DeleteError as err:
+                if self._get_capability('bulk_delete') or \
+                        err.code not in BULK_DELETE_UNSUPPORTED_STATUSES:
+                    raise
+                logger.info('Multi-Object Delete is not supported by {}, falling back to '
+                            'single deletes: {!r}'.format(self.endpoint, err))
+                self._set_capability('bulk_delete', False)
+            else:
+                self._set_capability('bulk_delete', True)
+                if errors:
+                    for error in errors:
+                        logger.warning('DeleteObjects failed to delete "{}": {} {}'.format(
+                            error.get('Key'), error.get('Code'), error.get('Message')))
+                    raise exceptions.DeleteError(
+                        'Failed to delete {} object(s), including "{}".'.format(
+                            len(errors), errors[0].get('Key')),
+                        code=500,
+                    )
+                return
+
+        await _bounded_gather([self._delete_key(key) for key in keys],
+                              settings.DELETE_CONCURRENCY)
+
+    async def _bulk_delete(self, keys):
+        """Deletes up to 1000 keys with one request and returns the per-key errors reported in
+        the response.  Quiet mode is used, so that only the failed keys are listed.
+
+        Docs: https://docs.aws.amazon.com/AmazonS3/latest/API/API_DeleteObjects.html
+        """
+
+        payload = ''.join([
+            '<?xml version="1.0" encoding="UTF-8"?><Delete><Quiet>true</Quiet>',
+            ''.join(
+                ['<Object><Key>{}</Key></Object>'.format(xml.sax.saxutils.escape(key))
+                 for key in keys]
+            ),
+            '</Delete>',
+        ]).encode('utf-8')
+        headers = {
+            'Content-Length': str(len(payload)),
+            'Content-MD5': compute_md5(BytesIO(payload))[1],
+            'Content-Type': 'text/xml',
+        }
+        params = {'delete': ''}
+        delete_url = functools.partial(
+            self._url_for(),
+            settings.TEMP_URL_SECS,
+            'POST',
+            query_parameters=params,
+            headers=headers,
+        )
+        resp = await self.make_request(
+            'POST',
+            delete_url,
+            data=payload,
+            headers=headers,
+            # params=params,
+            expects=(200, ),
+            throws=exceptions.DeleteError,
+        )
+
+        response_body = await resp.read()
+        self._check_for_200_error(response_body, "DeleteObjects", exceptions.DeleteError)
+        await resp.release()
+
+        result = xmltodict.parse(response_body, strip_whitespace=False)['DeleteResult'] or {}
+        errors = result.get('Error', [])
+        if isinstance(errors, dict):
+            errors = [errors]
+        return errors
 
     async def revisions(self, path, **kwargs):
         """Get past versions of the requested key
@@ -722,7 +1929,7 @@ class S3CompatProvider(provider.BaseProvider):
         # "versions" in "query_parameters" is required for generate_url().
         # SignatureDoesNotMatch is returned when "versions" is not specified.
         query_params = {'prefix': prefix, 'delimiter': '/', 'versions': ''}
-        url = functools.partial(self.bucket.generate_url, settings.TEMP_URL_SECS, 'GET', query_parameters=query_params)
+        url = functools.partial(self._url_for(), settings.TEMP_URL_SECS, 'GET', query_parameters=query_params)
         try:
             resp = await self.make_request(
                 'GET',
@@ -737,17 +1944,10 @@ class S3CompatProvider(provider.BaseProvider):
             logger.info('ListObjectVersions may not be supported: url={}: {}'.format(url(), str(e)))
             return []
 
-        content = await resp.read()
-        xml = xmltodict.parse(content)
-        versions = xml['ListVersionsResult'].get('Version') or []
-
-        if isinstance(versions, dict):
-            versions = [versions]
-
         return [
-            S3CompatRevision(item)
-            for item in versions
-            if item['Key'] == prefix
+            S3CompatRevision(record)
+            async for element, record in ListingParser().parse(resp)
+            if element == 'Version' and record['Key'] == prefix
         ]
 
     async def metadata(self, path, revision=None, **kwargs):
@@ -782,68 +1982,42 @@ class S3CompatProvider(provider.BaseProvider):
 
         async with self.request(
             'PUT',
-            functools.partial(self.bucket.new_key(path.full_path).generate_url, settings.TEMP_URL_SECS, 'PUT'),
+            functools.partial(self._url_for(path.full_path), settings.TEMP_URL_SECS, 'PUT'),
             skip_auto_headers={'CONTENT-TYPE'},
             expects=(200, 201, ),
             throws=exceptions.CreateFolderError
         ):
+            await self._invalidate_metadata(path.full_path)
             return S3CompatFolderMetadata(self, {'Prefix': path.full_path})
 
     async def _metadata_file(self, path, revision=None):
         if revision == 'Latest':
             revision = None
-        resp = await self.make_request(
-            'HEAD',
-            functools.partial(
-                self.bucket.new_key(path.full_path).generate_url,
-                settings.TEMP_URL_SECS,
-                'HEAD',
-                query_parameters={'versionId': revision} if revision else None
-            ),
-            expects=(200, ),
-            throws=exceptions.MetadataError,
-        )
-        await resp.release()
-        return S3CompatFileMetadataHeaders(self, path.full_path, resp.headers)
-
-    async def _metadata_folder(self, path, next_token=None):
-        prefix = path.full_path.lstrip('/')  # '/' -> '', '/A/B' -> 'A/B'
-        params = {'prefix': prefix, 'delimiter': '/', 'max-keys': '1000'}
-        if next_token is not None:
-            params['marker'] = next_token
-        resp = await self.make_request(
-            'GET',
-            functools.partial(self.bucket.generate_url, settings.TEMP_URL_SECS, 'GET'),
-            params=params,
-            expects=(200, ),
-            throws=exceptions.MetadataError,
-        )
-
-        contents = await resp.read()
-
-        parsed = xmltodict.parse(contents, strip_whitespace=False)['ListBucketResult']
 
-        next_token_string = parsed.get('NextMarker', '')
-        contents = parsed.get('Contents', [])
-        prefixes = parsed.get('CommonPrefixes', [])
-
-        if not contents and not prefixes and not path.is_root:
-            # If contents and prefixes are empty then this "folder"
-            # must exist as a key with a / at the end of the name
-            # if the path is root there is no need to test if it exists
+        async def fetch():
             resp = await self.make_request(
                 'HEAD',
-                functools.partial(self.bucket.new_key(prefix).generate_url, settings.TEMP_URL_SECS, 'HEAD'),
+                functools.partial(
+                    self._url_for(path.full_path),
+                    settings.TEMP_URL_SECS,
+                    'HEAD',
+                    query_parameters={'versionId': revision} if revision else None
+                ),
                 expects=(200, ),
                 throws=exceptions.MetadataError,
             )
             await resp.release()
+            return dict(resp.headers)
 
-        if isinstance(contents, dict):
-            contents = [contents]
+        headers = await self._cached_metadata(self._cache_key(path.full_path, revision), fetch)
+        return S3CompatFileMetadataHeaders(self, path.full_path, headers)
 
-        if isinstance(prefixes, dict):
-            prefixes = [prefixes]
+    async def _metadata_folder(self, path, next_token=None):
+        prefix = path.full_path.lstrip('/')  # '/' -> '', '/A/B' -> 'A/B'
+        contents, prefixes, next_token_string = await self._cached_metadata(
+            self._cache_key(prefix, listing_variant(next_token)),
+            functools.partial(self._list_folder_page, path, prefix, next_token),
+        )
 
         items = [
             S3CompatFolderMetadata(self, item)
@@ -862,3 +2036,89 @@ class S3CompatProvider(provider.BaseProvider):
         if next_token_string:
             items.append(next_token_string)
         return items
+
+    async def _list_folder_page(self, path, prefix, next_token=None):
+        """Lists one page of the folder at ``path``.
+
+        :rtype: tuple
+        :return: the ``Contents`` and ``CommonPrefixes`` of the page, and the token of the next
+            page or ''
+        """
+        contents, prefixes, token = await self._list_objects(
+            prefix, delimiter='/', token=next_token, max_keys=1000,
+        )
+        next_token_string = token or ''
+
+        if not contents and not prefixes and not path.is_root:
+            # If contents and prefixes are empty then this "folder"
+            # must exist as a key with a / at the end of the name
+            # if the path is root there is no need to test if it exists
+            resp = await self.make_request(
+                'HEAD',
+                functools.partial(self._url_for(prefix), settings.TEMP_URL_SECS, 'HEAD'),
+                expects=(200, ),
+                throws=exceptions.MetadataError,
+            )
+            await resp.release()
+
+        return contents, prefixes, next_token_string
+
+    async def walk(self, path):
+        """Enumerates everything under the folder ``path``, at any depth, with flat listings of
+        the keys under it rather than one listing per folder.  Items are yielded in the order of
+        their keys, each folder before its contents.  Folders which only exist as the prefix of
+        other keys are yielded as :class:`S3CompatFolderMetadata`.
+
+        :param WaterButlerPath path: the folder to enumerate, which is not yielded itself
+        """
+        prefix = path.full_path.lstrip('/')  # '/' -> '', '/A/B/' -> 'A/B/'
+        # The folders containing the last key.  Keys are listed in order, so the contents of a
+        # folder are listed together and the folder is not met again once they are passed.
+        current_folders = set()
+        async for contents in self._iter_objects(prefix):
+            for content in contents:
+                key = content['Key']
+                if key == prefix:  # self
+                    continue
+                folders = set()
+                end = key.find('/', len(prefix))
+                while end != -1 and end + 1 < len(key):
+                    folder = key[:end + 1]
+                    folders.add(folder)
+                    if folder not in current_folders:
+                        yield S3CompatFolderMetadata(self, {'Prefix': folder})
+                    end = key.find('/', end + 1)
+                if key.endswith('/'):
+                    folders.add(key)
+                    if key not in current_folders:
+                        yield S3CompatFolderKeyMetadata(self, content)
+                else:
+                    yield S3CompatFileMetadata(self, content)
+                current_folders = folders
+
+    async def zip(self, path, **kwargs):
+        """Streams a zip archive of ``path``.  The contents of folders are enumerated with
+        :meth:`walk`.
+        """
+        if path.is_file:
+            return await super().zip(path, **kwargs)
+        return streams.ZipStreamReader(self._zip_entries(path))
+
+    async def _zip_entries(self, path):
+        """Yields the names in the archive of the contents of the folder ``path`` and their
+        streams.  Files are downloaded as the archive reaches them, and empty folders are added
+        as entries of their own.
+        """
+        base = '/' + path.path
+        empty_folder = None
+        async for item in self.walk(path):
+            if empty_folder is not None and not item.path.startswith(empty_folder.path):
+                yield empty_folder.path[len(base):], streams.EmptyStream()
+            empty_folder = None
+            if item.kind == 'folder':
+                empty_folder = item
+                continue
+            yield item.path[len(base):], await self.download(
+                WaterButlerPath(item.path, prepend=self.prefix))
+        if empty_folder is not None:
+            yield empty_folder.path[len(base):], streams.EmptyStream()
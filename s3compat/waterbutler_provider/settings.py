@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 from waterbutler import settings
 
 config = settings.child('S3COMPAT_PROVIDER_CONFIG')
@@ -10,3 +13,132 @@ CONTIGUOUS_UPLOAD_SIZE_LIMIT = int(config.get('CONTIGUOUS_UPLOAD_SIZE_LIMIT', 12
 CHUNK_SIZE = int(config.get('CHUNK_SIZE', 64000000))  # 64 MB
 
 CHUNKED_UPLOAD_MAX_ABORT_RETRIES = int(config.get('CHUNKED_UPLOAD_MAX_ABORT_RETRIES', 2))
+
+# Signature version of the requests: '2' (signed by boto) or '4'.  Overridden per service by
+# `signatureVersion` in settings.json.
+SIGNATURE_VERSION = str(config.get('SIGNATURE_VERSION', '2'))
+
+# Region in the SigV4 credential scope when the bucket location is not known.
+SIGNATURE_REGION = config.get('SIGNATURE_REGION', 'us-east-1')
+
+# Number of connections used to download an object as byte ranges.  1 downloads it with a single
+# GET.  At most this many ranges of PARALLEL_DOWNLOAD_PART_SIZE are buffered per download.
+PARALLEL_DOWNLOAD_CONCURRENCY = int(config.get('PARALLEL_DOWNLOAD_CONCURRENCY', 1))
+
+PARALLEL_DOWNLOAD_PART_SIZE = int(config.get('PARALLEL_DOWNLOAD_PART_SIZE', 16000000))  # 16 MB
+
+# Share connections to a storage service between the requests of a process.
+CONNECTION_POOL = config.get_bool('CONNECTION_POOL', True)
+
+# Maximum number of connections opened at once to one storage service.
+CONNECTION_POOL_LIMIT_PER_HOST = int(config.get('CONNECTION_POOL_LIMIT_PER_HOST', 100))
+
+# Seconds after which an idle connection is closed.
+CONNECTION_POOL_KEEPALIVE_TIMEOUT = float(config.get('CONNECTION_POOL_KEEPALIVE_TIMEOUT', 30))
+
+# Seconds during which the addresses of a storage service are reused.
+CONNECTION_POOL_DNS_CACHE_TTL = int(config.get('CONNECTION_POOL_DNS_CACHE_TTL', 300))
+
+# Seconds during which the results of HEAD and listing requests are reused.  0 disables the cache.
+METADATA_CACHE_TTL = float(config.get('METADATA_CACHE_TTL', 5))
+
+# Number of results kept in the metadata cache of each process.
+METADATA_CACHE_MAX_ENTRIES = int(config.get('METADATA_CACHE_MAX_ENTRIES', 10000))
+
+# Seconds during which keys and folders found missing by path validation are reported missing
+# without a request, unless they are written through WaterButler.  0 disables it.
+NEGATIVE_CACHE_TTL = float(config.get('NEGATIVE_CACHE_TTL', 5))
+
+# Backend of the negative cache: 'memory' for each process, 'sqlite' to share it between the
+# worker processes of a host, or the dotted path of a BaseNegativeCache subclass.
+NEGATIVE_CACHE = config.get('NEGATIVE_CACHE', 'memory')
+
+NEGATIVE_CACHE_PATH = config.get('NEGATIVE_CACHE_PATH',
+                                 os.path.join(tempfile.gettempdir(), 's3compat-negative-cache'))
+
+# Share one HEAD or listing request between concurrent requests for the same metadata.
+METADATA_SINGLE_FLIGHT = config.get_bool('METADATA_SINGLE_FLIGHT', True)
+
+# Redirect clients that accept it to a presigned URL of the storage service for downloads,
+# instead of streaming the content through WaterButler.  The service must be reachable by clients.
+DOWNLOAD_REDIRECT = config.get_bool('DOWNLOAD_REDIRECT', False)
+
+# Number of multipart upload parts sent at once.  1 streams parts one by one, as they are read:
+# such parts are sent without Content-MD5, which is not known until they are sent, so the storage
+# does not check them.  Their ETags are checked against their MD5 digests instead, unless they are
+# encrypted with SSE-KMS or SSE-C.  Concurrent parts are buffered first and sent with Content-MD5.
+MULTIPART_CONCURRENCY = int(config.get('MULTIPART_CONCURRENCY', 1))
+
+# Upper bound on the memory held by parts buffered for concurrent upload.
+MULTIPART_MAX_BUFFER_SIZE = int(config.get('MULTIPART_MAX_BUFFER_SIZE', 256000000))  # 256 MB
+
+# Largest multipart part, and the number of parts aimed at when sizing them.  Parts are never
+# smaller than CHUNK_SIZE, and grow so that an upload never needs more than 10,000 parts.  Both,
+# and the minimum, can be overridden per service with `multipartUpload` in settings.json.
+MULTIPART_MAX_PART_SIZE = int(config.get('MULTIPART_MAX_PART_SIZE', 5 * 1024 ** 3))  # 5 GiB
+
+MULTIPART_TARGET_PART_COUNT = int(config.get('MULTIPART_TARGET_PART_COUNT', 1000))
+
+# Maximum number of keys in one Multi-Object Delete request (the S3 limit is 1000).
+BULK_DELETE_MAX_KEYS = int(config.get('BULK_DELETE_MAX_KEYS', 1000))
+
+# Number of delete requests sent at once when deleting a folder.
+DELETE_CONCURRENCY = int(config.get('DELETE_CONCURRENCY', 4))
+
+# Number of listing requests sent at once to list the keys under a folder at any depth, as for
+# folder deletes and zip downloads.  Above 1, ranges of keys are listed concurrently.
+LISTING_SHARD_CONCURRENCY = int(config.get('LISTING_SHARD_CONCURRENCY', 1))
+
+# Number of CopyObject requests sent at once when copying or moving a folder within the storage.
+INTRA_COPY_CONCURRENCY = int(config.get('INTRA_COPY_CONCURRENCY', 8))
+
+# Objects from this size on are copied within the storage as multipart uploads of byte ranges
+# (UploadPartCopy), as CopyObject is limited to 5 GiB.  Parts are sized as for uploads.
+MULTIPART_COPY_THRESHOLD = int(config.get('MULTIPART_COPY_THRESHOLD', 1024 ** 3))  # 1 GiB
+
+# Number of UploadPartCopy requests sent at once for the copy of one object.
+MULTIPART_COPY_CONCURRENCY = int(config.get('MULTIPART_COPY_CONCURRENCY', 8))
+
+# Store the MD5 and SHA-256 digests of uploaded files as object metadata (x-amz-meta-md5 and
+# x-amz-meta-sha256), so that their fixity can be checked with a HEAD request.  They are computed
+# as the upload is sent and applied by copying the object onto itself, which doubles the writes
+# of every upload, so this is off by default.  On a versioned bucket, the copy is a version of its
+# own: each upload shows as two revisions, of which only the later one has the digests.
+STORE_CONTENT_HASHES = config.get_bool('STORE_CONTENT_HASHES', False)
+
+# Keep the session of a failed multipart upload, so that retrying the upload resumes it.
+RESUMABLE_UPLOADS = config.get_bool('RESUMABLE_UPLOADS', False)
+
+RESUMABLE_UPLOAD_TTL = int(config.get('RESUMABLE_UPLOAD_TTL', 86400))  # 1 day
+
+# Journal of resumable upload sessions: 'sqlite', 'file' or the dotted path of a
+# BaseUploadJournal subclass.
+UPLOAD_JOURNAL = config.get('UPLOAD_JOURNAL', 'sqlite')
+
+UPLOAD_JOURNAL_PATH = config.get('UPLOAD_JOURNAL_PATH',
+                                 os.path.join(tempfile.gettempdir(), 's3compat-upload-journal'))
+
+# Seconds an upload holds its journal entry without sending a part, after which another upload
+# of the same key and size may take the session over.
+UPLOAD_JOURNAL_LEASE = int(config.get('UPLOAD_JOURNAL_LEASE', 600))  # 10 minutes
+
+# Number of times the upload of a multipart part is retried after a transient error.
+PART_UPLOAD_MAX_RETRIES = int(config.get('PART_UPLOAD_MAX_RETRIES', 3))
+
+# Seconds before the first retry of a part upload, doubled for each next retry.
+PART_UPLOAD_RETRY_BACKOFF = float(config.get('PART_UPLOAD_RETRY_BACKOFF', 1))
+
+# Number of threads hashing upload streams, off the event loop.  0 hashes them on the event loop.
+HASH_WORKERS = int(config.get('HASH_WORKERS', 4))
+
+# Chunks smaller than this are hashed on the event loop when no chunk is waiting for a thread.
+HASH_THREAD_MIN_SIZE = int(config.get('HASH_THREAD_MIN_SIZE', 64 * 1024))  # 64 KiB
+
+# Bytes of an upload waiting to be hashed, beyond which reading the upload waits for the hash.
+HASH_QUEUE_MAX_SIZE = int(config.get('HASH_QUEUE_MAX_SIZE', 16 * 1024 * 1024))  # 16 MiB
+
+# Parts up to this size are buffered in memory for retries, larger ones in a temporary file.
+PART_SPOOL_MEMORY_LIMIT = int(config.get('PART_SPOOL_MEMORY_LIMIT', 16000000))  # 16 MB
+
+# Directory of the temporary files of spooled parts.  None uses the system default.
+PART_SPOOL_DIR = config.get('PART_SPOOL_DIR', None)
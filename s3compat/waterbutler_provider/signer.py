@@ -0,0 +1,98 @@
+"""AWS Signature Version 4 signing of presigned URLs
+
+Requests are signed with SigV2 by boto unless the service is configured for SigV4, which is
+signed here without building boto objects.  The keys derived from the secret key only change
+daily, so they are cached per (date, region, service).
+
+See https://docs.aws.amazon.com/AmazonS3/latest/API/sigv4-query-string-auth.html
+"""
+import hmac
+import time
+import hashlib
+import functools
+from urllib import parse
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+
+@functools.lru_cache(maxsize=256)
+def signing_key(secret_key, date, region, service):
+    """Returns the key derived from ``secret_key`` to sign requests of ``date`` (YYYYMMDD).
+    """
+    key = _hmac(('AWS4' + secret_key).encode('utf-8'), date)
+    for scope in (region, service, 'aws4_request'):
+        key = _hmac(key, scope)
+    return key
+
+
+def quote(value):
+    """URI-encodes ``value`` as required for canonical query strings.
+    """
+    return parse.quote(str(value), safe='-_.~')
+
+
+class SigV4Signer:
+
+    def __init__(self, access_key, secret_key, region, service='s3'):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.service = service
+
+    def presign_url(self, method, scheme, host, path, expires_in, query=None, headers=None,
+                    timestamp=None):
+        """Returns the URL of a request which is authorized by its query string.
+
+        :param str host: the Host header of the request, with the port if it is not the default
+        :param str path: the URI-encoded path of the request
+        :param dict query: the parameters of the request, which are all signed
+        :param dict headers: headers that the request must be sent with
+        :param float timestamp: the time of signing, defaults to now
+        """
+        request_time = time.gmtime(time.time() if timestamp is None else timestamp)
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', request_time)
+        date = amz_date[:8]
+        credential_scope = '{}/{}/{}/aws4_request'.format(date, self.region, self.service)
+
+        canonical_headers = {name.lower().strip(): ' '.join(str(value).split())
+                             for name, value in (headers or {}).items()}
+        canonical_headers['host'] = host
+        signed_headers = ';'.join(sorted(canonical_headers))
+
+        query = {name: '' if value is None else value for name, value in (query or {}).items()}
+        query.update({
+            'X-Amz-Algorithm': ALGORITHM,
+            'X-Amz-Credential': '{}/{}'.format(self.access_key, credential_scope),
+            'X-Amz-Date': amz_date,
+            'X-Amz-Expires': str(int(expires_in)),
+            'X-Amz-SignedHeaders': signed_headers,
+        })
+        canonical_query = '&'.join('{}={}'.format(quote(name), quote(value))
+                                   for name, value in sorted(query.items()))
+
+        canonical_request = '\n'.join([
+            method,
+            path,
+            canonical_query,
+            ''.join('{}:{}\n'.format(name, canonical_headers[name])
+                    for name in sorted(canonical_headers)),
+            signed_headers,
+            UNSIGNED_PAYLOAD,
+        ])
+        string_to_sign = '\n'.join([
+            ALGORITHM,
+            amz_date,
+            credential_scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+        ])
+        signature = hmac.new(signing_key(self.secret_key, date, self.region, self.service),
+                             string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+        return '{}://{}{}?{}&X-Amz-Signature={}'.format(scheme, host, path, canonical_query,
+                                                        signature)
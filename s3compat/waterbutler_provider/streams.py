@@ -0,0 +1,337 @@
+"""Streams and buffers used by the S3 Compatible Storage provider
+"""
+import asyncio
+import hashlib
+import tempfile
+import collections
+import concurrent.futures
+
+from waterbutler.core import streams
+
+from . import settings
+
+# Size of the reads from an incoming stream into a buffer
+READ_SIZE = 1024 * 1024  # 1 MiB
+
+
+_hash_executor = None
+
+
+def get_hash_executor():
+    """Returns the pool of ``HASH_WORKERS`` threads shared by the hashes of the process.
+    """
+    global _hash_executor
+    if _hash_executor is None:
+        _hash_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=settings.HASH_WORKERS, thread_name_prefix='s3compat-hash')
+    return _hash_executor
+
+
+class ThreadedHash:
+    """Hash of a stream computed in the threads of `get_hash_executor`, where ``hashlib``
+    releases the GIL, instead of blocking the event loop for every chunk.
+
+    Chunks are queued in order and hashed by one job at a time.  `update` only waits when more
+    than ``HASH_QUEUE_MAX_SIZE`` bytes are queued, and `digest` waits for the queued chunks.
+
+    :param factory: the constructor of the hash, such as ``hashlib.md5``
+    """
+
+    def __init__(self, factory=hashlib.md5):
+        self._hash = factory()
+        self._chunks = collections.deque()
+        self._queued = 0
+        self._job = None
+        self._progress = asyncio.Event()
+
+    async def update(self, data):
+        if not data:
+            return
+        if settings.HASH_WORKERS <= 0 or \
+                (self._job is None and len(data) < settings.HASH_THREAD_MIN_SIZE):
+            self._hash.update(data)
+            return
+        self._chunks.append(data)
+        self._queued += len(data)
+        if self._job is None:
+            self._job = asyncio.ensure_future(self._drain())
+        while self._queued > settings.HASH_QUEUE_MAX_SIZE and self._job is not None:
+            self._progress.clear()
+            await self._progress.wait()
+
+    async def _drain(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while self._chunks:
+                chunks = list(self._chunks)
+                self._chunks.clear()
+                await loop.run_in_executor(get_hash_executor(), self._update_all, chunks)
+                self._queued -= sum(len(chunk) for chunk in chunks)
+                self._progress.set()
+        finally:
+            self._job = None
+            self._progress.set()
+
+    def _update_all(self, chunks):
+        for chunk in chunks:
+            self._hash.update(chunk)
+
+    async def digest(self):
+        while self._job is not None:
+            await asyncio.shield(self._job)
+        return self._hash.digest()
+
+    async def hexdigest(self):
+        return (await self.digest()).hex()
+
+
+class HashingStream(streams.BaseStream):
+    """Reads ``stream`` through, updating the `ThreadedHash` instances of ``hashes``, a dict
+    mapping names to them, with everything read.  ``bytes_read`` counts the bytes read.
+    """
+
+    def __init__(self, stream, hashes):
+        super().__init__()
+        self.stream = stream
+        self.hashes = hashes
+        self.bytes_read = 0
+
+    @property
+    def size(self):
+        return self.stream.size
+
+    async def _read(self, size=-1):
+        data = await self.stream.read(size)
+        if not data:
+            self.feed_eof()
+            return data
+        self.bytes_read += len(data)
+        for threaded_hash in self.hashes.values():
+            await threaded_hash.update(data)
+        return data
+
+
+class PartBuffer:
+    """Holds the content of one part of a multipart upload, so that the part can be sent again if
+    its request fails.  Parts up to ``PART_SPOOL_MEMORY_LIMIT`` bytes are kept in memory, larger
+    ones are spooled to a temporary file, which is written and read in the default executor of
+    the loop.  The MD5 digest of the content is computed as it is buffered, by a `ThreadedHash`.
+    """
+
+    def __init__(self):
+        self._file = tempfile.SpooledTemporaryFile(max_size=settings.PART_SPOOL_MEMORY_LIMIT,
+                                                   dir=settings.PART_SPOOL_DIR)
+        self._md5 = ThreadedHash(hashlib.md5)
+        self._md5_digest = None
+        self.size = 0
+
+    async def fill(self, stream, size):
+        """Reads ``size`` bytes from the given stream, or fewer if the stream ends first.
+
+        :rtype: int
+        :return: the number of bytes buffered
+        """
+        remaining = size
+        while remaining > 0:
+            chunk = await stream.read(min(remaining, READ_SIZE))
+            if not chunk:
+                break
+            await self.write(chunk)
+            remaining -= len(chunk)
+        await self.finish()
+        return self.size
+
+    def tee(self, stream, size):
+        """Returns a stream of the next ``size`` bytes of the given stream, or fewer if it ends
+        first, which buffers them as they are read.  Once it is drained, `finish` completes the
+        buffer as `fill` does.
+        """
+        return TeeStream(self, stream, size)
+
+    async def write(self, chunk):
+        if self.size + len(chunk) > settings.PART_SPOOL_MEMORY_LIMIT:
+            # The file is or is about to be on disk
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self._file.write, chunk)
+        else:
+            self._file.write(chunk)
+        await self._md5.update(chunk)
+        self.size += len(chunk)
+
+    async def finish(self):
+        """Waits for the MD5 digest of the buffered content.
+        """
+        self._md5_digest = await self._md5.digest()
+
+    @property
+    def md5(self):
+        return self._md5_digest.hex()
+
+    @property
+    def md5_digest(self):
+        return self._md5_digest
+
+    def stream(self):
+        """Returns a new stream of the buffered content, from its start.
+        """
+        self._file.seek(0)
+        if self.size > settings.PART_SPOOL_MEMORY_LIMIT:
+            return SpooledFileStream(self._file, self.size)
+        return streams.FileStreamReader(self._file)
+
+    def close(self):
+        self._file.close()
+
+
+class TeeStream(streams.BaseStream):
+    """Reads up to ``size`` bytes of ``stream`` through, writing them to the `PartBuffer`
+    ``part``.  See `PartBuffer.tee`.
+    """
+
+    def __init__(self, part, stream, size):
+        super().__init__()
+        self.part = part
+        self.stream = stream
+        self._size = size
+        self._remaining = size
+
+    @property
+    def size(self):
+        return self._size
+
+    async def _read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = await self.stream.read(size) if size else b''
+        if not data:
+            self.feed_eof()
+            return data
+        self._remaining -= len(data)
+        await self.part.write(data)
+        return data
+
+    async def drain(self):
+        """Reads the rest of the stream into the part and finishes it.
+        """
+        while await self.read(READ_SIZE):
+            pass
+        await self.part.finish()
+
+
+class SpooledFileStream(streams.BaseStream):
+    """Reads a file of ``size`` bytes from its current position in the default executor of the
+    loop, so that reading it from disk does not block the loop.
+    """
+
+    def __init__(self, file, size):
+        super().__init__()
+        self.file = file
+        self._size = size
+
+    @property
+    def size(self):
+        return self._size
+
+    async def _read(self, size=-1):
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(None, self.file.read, size)
+        if not data:
+            self.feed_eof()
+        return data
+
+
+class RangeDownloadStream(streams.BaseStream):
+    """Reassembles an object downloaded as consecutive byte ranges over several connections.
+
+    Ranges of ``part_size`` bytes are fetched by ``fetch(start, end)``, a coroutine function
+    returning the bytes from ``start`` to ``end`` inclusive.  Up to ``concurrency`` ranges are
+    fetched or held ahead of the reader at once, which bounds the reorder buffer to about
+    ``concurrency + 1`` parts; the next range is requested as the reader moves past a part.
+    The ranges still being fetched are cancelled when the stream is closed, or garbage collected
+    after its reader gave up on it.
+
+    :param bytes first_part: the content already received from the start of the object
+    """
+
+    def __init__(self, fetch, size, part_size, concurrency, first_part=b'',
+                 content_type='application/octet-stream'):
+        super().__init__()
+        self._fetch = fetch
+        self._size = size
+        self._part_size = part_size
+        self._concurrency = concurrency
+        self._pending = collections.deque()
+        self._next_start = len(first_part)
+        self._part = first_part
+        self._position = 0
+        self.content_type = content_type
+        self._schedule()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def partial(self):
+        return False
+
+    @property
+    def name(self):
+        return None
+
+    def _schedule(self):
+        while len(self._pending) < self._concurrency and self._next_start < self._size:
+            end = min(self._next_start + self._part_size, self._size) - 1
+            self._pending.append(asyncio.ensure_future(self._fetch(self._next_start, end)))
+            self._next_start = end + 1
+
+    async def _next_part(self):
+        """Waits for the next part in order.  Returns False at the end of the object.
+        """
+        if not self._pending:
+            self.feed_eof()
+            return False
+        try:
+            self._part = await self._pending.popleft()
+        except BaseException:
+            self.cancel()
+            raise
+        self._position = 0
+        self._schedule()
+        return True
+
+    async def _read(self, size=-1):
+        if size < 0:
+            chunks = [self._part[self._position:]]
+            while await self._next_part():
+                chunks.append(self._part)
+            self._position = len(self._part)
+            return b''.join(chunks)
+
+        while self._position >= len(self._part):
+            if not await self._next_part():
+                return b''
+        data = self._part[self._position:self._position + size]
+        self._position += len(data)
+        return data
+
+    def cancel(self):
+        """Stops fetching the remaining ranges.
+        """
+        for task in self._pending:
+            task.cancel()
+        self._pending.clear()
+        self._next_start = self._size
+
+    def close(self):
+        self.cancel()
+        self._part = b''
+        self._position = 0
+        self.feed_eof()
+
+    def __del__(self):
+        try:
+            self.cancel()
+        except RuntimeError:
+            # The loop of the tasks is closed, they are not running anymore
+            pass
@@ -8,9 +8,11 @@ Original source: tests/providers/s3compat/test_provider.py from RDM-waterbutler
 import os
 import io
 import xml
+import asyncio
 import json
 import time
 import base64
+import threading
 import hashlib
 import aiohttpretty
 from http import client
@@ -23,8 +25,13 @@ from boto.utils import compute_md5
 
 from waterbutler.core import streams, metadata, exceptions
 from waterbutler.core.path import WaterButlerPath
+from waterbutler.core.utils import make_disposition
 from s3compat.waterbutler_provider import S3CompatProvider
 from s3compat.waterbutler_provider import settings as pd_settings
+from s3compat.waterbutler_provider import provider as pd_provider
+from s3compat.waterbutler_provider import streams as pd_streams
+from s3compat.waterbutler_provider.cache import get_metadata_cache, get_negative_cache
+from s3compat.waterbutler_provider.pool import close_connectors
 
 from tests.utils import MockCoroutine
 from collections import OrderedDict
@@ -37,6 +44,24 @@ from s3compat.waterbutler_provider.metadata import (S3CompatRevision,
 from hmac import compare_digest
 
 
+@pytest.fixture(autouse=True)
+def clear_shared_state():
+    pd_provider._endpoint_capabilities.clear()
+    get_metadata_cache().clear()
+    get_negative_cache().clear()
+    yield
+    pd_provider._endpoint_capabilities.clear()
+    get_metadata_cache().clear()
+    get_negative_cache().clear()
+
+
+@pytest.fixture
+def list_objects_v1(provider):
+    """Makes the endpoint known not to support ListObjectsV2, as in the listings mocked with
+    ListObjects parameters."""
+    provider._set_capability('list_objects_v2', False)
+
+
 @pytest.fixture
 def base_prefix():
     return ''
@@ -541,15 +566,20 @@ def location_response(location):
     '''.format(location=location)
 
 
-def list_objects_response(keys, truncated=False):
+def list_objects_response(keys, truncated=False, v2=False, next_token=None):
     response = '''<?xml version="1.0" encoding="UTF-8"?>
     <ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
         <Name>bucket</Name>
         <Prefix/>
-        <Marker/>
         <MaxKeys>1000</MaxKeys>'''
 
     response += '<IsTruncated>' + str(truncated).lower() + '</IsTruncated>'
+    if v2:
+        response += '<KeyCount>{}</KeyCount>'.format(len(keys))
+        if next_token is not None:
+            response += '<NextContinuationToken>{}</NextContinuationToken>'.format(next_token)
+    else:
+        response += '<Marker/>'
     response += ''.join(map(
         lambda x: '<Contents><Key>{}</Key></Contents>'.format(x),
         keys
@@ -560,9 +590,32 @@ def list_objects_response(keys, truncated=False):
     return response.encode('utf-8')
 
 
+def part_headers(part_number, content=b'sleepy', part_size=2, streamed=False):
+    part = content[(part_number - 1) * part_size:part_number * part_size]
+    if streamed:
+        # Parts sent as they are read have no Content-MD5
+        return {'Content-Length': str(len(part))}
+    return {
+        'Content-Length': str(len(part)),
+        'Content-MD5': base64.b64encode(hashlib.md5(part).digest()).decode('ascii'),
+    }
+
+
+def composite_etag(parts):
+    digests = b''.join(hashlib.md5(part).digest() for part in parts)
+    return '"{}-{}"'.format(hashlib.md5(digests).hexdigest(), len(parts))
+
+
+def complete_upload_body(etag):
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+    <CompleteMultipartUploadResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+        <ETag>{}</ETag>
+    </CompleteMultipartUploadResult>'''.format(xml.sax.saxutils.escape(etag))
+
+
 def bulk_delete_body(keys):
     payload = '<?xml version="1.0" encoding="UTF-8"?>'
-    payload += '<Delete>'
+    payload += '<Delete><Quiet>true</Quiet>'
     payload += ''.join(map(
         lambda x: '<Object><Key>{}</Key></Object>'.format(x),
         keys
@@ -666,6 +719,18 @@ class TestProviderConstruction:
         assert provider.connection.host == 'normalhost'
         assert provider.connection.port == 8080
 
+    @pytest.mark.asyncio
+    async def test_make_request_shares_connector(self, provider):
+        make_request = MockCoroutine()
+        with mock.patch('waterbutler.core.provider.BaseProvider.make_request', make_request):
+            await provider.make_request('GET', 'https://securehost/')
+            connector = make_request.call_args_list[0][1]['connector']
+            await provider.make_request('GET', 'https://securehost/')
+
+        assert make_request.call_args_list[1][1]['connector'] is connector
+        assert not connector.closed
+        await close_connectors()
+
 
 class TestValidatePath:
 
@@ -867,4 +932,1349 @@ class TestCRUD:
         aiohttpretty.register_uri('GET', url[:url.index('?')], status=404)
 
         with pytest.raises(exceptions.DownloadError):
-            await provider.download(path)
\ No newline at end of file
+            await provider.download(path)
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_download_without_head(self, provider, mock_time):
+        path = WaterButlerPath('/muhtriangle', prepend=provider.prefix)
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+
+        head_url = generate_url(100, 'HEAD')
+        aiohttpretty.register_uri('HEAD', head_url, status=500)
+        get_url = generate_url(100, response_headers={'response-content-disposition': 'attachment'})
+        aiohttpretty.register_uri('GET', get_url[:get_url.index('?')],
+                                  body=b'delicious', auto_length=True)
+
+        result = await provider.download(path)
+
+        assert await result.read() == b'delicious'
+        assert result._size == 9
+        assert not aiohttpretty.has_call(method='HEAD', uri=head_url)
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_download_size_from_content_range(self, provider, mock_time):
+        path = WaterButlerPath('/muhtriangle', prepend=provider.prefix)
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+
+        head_url = generate_url(100, 'HEAD')
+        aiohttpretty.register_uri('HEAD', head_url, status=500)
+        get_url = generate_url(100, response_headers={'response-content-disposition': 'attachment'})
+        aiohttpretty.register_uri('GET', get_url[:get_url.index('?')], body=b'de', status=206,
+                                  headers={'Content-Range': 'bytes 0-1/9'})
+
+        result = await provider.download(path, range=(0, 1))
+
+        assert result._size == 2
+        assert not aiohttpretty.has_call(method='HEAD', uri=head_url)
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_download_size_from_head(self, provider, file_header_metadata, mock_time):
+        path = WaterButlerPath('/muhtriangle', prepend=provider.prefix)
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+
+        head_url = generate_url(100, 'HEAD')
+        aiohttpretty.register_uri('HEAD', head_url, headers=file_header_metadata)
+        get_url = generate_url(100, response_headers={'response-content-disposition': 'attachment'})
+        aiohttpretty.register_uri('GET', get_url[:get_url.index('?')], body=b'delicious',
+                                  headers={'ETag': file_header_metadata['Etag']})
+
+        result = await provider.download(path)
+
+        assert result._size == int(file_header_metadata['Content-Length'])
+        assert aiohttpretty.has_call(method='HEAD', uri=head_url)
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_download_ranges(self, provider, mock_time, monkeypatch):
+        monkeypatch.setattr(provider, 'PARALLEL_DOWNLOAD_CONCURRENCY', 2)
+        monkeypatch.setattr(provider, 'PARALLEL_DOWNLOAD_PART_SIZE', 4)
+        path = WaterButlerPath('/muhtriangle', prepend=provider.prefix)
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+
+        get_url = generate_url(100, response_headers={'response-content-disposition': 'attachment'})
+        aiohttpretty.register_uri('GET', get_url[:get_url.index('?')], responses=[
+            {'status': 206, 'body': b'deli',
+             'headers': {'Content-Range': 'bytes 0-3/9', 'ETag': '"etag"'}},
+            {'status': 206, 'body': b'ciou', 'headers': {'Content-Range': 'bytes 4-7/9'}},
+            {'status': 206, 'body': b's', 'headers': {'Content-Range': 'bytes 8-8/9'}},
+        ])
+
+        result = await provider.download(path)
+
+        assert result.size == 9
+        assert not result.partial
+        assert await result.read() == b'delicious'
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_download_ranges_single_part(self, provider, mock_time, monkeypatch):
+        monkeypatch.setattr(provider, 'PARALLEL_DOWNLOAD_CONCURRENCY', 2)
+        monkeypatch.setattr(provider, 'PARALLEL_DOWNLOAD_PART_SIZE', 16)
+        path = WaterButlerPath('/muhtriangle', prepend=provider.prefix)
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+
+        get_url = generate_url(100, response_headers={'response-content-disposition': 'attachment'})
+        aiohttpretty.register_uri('GET', get_url[:get_url.index('?')], status=206,
+                                  body=b'delicious', headers={'Content-Range': 'bytes 0-8/9'})
+
+        result = await provider.download(path)
+
+        assert result.size == 9
+        assert not result.partial
+        assert await result.read() == b'delicious'
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_download_ranges_unknown_size(self, provider, mock_time, monkeypatch):
+        monkeypatch.setattr(provider, 'PARALLEL_DOWNLOAD_CONCURRENCY', 2)
+        monkeypatch.setattr(provider, 'PARALLEL_DOWNLOAD_PART_SIZE', 4)
+        path = WaterButlerPath('/muhtriangle', prepend=provider.prefix)
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+
+        get_url = generate_url(100, response_headers={'response-content-disposition': 'attachment'})
+        aiohttpretty.register_uri('GET', get_url[:get_url.index('?')], responses=[
+            {'status': 206, 'body': b'deli', 'headers': {'Content-Range': 'bytes 0-3/*'}},
+            {'status': 200, 'body': b'delicious', 'headers': {'Content-Length': '9'}},
+        ])
+
+        result = await provider.download(path)
+
+        # Not the first range only, but the whole object in one request
+        assert await result.read() == b'delicious'
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_download_redirect(self, provider, mock_time, monkeypatch):
+        monkeypatch.setattr(pd_settings, 'DOWNLOAD_REDIRECT', True)
+        path = WaterButlerPath('/muhtriangle', prepend=provider.prefix)
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+
+        url = await provider.download(path, accept_url=True, version='someversion',
+                                      display_name='meow.txt')
+
+        expected = generate_url(
+            100,
+            query_parameters={'versionId': 'someversion'},
+            response_headers={'response-content-disposition':
+                              'attachment; filename="meow.txt"; filename*=UTF-8\'\'meow.txt'},
+        )
+        assert url == expected
+        query = parse.parse_qs(parse.urlparse(url).query)
+        assert query['versionId'] == ['someversion']
+        assert 'response-content-disposition' in query
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_download_redirect_disabled(self, provider, file_header_metadata, mock_time,
+                                              monkeypatch):
+        monkeypatch.setattr(pd_settings, 'DOWNLOAD_REDIRECT', False)
+        path = WaterButlerPath('/muhtriangle', prepend=provider.prefix)
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+
+        head_url = generate_url(100, 'HEAD')
+        aiohttpretty.register_uri('HEAD', head_url, headers=file_header_metadata)
+        get_url = generate_url(100, response_headers={'response-content-disposition': 'attachment'})
+        aiohttpretty.register_uri('GET', get_url[:get_url.index('?')],
+                                  body=b'delicious', headers=file_header_metadata, auto_length=True)
+
+        result = await provider.download(path, accept_url=True)
+
+        assert await result.read() == b'delicious'
+
+
+class TestMultipartUpload:
+
+    def test_multipart_slots(self, provider, monkeypatch):
+        monkeypatch.setattr(provider, 'MULTIPART_CONCURRENCY', 4)
+        monkeypatch.setattr(provider, 'MULTIPART_MAX_BUFFER_SIZE', 100)
+
+        assert provider._multipart_slots(10) == 4
+        assert provider._multipart_slots(30) == 2
+        assert provider._multipart_slots(40) == 1
+        assert provider._multipart_slots(200) == 1
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_upload_parts_concurrently(self, provider, file_stream, mock_time, monkeypatch):
+        monkeypatch.setattr(provider, 'CHUNK_SIZE', 2)
+        monkeypatch.setattr(provider, 'MULTIPART_CONCURRENCY', 2)
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+        upload_id = 'EXAMPLEJZ6e0YupT2h66iePQCc9IEbYbDUy4RTpMeoSMLPRp8Z5o1u8feSRonpvnWsKKG35tI2LB9'
+
+        for part_number in (1, 2, 3):
+            params = {'partNumber': str(part_number), 'uploadId': upload_id}
+            part_url = provider.bucket.new_key(path.full_path).generate_url(
+                100, 'PUT', query_parameters=params, headers=part_headers(part_number)
+            )
+            aiohttpretty.register_uri('PUT', part_url, status=200,
+                                      headers={'ETag': '"part{}"'.format(part_number)})
+
+        in_flight = []
+        max_in_flight = []
+        make_request = provider.make_request
+
+        async def counting_make_request(*args, **kwargs):
+            in_flight.append(args)
+            max_in_flight.append(len(in_flight))
+            try:
+                await asyncio.sleep(0.01)
+                return await make_request(*args, **kwargs)
+            finally:
+                in_flight.remove(args)
+
+        monkeypatch.setattr(provider, 'make_request', counting_make_request)
+
+        parts_metadata = await provider._upload_parts(file_stream, path, upload_id)
+
+        assert [part['ETag'] for part in parts_metadata] == ['"part1"', '"part2"', '"part3"']
+        # Parts overlap, within MULTIPART_CONCURRENCY
+        assert 1 < max(max_in_flight) <= 2
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_upload_parts_concurrently_failure(self, provider, file_stream, mock_time,
+                                                     monkeypatch):
+        monkeypatch.setattr(provider, 'CHUNK_SIZE', 2)
+        monkeypatch.setattr(provider, 'MULTIPART_CONCURRENCY', 3)
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+        upload_id = 'EXAMPLEJZ6e0YupT2h66iePQCc9IEbYbDUy4RTpMeoSMLPRp8Z5o1u8feSRonpvnWsKKG35tI2LB9'
+
+        for part_number in (1, 2, 3):
+            params = {'partNumber': str(part_number), 'uploadId': upload_id}
+            part_url = provider.bucket.new_key(path.full_path).generate_url(
+                100, 'PUT', query_parameters=params, headers=part_headers(part_number)
+            )
+            aiohttpretty.register_uri('PUT', part_url, status=403 if part_number == 2 else 200,
+                                      headers={'ETag': '"part{}"'.format(part_number)})
+
+        with pytest.raises(exceptions.UploadError):
+            await provider._upload_parts(file_stream, path, upload_id)
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    @pytest.mark.parametrize('etag,part_etags,part_headers_,matches,deleted', [
+        (composite_etag([b'sl', b'ee', b'py']), [b'sl', b'ee', b'py'], {}, True, False),
+        (composite_etag([b'sl', b'ee', b'pi']), [b'sl', b'ee', b'py'], {}, False, True),
+        (composite_etag([b'sl', b'eepy']), [b'sl', b'ee', b'py'], {}, False, True),
+        ('"opaque-etag"', [b'sl', b'ee', b'py'], {}, True, False),
+        # A part altered on the way, which the storage did not reject without Content-MD5
+        (composite_etag([b'sl', b'ee', b'py']), [b'sl', b'eh', b'py'], {}, False, False),
+        # Parts encrypted with SSE-KMS or SSE-C have ETags which are not MD5s
+        (composite_etag([b'sl', b'ee', b'pi']), [b'sl', b'eh', b'py'],
+         {'x-amz-server-side-encryption': 'aws:kms'}, True, False),
+        (composite_etag([b'sl', b'ee', b'pi']), [b'sl', b'eh', b'py'],
+         {'x-amz-server-side-encryption-customer-algorithm': 'AES256'}, True, False),
+    ])
+    async def test_chunked_upload_checks_etags(self, provider, file_stream, create_session_resp,
+                                               etag, part_etags, part_headers_, matches,
+                                               deleted, mock_time, monkeypatch):
+        monkeypatch.setattr(provider, 'CHUNK_SIZE', 2)
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+        upload_id = 'EXAMPLEJZ6e0YupT2h66iePQCc9IEbYbDUy4RTpMeoSMLPRp8Z5o1u8' \
+                    'feSRonpvnWsKKG35tI2LB9VDPiCgTy.Gq2VxQLYjrue4Nq.NBdqI-'
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+        create_url = generate_url(100, 'POST', query_parameters={'uploads': ''})
+        aiohttpretty.register_uri('POST', create_url, status=200, body=create_session_resp)
+        for part_number, part in enumerate(part_etags, 1):
+            params = {'partNumber': str(part_number), 'uploadId': upload_id}
+            part_url = generate_url(100, 'PUT', query_parameters=params,
+                                    headers=part_headers(part_number, streamed=True))
+            aiohttpretty.register_uri(
+                'PUT', part_url, status=200,
+                headers={'ETag': '"{}"'.format(hashlib.md5(part).hexdigest()), **part_headers_})
+        monkeypatch.setattr(provider, '_complete_multipart_upload',
+                            MockCoroutine(return_value=etag))
+        monkeypatch.setattr(provider, '_abort_chunked_upload', MockCoroutine(return_value=False))
+        delete_url = generate_url(100, 'DELETE')
+        aiohttpretty.register_uri('DELETE', delete_url, status=204)
+
+        if matches:
+            await provider._chunked_upload(file_stream, path)
+        else:
+            with pytest.raises(exceptions.UploadChecksumMismatchError):
+                await provider._chunked_upload(file_stream, path)
+        assert aiohttpretty.has_call(method='DELETE', uri=delete_url) is deleted
+        # A mismatched part is caught before the upload is completed
+        assert provider._abort_chunked_upload.call_count == int(not matches and not deleted)
+
+    @pytest.mark.parametrize('headers,expected', [
+        ({}, True),
+        ({'x-amz-server-side-encryption': 'AES256'}, True),
+        ({'x-amz-server-side-encryption': 'aws:kms'}, False),
+        ({'x-amz-server-side-encryption': 'aws:kms:dsse'}, False),
+        ({'x-amz-server-side-encryption-customer-algorithm': 'AES256'}, False),
+    ])
+    def test_etag_is_md5(self, headers, expected):
+        assert pd_provider._etag_is_md5(headers) is expected
+
+    def test_plan_parts(self, provider):
+        mb = 1000 ** 2
+        assert provider._plan_parts(130 * mb) == [65 * mb, 65 * mb]
+        assert len(provider._plan_parts(10 ** 12)) == 1000
+
+    def test_plan_parts_service_overrides(self, auth, credentials, settings):
+        settings['multipart_upload'] = {'min_part_size': 10, 'max_part_size': 40,
+                                        'target_part_count': 5}
+        provider = S3CompatProvider(auth, credentials, settings)
+
+        assert provider._plan_parts(25) == [13, 12]
+        assert provider._plan_parts(100) == [20] * 5
+        assert provider._plan_parts(1000) == [40] * 25
+
+    def test_plan_parts_too_large(self, provider, monkeypatch):
+        monkeypatch.setattr(provider, 'MULTIPART_MAX_PART_SIZE', 10)
+
+        with pytest.raises(exceptions.UploadError) as e:
+            provider._plan_parts(100001)
+
+        assert e.value.code == 413
+
+
+def bulk_delete_url(provider, keys):
+    payload, headers = bulk_delete_body(keys)
+    return provider.bucket.generate_url(100, 'POST', query_parameters={'delete': ''},
+                                        headers=headers)
+
+
+def delete_result_response(errors=()):
+    response = '<?xml version="1.0" encoding="UTF-8"?>'
+    response += '<DeleteResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+    response += ''.join(map(
+        lambda x: '<Error><Key>{}</Key><Code>AccessDenied</Code>'
+                  '<Message>Access Denied</Message></Error>'.format(x),
+        errors
+    ))
+    response += '</DeleteResult>'
+    return response.encode('utf-8')
+
+
+@pytest.mark.usefixtures('list_objects_v1')
+class TestDeleteFolder:
+
+    @pytest.mark.asyncio
+    async def test_delete_folder_concurrently(self, provider, monkeypatch):
+        monkeypatch.setattr(pd_settings, 'DELETE_CONCURRENCY', 2)
+        monkeypatch.setattr(pd_settings, 'BULK_DELETE_MAX_KEYS', 1)
+        path = WaterButlerPath('/thisfolder/', prepend=provider.prefix)
+
+        async def iter_folder_keys(prefix):
+            yield ['thisfolder/item1', 'thisfolder/item2', 'thisfolder/item3']
+            yield ['thisfolder/item4']
+
+        in_flight = []
+        max_in_flight = []
+
+        async def delete_batch(keys):
+            in_flight.append(keys)
+            max_in_flight.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(keys)
+
+        monkeypatch.setattr(provider, '_iter_folder_keys', iter_folder_keys)
+        monkeypatch.setattr(provider, '_delete_batch', delete_batch)
+
+        await provider.delete(path)
+
+        # Batches overlap, within DELETE_CONCURRENCY
+        assert 1 < max(max_in_flight) <= 2
+
+    @pytest.mark.asyncio
+    async def test_bounded_gather_cancels_on_failure(self):
+        cancelled = []
+
+        async def fail():
+            raise exceptions.DeleteError('failed')
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        with pytest.raises(exceptions.DeleteError):
+            await pd_provider._bounded_gather([slow(), fail(), slow()], 3)
+
+        assert cancelled == [True, True]
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_delete_folder_bulk(self, provider, mock_time):
+        path = WaterButlerPath('/thisfolder/', prepend=provider.prefix)
+        keys = ['thisfolder/', 'thisfolder/item1', 'thisfolder/item2']
+        prefix = path.full_path.lstrip('/')
+
+        list_url = provider.bucket.generate_url(100, 'GET')
+        aiohttpretty.register_uri('GET', list_url, params={'prefix': prefix},
+                                  body=list_objects_response(keys))
+        aiohttpretty.register_uri('POST', bulk_delete_url(provider, keys[1:]), status=200,
+                                  body=delete_result_response())
+        aiohttpretty.register_uri('POST', bulk_delete_url(provider, keys[:1]), status=200,
+                                  body=delete_result_response())
+
+        await provider.delete(path)
+
+        assert aiohttpretty.has_call(method='POST', uri=bulk_delete_url(provider, keys[1:]))
+        assert aiohttpretty.has_call(method='POST', uri=bulk_delete_url(provider, keys[:1]))
+        assert pd_provider._endpoint_capabilities[provider.endpoint]['bulk_delete'] is True
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_delete_folder_bulk_key_errors(self, provider, mock_time):
+        path = WaterButlerPath('/thisfolder/', prepend=provider.prefix)
+        keys = ['thisfolder/item1', 'thisfolder/item2']
+        prefix = path.full_path.lstrip('/')
+
+        list_url = provider.bucket.generate_url(100, 'GET')
+        aiohttpretty.register_uri('GET', list_url, params={'prefix': prefix},
+                                  body=list_objects_response(keys))
+        aiohttpretty.register_uri('POST', bulk_delete_url(provider, keys), status=200,
+                                  body=delete_result_response(['thisfolder/item2']))
+
+        with pytest.raises(exceptions.DeleteError) as exc:
+            await provider.delete(path)
+
+        assert 'thisfolder/item2' in exc.value.message
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_delete_folder_bulk_unsupported(self, provider, mock_time):
+        path = WaterButlerPath('/thisfolder/', prepend=provider.prefix)
+        keys = ['thisfolder/item1', 'thisfolder/item2']
+        prefix = path.full_path.lstrip('/')
+
+        list_url = provider.bucket.generate_url(100, 'GET')
+        aiohttpretty.register_uri('GET', list_url, params={'prefix': prefix},
+                                  body=list_objects_response(keys))
+        aiohttpretty.register_uri('POST', bulk_delete_url(provider, keys), status=501)
+        for key in keys:
+            aiohttpretty.register_uri('DELETE',
+                                      provider.bucket.new_key(key).generate_url(100, 'DELETE'),
+                                      status=204)
+
+        await provider.delete(path)
+
+        for key in keys:
+            assert aiohttpretty.has_call(
+                method='DELETE', uri=provider.bucket.new_key(key).generate_url(100, 'DELETE'))
+        assert pd_provider._endpoint_capabilities[provider.endpoint]['bulk_delete'] is False
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_delete_folder_paginated(self, provider, mock_time):
+        path = WaterButlerPath('/thisfolder/', prepend=provider.prefix)
+        first_page = ['thisfolder/', 'thisfolder/item1']
+        second_page = ['thisfolder/sub/', 'thisfolder/sub/item2']
+        prefix = path.full_path.lstrip('/')
+
+        list_url = provider.bucket.generate_url(100, 'GET')
+        aiohttpretty.register_uri('GET', list_url, params={'prefix': prefix},
+                                  body=list_objects_response(first_page, truncated=True))
+        aiohttpretty.register_uri('GET', list_url,
+                                  params={'prefix': prefix, 'marker': first_page[-1]},
+                                  body=list_objects_response(second_page))
+        for keys in (['thisfolder/item1'], ['thisfolder/sub/item2'],
+                     ['thisfolder/sub/'], ['thisfolder/']):
+            aiohttpretty.register_uri('POST', bulk_delete_url(provider, keys), status=200,
+                                      body=delete_result_response())
+
+        await provider.delete(path)
+
+        # Each page is deleted on its own, and folder keys one depth at a time
+        for keys in (['thisfolder/item1'], ['thisfolder/sub/item2'],
+                     ['thisfolder/sub/'], ['thisfolder/']):
+            assert aiohttpretty.has_call(method='POST', uri=bulk_delete_url(provider, keys))
+
+
+def copy_object_url(provider, source_key, dest_key):
+    source = '/' + os.path.join(provider.settings['bucket'], source_key)
+    headers = {'x-amz-copy-source': parse.quote(source)}
+    return provider.bucket.new_key(dest_key).generate_url(100, 'PUT', headers=headers)
+
+
+class TestIntraCopy:
+
+    def test_can_intra_copy(self, provider, auth, credentials):
+        other_bucket = S3CompatProvider(auth, credentials, {'bucket': 'other bucket'})
+        other_host = S3CompatProvider(auth, dict(credentials, host='Other Host'),
+                                      {'bucket': 'that kerning'})
+        other_key = S3CompatProvider(auth, dict(credentials, access_key='other'),
+                                     {'bucket': 'that kerning'})
+
+        assert provider.can_intra_copy(other_bucket)
+        assert provider.can_intra_move(other_bucket)
+        assert not provider.can_intra_copy(other_host)
+        assert not provider.can_intra_copy(other_key)
+        assert not provider.can_intra_move(other_key)
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    @pytest.mark.usefixtures('list_objects_v1')
+    async def test_intra_copy_folder(self, provider, copy_object_resp, mock_time,
+                                     monkeypatch):
+        src_path = WaterButlerPath('/thisfolder/', prepend=provider.prefix)
+        dest_path = WaterButlerPath('/thatfolder/', prepend=provider.prefix)
+        keys = ['thisfolder/', 'thisfolder/item1', 'thisfolder/sub/item2']
+        monkeypatch.setattr(provider, 'exists', MockCoroutine(return_value=False))
+        monkeypatch.setattr(provider, '_metadata_folder', MockCoroutine(return_value=[]))
+
+        list_url = provider.bucket.generate_url(100, 'GET')
+        aiohttpretty.register_uri('GET', list_url, params={'prefix': 'thisfolder/'},
+                                  body=list_objects_response(keys))
+        for key in keys:
+            aiohttpretty.register_uri(
+                'PUT', copy_object_url(provider, key, 'that' + key[len('this'):]),
+                status=200, body=copy_object_resp)
+
+        folder, created = await provider.intra_copy(provider, src_path, dest_path)
+
+        assert created is True
+        assert folder.path == '/thatfolder/'
+        assert folder.children == []
+        for key in keys:
+            assert aiohttpretty.has_call(
+                method='PUT', uri=copy_object_url(provider, key, 'that' + key[len('this'):]))
+
+    @pytest.mark.asyncio
+    async def test_intra_copy_folder_overlapping(self, provider, monkeypatch):
+        src_path = WaterButlerPath('/thisfolder/', prepend=provider.prefix)
+        dest_path = WaterButlerPath('/thisfolder/sub/', prepend=provider.prefix)
+        delete = MockCoroutine()
+        monkeypatch.setattr(provider, 'delete', delete)
+
+        with pytest.raises(exceptions.IntraCopyError) as exc:
+            await provider.intra_copy(provider, src_path, dest_path)
+        assert exc.value.code == 400
+        with pytest.raises(exceptions.IntraCopyError):
+            await provider.intra_copy(provider, src_path, src_path)
+        # Replacing a folder containing the source would delete it
+        with pytest.raises(exceptions.IntraCopyError):
+            await provider.intra_copy(provider, dest_path, src_path)
+        assert delete.call_count == 0
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_multipart_copy(self, provider, create_session_resp, mock_time, monkeypatch):
+        monkeypatch.setattr(provider, 'CHUNK_SIZE', 2)
+        monkeypatch.setattr(provider, 'MULTIPART_COPY_THRESHOLD', 4)
+        upload_id = 'EXAMPLEJZ6e0YupT2h66iePQCc9IEbYbDUy4RTpMeoSMLPRp8Z5o1u8' \
+                    'feSRonpvnWsKKG35tI2LB9VDPiCgTy.Gq2VxQLYjrue4Nq.NBdqI-'
+        source_headers = {
+            'Content-Length': '6',
+            'Content-Type': 'text/plain',
+            'Content-Disposition': 'attachment',
+            'Etag': '"fba9dede5f27731c9771645a39863328"',
+            'x-amz-meta-owner': 'me',
+            'x-amz-server-side-encryption': 'AES256',
+        }
+        head_url = provider.bucket.new_key('thisfile').generate_url(100, 'HEAD')
+        aiohttpretty.register_uri('HEAD', head_url, headers=source_headers)
+        generate_url = provider.bucket.new_key('thatfile').generate_url
+        create_headers = {
+            'Content-Type': 'text/plain',
+            'Content-Disposition': 'attachment',
+            'x-amz-meta-owner': 'me',
+        }
+        create_url = generate_url(100, 'POST', query_parameters={'uploads': ''},
+                                  headers=create_headers)
+        aiohttpretty.register_uri('POST', create_url, status=200, body=create_session_resp)
+        part_urls = []
+        for part_number, byte_range in enumerate(['bytes=0-1', 'bytes=2-3', 'bytes=4-5'], 1):
+            params = {'partNumber': str(part_number), 'uploadId': upload_id}
+            headers = {
+                'x-amz-copy-source': parse.quote('/that kerning/thisfile'),
+                'x-amz-copy-source-range': byte_range,
+                'x-amz-copy-source-if-match': '"fba9dede5f27731c9771645a39863328"',
+            }
+            part_url = generate_url(100, 'PUT', query_parameters=params, headers=headers)
+            part_urls.append(part_url)
+            aiohttpretty.register_uri(
+                'PUT', part_url, status=200,
+                body='<CopyPartResult><ETag>"part{}"</ETag></CopyPartResult>'.format(part_number))
+        monkeypatch.setattr(provider, '_complete_multipart_upload', MockCoroutine())
+
+        await provider._copy_object(provider, 'thisfile', 'thatfile', size=6)
+
+        assert aiohttpretty.has_call(method='POST', uri=create_url)
+        for part_url in part_urls:
+            assert aiohttpretty.has_call(method='PUT', uri=part_url)
+        args, _ = provider._complete_multipart_upload.call_args_list[0]
+        assert args[1:] == (upload_id,
+                            [{'ETAG': '"part1"'}, {'ETAG': '"part2"'}, {'ETAG': '"part3"'}])
+
+    @pytest.mark.asyncio
+    async def test_cancelled_multipart_copy_is_aborted(self, provider, file_header_metadata,
+                                                       monkeypatch):
+        monkeypatch.setattr(provider, 'CHUNK_SIZE', 2)
+        monkeypatch.setattr(provider, 'MULTIPART_COPY_THRESHOLD', 4)
+        monkeypatch.setattr(provider, '_metadata_file', MockCoroutine(
+            return_value=S3CompatFileMetadataHeaders(provider, 'thisfile', file_header_metadata)))
+        monkeypatch.setattr(provider, '_create_upload_session',
+                            MockCoroutine(return_value='upload-id'))
+        monkeypatch.setattr(provider, '_abort_chunked_upload', MockCoroutine(return_value=False))
+        started, cancelled = [], []
+
+        async def upload_part_copy(*args):
+            started.append(args[3])
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(args[3])
+                raise
+
+        monkeypatch.setattr(provider, '_upload_part_copy', upload_part_copy)
+
+        copy = asyncio.ensure_future(provider._copy_object(provider, 'thisfile', 'thatfile',
+                                                           size=6))
+        await asyncio.sleep(0.01)
+        copy.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await copy
+
+        assert started and sorted(cancelled) == started
+        args, _ = provider._abort_chunked_upload.call_args_list[0]
+        assert args[1] == 'upload-id'
+
+
+class UnsizedStream(streams.StringStream):
+    """A stream whose size is not known in advance."""
+
+    size = None
+
+
+class TestStreamingUpload:
+
+    @pytest.mark.asyncio
+    async def test_small_stream_is_put(self, provider, mock_time, monkeypatch):
+        sent = []
+
+        async def contiguous_upload(stream, path):
+            sent.append(await stream.read())
+            return '"etag"'
+
+        monkeypatch.setattr(provider, 'CHUNK_SIZE', 10)
+        monkeypatch.setattr(provider, '_contiguous_upload',
+                            MockCoroutine(side_effect=contiguous_upload))
+        monkeypatch.setattr(provider, '_create_upload_session', MockCoroutine())
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+
+        size, etag = await provider._streaming_upload(UnsizedStream(b'sleepy'), path)
+
+        assert (size, etag) == (6, '"etag"')
+        assert sent == [b'sleepy']
+        assert provider._create_upload_session.call_count == 0
+        # The buffered part is released once it is sent
+        args, _ = provider._contiguous_upload.call_args_list[0]
+        with pytest.raises(ValueError):
+            await args[0].read()
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_large_stream_is_uploaded_by_parts(self, provider, mock_time, monkeypatch):
+        monkeypatch.setattr(provider, 'CHUNK_SIZE', 4)
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+        upload_id = 'EXAMPLEJZ6e0YupT2h66iePQCc9IEbYbDUy4RTpMeoSMLPRp8Z5o1u8feSRonpvnWsKKG35tI2LB9'
+        monkeypatch.setattr(provider, '_create_upload_session',
+                            MockCoroutine(return_value=upload_id))
+        monkeypatch.setattr(provider, '_complete_multipart_upload',
+                            MockCoroutine(return_value=composite_etag([b'slee', b'py'])))
+        for part_number in (1, 2):
+            params = {'partNumber': str(part_number), 'uploadId': upload_id}
+            part_url = provider.bucket.new_key(path.full_path).generate_url(
+                100, 'PUT', query_parameters=params, headers=part_headers(part_number,
+                                                                          part_size=4)
+            )
+            aiohttpretty.register_uri('PUT', part_url, status=200,
+                                      headers={'ETag': '"part{}"'.format(part_number)})
+        hashes = {'sha256': pd_streams.ThreadedHash(hashlib.sha256)}
+
+        size, etag = await provider._streaming_upload(UnsizedStream(b'sleepy'), path,
+                                                      hashes=hashes)
+
+        assert size == 6
+        assert etag == composite_etag([b'slee', b'py'])
+        args, _ = provider._complete_multipart_upload.call_args_list[0]
+        assert [part['ETag'] for part in args[2]] == ['"part1"', '"part2"']
+        assert await hashes['sha256'].hexdigest() == hashlib.sha256(b'sleepy').hexdigest()
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('max_buffer_size,max_parts_in_flight', [
+        (40, 3),
+        (8, 2),
+        # A part larger than the buffer is sent alone
+        (2, 1),
+    ])
+    async def test_parts_bounded_by_their_sizes(self, provider, max_buffer_size,
+                                                max_parts_in_flight, monkeypatch):
+        # The parts may grow up to 16 bytes, but the first ones only have 4
+        provider.settings['multipart_upload'] = {'min_part_size': 4, 'max_part_size': 16}
+        monkeypatch.setattr(provider, 'MULTIPART_CONCURRENCY', 3)
+        monkeypatch.setattr(provider, 'MULTIPART_MAX_BUFFER_SIZE', max_buffer_size)
+        monkeypatch.setattr(provider, '_create_upload_session', MockCoroutine())
+        monkeypatch.setattr(provider, '_complete_multipart_upload',
+                            MockCoroutine(return_value='"opaque-etag"'))
+        in_flight = []
+        max_in_flight = []
+
+        async def upload_part(part, *args, **kwargs):
+            in_flight.append(part.size)
+            max_in_flight.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(part.size)
+            return {'ETAG': '"part"'}
+
+        monkeypatch.setattr(provider, '_upload_part', upload_part)
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+
+        await provider._streaming_upload(UnsizedStream(b'sleepy' * 4), path)
+
+        assert len(max_in_flight) == 6
+        assert max(max_in_flight) == max_parts_in_flight
+
+    def test_unknown_request_size(self):
+        class RequestStream(UnsizedStream):
+            @property
+            def size(self):
+                return int(None)
+
+        assert pd_provider._stream_size(RequestStream(b'sleepy')) is None
+        assert pd_provider._stream_size(UnsizedStream(b'sleepy')) is None
+        assert pd_provider._stream_size(streams.StringStream(b'sleepy')) == 6
+
+
+class TestContentHashes:
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_store_content_hashes(self, provider, copy_object_resp, mock_time):
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+        hashes = {'md5': pd_streams.ThreadedHash(hashlib.md5),
+                  'sha256': pd_streams.ThreadedHash(hashlib.sha256)}
+        for threaded_hash in hashes.values():
+            await threaded_hash.update(b'sleepy')
+        etag = '"{}"'.format(hashlib.md5(b'sleepy').hexdigest())
+        headers = {
+            'x-amz-copy-source': parse.quote('/that kerning/' + path.full_path),
+            'x-amz-copy-source-if-match': etag,
+            'x-amz-meta-md5': hashlib.md5(b'sleepy').hexdigest(),
+            'x-amz-meta-sha256': hashlib.sha256(b'sleepy').hexdigest(),
+            'x-amz-metadata-directive': 'REPLACE',
+        }
+        copy_url = provider.bucket.new_key(path.full_path).generate_url(100, 'PUT',
+                                                                        headers=headers)
+        aiohttpretty.register_uri('PUT', copy_url, status=200, body=copy_object_resp)
+
+        await provider._store_content_hashes(path, 6, hashes, etag)
+
+        assert aiohttpretty.has_call(method='PUT', uri=copy_url)
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('error', [
+        exceptions.IntraCopyError('Not Implemented', code=501),
+        exceptions.MetadataError('Not Found', code=404),
+        asyncio.TimeoutError(),
+    ])
+    async def test_store_content_hashes_fails(self, provider, error, monkeypatch):
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+        monkeypatch.setattr(provider, '_copy_object', MockCoroutine(side_effect=error))
+        hashes = {'md5': pd_streams.ThreadedHash(hashlib.md5)}
+
+        # The upload is kept without the hashes
+        await provider._store_content_hashes(path, 6, hashes, '"etag"')
+
+    @pytest.mark.asyncio
+    async def test_store_content_hashes_without_etag(self, provider, monkeypatch):
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+        monkeypatch.setattr(provider, '_copy_object', MockCoroutine())
+        hashes = {'md5': pd_streams.ThreadedHash(hashlib.md5)}
+
+        await provider._store_content_hashes(path, 6, hashes, None)
+
+        assert provider._copy_object.call_count == 0
+
+
+class TestResumableUpload:
+
+    @pytest.fixture
+    def upload_journal(self, tmpdir, monkeypatch):
+        from s3compat.waterbutler_provider import journal
+        upload_journal = journal.SQLiteUploadJournal(str(tmpdir.join('journal.sqlite3')))
+        monkeypatch.setattr(journal, '_journal', upload_journal)
+        monkeypatch.setattr(pd_settings, 'RESUMABLE_UPLOADS', True)
+        return upload_journal
+
+    @pytest.mark.asyncio
+    async def test_journal_called_off_loop(self, provider, upload_journal, monkeypatch):
+        threads = []
+        monkeypatch.setattr(upload_journal, 'claim',
+                            lambda key: threads.append(threading.get_ident()) or True)
+
+        assert await provider._call_upload_journal('claim', 'key') is True
+        assert threads and threads[0] != threading.get_ident()
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_resume_sends_missing_parts(self, provider, file_stream, upload_journal,
+                                              mock_time, monkeypatch):
+        monkeypatch.setattr(provider, 'CHUNK_SIZE', 2)
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+        upload_id = 'EXAMPLEJZ6e0YupT2h66iePQCc9IEbYbDUy4RTpMeoSMLPRp8Z5o1u8feSRonpvnWsKKG35tI2LB9'
+        journal_key = provider._upload_journal_key(path, 6)
+        first_etag = '"{}"'.format(hashlib.md5(b'sl').hexdigest())
+        upload_journal.start(journal_key, upload_id)
+        upload_journal.add_part(journal_key, 1, first_etag)
+
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+        list_parts_url = generate_url(100, 'GET', query_parameters={'uploadId': upload_id})
+        aiohttpretty.register_uri(
+            'GET', list_parts_url, params={'uploadId': upload_id}, status=200,
+            body='''<?xml version="1.0" encoding="UTF-8"?>
+            <ListPartsResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+                <IsTruncated>false</IsTruncated>
+                <Part><PartNumber>1</PartNumber><ETag>{}</ETag><Size>2</Size></Part>
+            </ListPartsResult>'''.format(first_etag.replace('"', '&quot;'))
+        )
+        for part_number in (2, 3):
+            params = {'partNumber': str(part_number), 'uploadId': upload_id}
+            part_url = generate_url(100, 'PUT', query_parameters=params,
+                                    headers=part_headers(part_number, streamed=True))
+            aiohttpretty.register_uri('PUT', part_url, status=200,
+                                      headers={'ETag': '"part{}"'.format(part_number)})
+        payload = ''.join([
+            '<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUpload>',
+            ''.join(['<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'.format(n, etag)
+                     for n, etag in ((1, first_etag), (2, '"part2"'), (3, '"part3"'))]),
+            '</CompleteMultipartUpload>',
+        ]).encode('utf-8')
+        complete_headers = {
+            'Content-Length': str(len(payload)),
+            'Content-MD5': compute_md5(BytesIO(payload))[1],
+            'Content-Type': 'text/xml',
+        }
+        complete_url = generate_url(100, 'POST', query_parameters={'uploadId': upload_id},
+                                    headers=complete_headers)
+        aiohttpretty.register_uri(
+            'POST', complete_url, status=200,
+            body=complete_upload_body(composite_etag([b'sl', b'ee', b'py'])))
+
+        await provider._chunked_upload(file_stream, path)
+
+        part_url = generate_url(100, 'PUT', query_parameters={'partNumber': '1',
+                                                              'uploadId': upload_id},
+                                headers=part_headers(1))
+        assert not aiohttpretty.has_call(method='PUT', uri=part_url)
+        assert upload_journal.get(journal_key) is None
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_failure_keeps_session(self, provider, file_stream, upload_journal,
+                                         create_session_resp, mock_time, monkeypatch):
+        monkeypatch.setattr(provider, 'CHUNK_SIZE', 2)
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+        upload_id = 'EXAMPLEJZ6e0YupT2h66iePQCc9IEbYbDUy4RTpMeoSMLPRp8Z5o1u8' \
+                    'feSRonpvnWsKKG35tI2LB9VDPiCgTy.Gq2VxQLYjrue4Nq.NBdqI-'
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+        create_url = generate_url(100, 'POST', query_parameters={'uploads': ''})
+        aiohttpretty.register_uri('POST', create_url, status=200, body=create_session_resp)
+        for part_number in (1, 2, 3):
+            params = {'partNumber': str(part_number), 'uploadId': upload_id}
+            part_url = generate_url(100, 'PUT', query_parameters=params,
+                                    headers=part_headers(part_number, streamed=True))
+            aiohttpretty.register_uri('PUT', part_url, status=403 if part_number == 2 else 200,
+                                      headers={'ETag': '"part{}"'.format(part_number)})
+
+        with pytest.raises(exceptions.UploadError):
+            await provider._chunked_upload(file_stream, path)
+
+        journal_key = provider._upload_journal_key(path, 6)
+        assert upload_journal.get(journal_key) == (upload_id, {1: '"part1"'})
+        assert upload_journal.claim(journal_key)
+
+    @pytest.mark.asyncio
+    async def test_claimed_session_not_resumed(self, provider, file_stream, upload_journal,
+                                               monkeypatch):
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+        journal_key = provider._upload_journal_key(path, 6)
+        upload_journal.claim(journal_key)
+        upload_journal.start(journal_key, 'in-use-upload-id')
+        monkeypatch.setattr(provider, '_create_upload_session',
+                            MockCoroutine(return_value='upload-id'))
+        monkeypatch.setattr(provider, '_upload_parts', MockCoroutine(return_value=[]))
+        monkeypatch.setattr(provider, '_complete_multipart_upload',
+                            MockCoroutine(return_value=None))
+
+        await provider._chunked_upload(file_stream, path)
+
+        args, kwargs = provider._upload_parts.call_args_list[0]
+        assert args[2] == 'upload-id'
+        assert kwargs['journal_key'] is None
+        assert upload_journal.get(journal_key) == ('in-use-upload-id', {})
+
+    @pytest.mark.asyncio
+    async def test_expired_sessions_aborted(self, provider, upload_journal, monkeypatch):
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+        journal_key = provider._upload_journal_key(path, 6)
+        upload_journal.start(journal_key, 'expired-upload-id')
+        upload_journal.release(journal_key)
+        monkeypatch.setattr(pd_settings, 'RESUMABLE_UPLOAD_TTL', -1)
+        monkeypatch.setattr(provider, '_abort_chunked_upload', MockCoroutine(return_value=True))
+
+        await provider._abort_expired_upload_sessions()
+
+        args, _ = provider._abort_chunked_upload.call_args_list[0]
+        assert args[0].full_path == path.full_path
+        assert args[1] == 'expired-upload-id'
+        assert upload_journal.expired(provider._upload_journal_prefix()) == []
+
+
+class TestUploadPartRetry:
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_upload_part_retried(self, provider, file_stream, mock_time, monkeypatch):
+        monkeypatch.setattr(provider, 'CHUNK_SIZE', 2)
+        monkeypatch.setattr(pd_settings, 'PART_UPLOAD_RETRY_BACKOFF', 0)
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+        upload_id = 'EXAMPLEJZ6e0YupT2h66iePQCc9IEbYbDUy4RTpMeoSMLPRp8Z5o1u8feSRonpvnWsKKG35tI2LB9'
+
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+        for part_number in (1, 2, 3):
+            params = {'partNumber': str(part_number), 'uploadId': upload_id}
+            streamed_url = generate_url(100, 'PUT', query_parameters=params,
+                                        headers=part_headers(part_number, streamed=True))
+            etag = {'ETag': '"part{}"'.format(part_number)}
+            if part_number == 2:
+                # Retries send the buffered part, with its Content-MD5
+                aiohttpretty.register_uri('PUT', streamed_url, status=503)
+                part_url = generate_url(100, 'PUT', query_parameters=params,
+                                        headers=part_headers(part_number))
+                aiohttpretty.register_uri('PUT', part_url, responses=[
+                    {'status': 500},
+                    {'status': 200, 'headers': etag},
+                ])
+            else:
+                aiohttpretty.register_uri('PUT', streamed_url, status=200, headers=etag)
+
+        parts_metadata = await provider._upload_parts(file_stream, path, upload_id)
+
+        assert [part['ETag'] for part in parts_metadata] == ['"part1"', '"part2"', '"part3"']
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_upload_part_retries_exhausted(self, provider, file_stream, mock_time,
+                                                 monkeypatch):
+        monkeypatch.setattr(provider, 'CHUNK_SIZE', 6)
+        monkeypatch.setattr(pd_settings, 'PART_UPLOAD_RETRY_BACKOFF', 0)
+        monkeypatch.setattr(pd_settings, 'PART_UPLOAD_MAX_RETRIES', 1)
+        path = WaterButlerPath('/foobah', prepend=provider.prefix)
+        upload_id = 'EXAMPLEJZ6e0YupT2h66iePQCc9IEbYbDUy4RTpMeoSMLPRp8Z5o1u8feSRonpvnWsKKG35tI2LB9'
+
+        params = {'partNumber': '1', 'uploadId': upload_id}
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+        streamed_url = generate_url(100, 'PUT', query_parameters=params,
+                                    headers=part_headers(1, part_size=6, streamed=True))
+        aiohttpretty.register_uri('PUT', streamed_url, status=503)
+        part_url = generate_url(100, 'PUT', query_parameters=params,
+                                headers=part_headers(1, part_size=6))
+        aiohttpretty.register_uri('PUT', part_url, responses=[
+            {'status': 503},
+            {'status': 200, 'headers': {'ETag': '"part1"'}},
+        ])
+
+        with pytest.raises(exceptions.UploadError) as exc:
+            await provider._upload_parts(file_stream, path, upload_id)
+
+        assert exc.value.code == 503
+
+
+class TestMetadataCache:
+
+    def test_cache_key_per_credentials(self, auth, credentials, settings):
+        provider = S3CompatProvider(auth, credentials, settings)
+        same_user = S3CompatProvider(auth, dict(credentials), settings)
+        other_user = S3CompatProvider(auth, dict(credentials, secret_key='other'), settings)
+
+        assert provider._cache_key('a') == same_user._cache_key('a')
+        assert provider._cache_key('a') != other_user._cache_key('a')
+        assert credentials['secret_key'] not in provider._cache_key('a')
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_validate_then_metadata(self, provider, file_header_metadata, mock_time):
+        path = WaterButlerPath('/muhtriangle', prepend=provider.prefix)
+        head_url = provider.bucket.new_key(path.full_path).generate_url(100, 'HEAD')
+        aiohttpretty.register_uri('HEAD', head_url, responses=[
+            {'status': 200, 'headers': file_header_metadata},
+            {'status': 500},
+        ])
+
+        await provider.validate_v1_path('/muhtriangle')
+        file_metadata = await provider.metadata(path)
+
+        assert file_metadata.size == '9001'
+        assert get_metadata_cache().stats()['hits'] == 1
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_concurrent_requests_are_shared(self, provider, file_header_metadata,
+                                                  mock_time, monkeypatch):
+        monkeypatch.setattr(get_metadata_cache(), 'ttl', 0)
+        path = WaterButlerPath('/muhtriangle', prepend=provider.prefix)
+        head_url = provider.bucket.new_key(path.full_path).generate_url(100, 'HEAD')
+        aiohttpretty.register_uri('HEAD', head_url, responses=[
+            {'status': 200, 'headers': file_header_metadata},
+            {'status': 500},
+        ])
+
+        results = await asyncio.gather(*[provider.metadata(path) for _ in range(3)])
+
+        assert [result.size for result in results] == ['9001'] * 3
+
+    @pytest.mark.asyncio
+    async def test_requests_of_other_users_are_not_shared(self, auth, credentials, settings,
+                                                          monkeypatch):
+        monkeypatch.setattr(get_metadata_cache(), 'ttl', 0)
+        providers = [
+            S3CompatProvider(auth, credentials, settings),
+            S3CompatProvider(auth, dict(credentials, secret_key='other'), settings),
+        ]
+        calls = []
+
+        async def fetch():
+            calls.append(None)
+            await asyncio.sleep(0.01)
+            return {'Etag': '"a"'}
+
+        await asyncio.gather(*[provider._cached_metadata(provider._cache_key('a'), fetch)
+                               for provider in providers for _ in range(2)])
+
+        assert len(calls) == 2
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('written,cached', [('b', True), ('a', False), ('', False)])
+    async def test_written_while_fetched(self, provider, written, cached):
+        async def fetch():
+            # Written while it is fetched, through any provider
+            await provider._invalidate_metadata(written, recursive=True)
+            return {'Etag': '"a"'}
+
+        await provider._cached_metadata(provider._cache_key('a'), fetch)
+
+        assert (get_metadata_cache().get(provider._cache_key('a')) is not None) is cached
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_versions_are_cached_apart(self, provider, file_header_metadata, mock_time):
+        path = WaterButlerPath('/muhtriangle', prepend=provider.prefix)
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+        aiohttpretty.register_uri('HEAD', generate_url(100, 'HEAD'),
+                                  headers=file_header_metadata)
+        version_url = generate_url(100, 'HEAD', query_parameters={'versionId': 'someversion'})
+        aiohttpretty.register_uri('HEAD', version_url, headers={**file_header_metadata,
+                                                                'Content-Length': '9'})
+
+        assert (await provider.metadata(path)).size == '9001'
+        assert (await provider.metadata(path, revision='someversion')).size == '9'
+        assert get_metadata_cache().stats()['hits'] == 0
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_delete_invalidates(self, provider, file_header_metadata, mock_time):
+        path = WaterButlerPath('/muhtriangle', prepend=provider.prefix)
+        generate_url = provider.bucket.new_key(path.full_path).generate_url
+        aiohttpretty.register_uri('HEAD', generate_url(100, 'HEAD'), responses=[
+            {'status': 200, 'headers': file_header_metadata},
+            {'status': 404},
+        ])
+        aiohttpretty.register_uri('DELETE', generate_url(100, 'DELETE'), status=204)
+
+        await provider.metadata(path)
+        await provider.delete(path)
+
+        with pytest.raises(exceptions.MetadataError):
+            await provider.metadata(path)
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    @pytest.mark.usefixtures('list_objects_v1')
+    async def test_folder_listing(self, provider, folder_metadata, mock_time):
+        path = WaterButlerPath('/darp/', prepend=provider.prefix)
+        url = provider.bucket.generate_url(100)
+        params = {'prefix': path.full_path.lstrip('/'), 'delimiter': '/', 'max-keys': '1000'}
+        aiohttpretty.register_uri('GET', url, params=params, responses=[
+            {'status': 200, 'body': folder_metadata,
+             'headers': {'Content-Type': 'application/xml'}},
+            {'status': 500},
+        ])
+
+        first = await provider.metadata(path)
+        second = await provider.metadata(path)
+
+        assert [item.path for item in first] == [item.path for item in second]
+
+
+class TestListObjectsV2:
+
+    def v2_params(self, prefix, **params):
+        return dict(params, prefix=prefix, **{'list-type': '2', 'fetch-owner': 'false'})
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_delete_folder(self, provider, mock_time):
+        path = WaterButlerPath('/thisfolder/', prepend=provider.prefix)
+        first_page = ['thisfolder/item1']
+        second_page = ['thisfolder/item2']
+        prefix = path.full_path.lstrip('/')
+
+        list_url = provider.bucket.generate_url(100, 'GET')
+        aiohttpretty.register_uri('GET', list_url, params=self.v2_params(prefix),
+                                  body=list_objects_response(first_page, truncated=True,
+                                                             v2=True, next_token='1ueGcxLPRx'))
+        aiohttpretty.register_uri('GET', list_url,
+                                  params=self.v2_params(prefix,
+                                                        **{'continuation-token': '1ueGcxLPRx'}),
+                                  body=list_objects_response(second_page, v2=True))
+        for keys in (first_page, second_page):
+            aiohttpretty.register_uri('POST', bulk_delete_url(provider, keys), status=200,
+                                      body=delete_result_response())
+
+        await provider.delete(path)
+
+        for keys in (first_page, second_page):
+            assert aiohttpretty.has_call(method='POST', uri=bulk_delete_url(provider, keys))
+        assert pd_provider._endpoint_capabilities[provider.endpoint]['list_objects_v2'] is True
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    @pytest.mark.parametrize('v2_response', [
+        {'status': 400},
+        {'status': 200, 'body': list_objects_response(['folder/item1'])},
+    ])
+    async def test_fallback(self, provider, v2_response, mock_time):
+        list_url = provider.bucket.generate_url(100, 'GET')
+        aiohttpretty.register_uri('GET', list_url, params=self.v2_params('folder/'),
+                                  **v2_response)
+        aiohttpretty.register_uri('GET', list_url, params={'prefix': 'folder/'},
+                                  body=list_objects_response(['folder/item1']))
+
+        contents, prefixes, token = await provider._list_objects('folder/')
+
+        assert [content['Key'] for content in contents] == ['folder/item1']
+        assert token is None
+        assert pd_provider._endpoint_capabilities[provider.endpoint]['list_objects_v2'] is False
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_error_once_supported(self, provider, mock_time):
+        provider._set_capability('list_objects_v2', True)
+        list_url = provider.bucket.generate_url(100, 'GET')
+        aiohttpretty.register_uri('GET', list_url, params=self.v2_params('folder/'), status=400)
+
+        with pytest.raises(exceptions.MetadataError):
+            await provider._list_objects('folder/')
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    @pytest.mark.usefixtures('list_objects_v1')
+    async def test_v1_without_next_marker(self, provider, mock_time):
+        list_url = provider.bucket.generate_url(100, 'GET')
+        aiohttpretty.register_uri('GET', list_url, params={'prefix': 'folder/', 'marker': 'a'},
+                                  body=list_objects_response(['folder/item1', 'folder/item2'],
+                                                             truncated=True))
+
+        contents, prefixes, token = await provider._list_objects('folder/', start_after='a')
+
+        assert token == 'folder/item2'
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    @pytest.mark.usefixtures('list_objects_v1')
+    async def test_v1_prefixes_without_next_marker(self, provider, mock_time):
+        list_url = provider.bucket.generate_url(100, 'GET')
+        body = list_objects_response([], truncated=True).replace(
+            b'</ListBucketResult>',
+            b'<CommonPrefixes><Prefix>folder/sub/</Prefix></CommonPrefixes></ListBucketResult>')
+        aiohttpretty.register_uri('GET', list_url, params={'prefix': 'folder/', 'delimiter': '/'},
+                                  body=body)
+
+        contents, prefixes, token = await provider._list_objects('folder/', delimiter='/')
+
+        assert prefixes == [{'Prefix': 'folder/sub/'}]
+        assert token == 'folder/sub/'
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    @pytest.mark.usefixtures('list_objects_v1')
+    async def test_v1_empty_truncated_page(self, provider, mock_time):
+        list_url = provider.bucket.generate_url(100, 'GET')
+        aiohttpretty.register_uri('GET', list_url, params={'prefix': 'folder/'},
+                                  body=list_objects_response([], truncated=True))
+
+        contents, prefixes, token = await provider._list_objects('folder/')
+
+        assert contents == []
+        assert token is None
+
+
+@pytest.mark.usefixtures('list_objects_v1')
+class TestWalk:
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_walk(self, provider, mock_time):
+        path = WaterButlerPath('/thisfolder/', prepend=provider.prefix)
+        first_page = ['thisfolder/', 'thisfolder/a', 'thisfolder/b/']
+        second_page = ['thisfolder/c/d/e', 'thisfolder/c/f']
+        prefix = path.full_path.lstrip('/')
+
+        list_url = provider.bucket.generate_url(100, 'GET')
+        aiohttpretty.register_uri('GET', list_url, params={'prefix': prefix},
+                                  body=list_objects_response(first_page, truncated=True))
+        aiohttpretty.register_uri('GET', list_url,
+                                  params={'prefix': prefix, 'marker': first_page[-1]},
+                                  body=list_objects_response(second_page))
+
+        items = [item async for item in provider.walk(path)]
+
+        assert [(item.kind, item.path) for item in items] == [
+            ('file', '/thisfolder/a'),
+            ('folder', '/thisfolder/b/'),
+            ('folder', '/thisfolder/c/'),
+            ('folder', '/thisfolder/c/d/'),
+            ('file', '/thisfolder/c/d/e'),
+            ('file', '/thisfolder/c/f'),
+        ]
+        assert isinstance(items[1], S3CompatFolderKeyMetadata)
+        assert isinstance(items[2], S3CompatFolderMetadata)
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_zip_entries(self, provider, mock_time):
+        path = WaterButlerPath('/thisfolder/', prepend=provider.prefix)
+        keys = ['thisfolder/', 'thisfolder/a', 'thisfolder/b/', 'thisfolder/c/d']
+        prefix = path.full_path.lstrip('/')
+
+        list_url = provider.bucket.generate_url(100, 'GET')
+        aiohttpretty.register_uri('GET', list_url, params={'prefix': prefix},
+                                  body=list_objects_response(keys))
+        for key, body in (('thisfolder/a', b'a'), ('thisfolder/c/d', b'd')):
+            url = provider.bucket.new_key(key).generate_url(100)
+            aiohttpretty.register_uri('GET', url[:url.index('?')], body=body, auto_length=True)
+
+        entries = [(name, await stream.read())
+                   async for name, stream in provider._zip_entries(path)]
+
+        assert entries == [('a', b'a'), ('b/', b''), ('c/d', b'd')]
+
+
+class TestNegativeCache:
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_missing_key(self, provider, file_header_metadata, mock_time):
+        head_url = provider.bucket.new_key('muhtriangle').generate_url(100, 'HEAD')
+        aiohttpretty.register_uri('HEAD', head_url, responses=[
+            {'status': 404},
+            {'status': 200, 'headers': file_header_metadata},
+        ])
+
+        for _ in range(2):
+            with pytest.raises(exceptions.NotFoundError):
+                await provider.validate_v1_path('/muhtriangle')
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_write_clears(self, provider, file_header_metadata, mock_time):
+        head_url = provider.bucket.new_key('muhtriangle').generate_url(100, 'HEAD')
+        aiohttpretty.register_uri('HEAD', head_url, responses=[
+            {'status': 404},
+            {'status': 200, 'headers': file_header_metadata},
+        ])
+
+        with pytest.raises(exceptions.NotFoundError):
+            await provider.validate_v1_path('/muhtriangle')
+        await provider._invalidate_metadata('muhtriangle')
+
+        await provider.validate_v1_path('/muhtriangle')
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_create_folder_clears(self, provider, mock_time):
+        path = WaterButlerPath('/newfolder/', prepend=provider.prefix)
+        get_negative_cache().add(provider._negative_cache_key(path.full_path),
+                                 provider.credentials_digest)
+        url = provider.bucket.new_key(path.full_path).generate_url(100, 'PUT')
+        aiohttpretty.register_uri('PUT', url, status=200)
+
+        await provider.create_folder(path, folder_precheck=False)
+
+        assert not get_negative_cache().contains(provider._negative_cache_key(path.full_path),
+                                                 provider.credentials_digest)
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_disabled(self, provider, file_header_metadata, mock_time, monkeypatch):
+        monkeypatch.setattr(pd_settings, 'NEGATIVE_CACHE_TTL', 0)
+        head_url = provider.bucket.new_key('muhtriangle').generate_url(100, 'HEAD')
+        aiohttpretty.register_uri('HEAD', head_url, responses=[
+            {'status': 404},
+            {'status': 200, 'headers': file_header_metadata},
+        ])
+
+        with pytest.raises(exceptions.NotFoundError):
+            await provider.validate_v1_path('/muhtriangle')
+        await provider.validate_v1_path('/muhtriangle')
+
+
+class TestSignatureV4:
+
+    @pytest.fixture
+    def v4_provider(self, auth, credentials, settings):
+        settings['signature_version'] = '4'
+        settings['region'] = 'jp-east-1'
+        return S3CompatProvider(auth, credentials, settings)
+
+    def test_signature_version(self, provider, v4_provider):
+        assert provider.signer is None
+        assert v4_provider.signer.region == 'jp-east-1'
+
+    def test_url_for(self, v4_provider, mock_time):
+        url = v4_provider._url_for('my key')(100, 'HEAD', query_parameters={'versionId': 'v'})
+
+        parsed = parse.urlsplit(url)
+        query = parse.parse_qs(parsed.query)
+        assert parsed.scheme == 'https'
+        assert parsed.netloc == 'Target Host'
+        assert parsed.path == '/that%20kerning/my%20key'
+        assert query['versionId'] == ['v']
+        assert query['X-Amz-Credential'] == ['Dont dead/20160205/jp-east-1/s3/aws4_request']
+        assert query['X-Amz-Expires'] == ['100']
+        assert 'X-Amz-Signature' in query
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_params_are_signed(self, v4_provider, folder_metadata, mock_time):
+        params = {'prefix': 'folder/', 'delimiter': '/'}
+        url = v4_provider._url_for()(100, 'GET', params=params)
+        aiohttpretty.register_uri('GET', url, body=folder_metadata,
+                                  headers={'Content-Type': 'application/xml'})
+
+        await v4_provider.validate_v1_path('/folder/')
+
+        assert aiohttpretty.has_call(method='GET', uri=url)
+
+    @pytest.mark.asyncio
+    @pytest.mark.aiohttpretty
+    async def test_download(self, v4_provider, mock_time):
+        path = WaterButlerPath('/muhtriangle', prepend=v4_provider.prefix)
+        url = v4_provider._url_for(path.full_path)(
+            100, 'GET',
+            response_headers={'response-content-disposition': make_disposition('muhtriangle')})
+        aiohttpretty.register_uri('GET', url, body=b'delicious', auto_length=True)
+
+        result = await v4_provider.download(path)
+
+        assert await result.read() == b'delicious'
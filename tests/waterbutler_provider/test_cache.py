@@ -0,0 +1,272 @@
+"""Test the metadata cache of the S3 Compatible Storage provider"""
+import asyncio
+import sqlite3
+
+import pytest
+
+from s3compat.waterbutler_provider import cache as pd_cache
+
+
+@pytest.fixture
+def metadata_cache():
+    return pd_cache.MetadataCache(60, 3)
+
+
+class TestMetadataCache:
+
+    def test_get_set(self, metadata_cache):
+        assert metadata_cache.get(('host', 'bucket', 'a', None, 'user')) is None
+        metadata_cache.set(('host', 'bucket', 'a', None, 'user'), {'Etag': '"a"'})
+
+        assert metadata_cache.get(('host', 'bucket', 'a', None, 'user')) == {'Etag': '"a"'}
+        assert metadata_cache.stats() == {'hits': 1, 'misses': 1, 'entries': 1}
+
+    def test_expiry(self, metadata_cache, monkeypatch):
+        metadata_cache.set(('host', 'bucket', 'a', None, 'user'), 'a')
+        monotonic = pd_cache.time.monotonic() + 61
+        monkeypatch.setattr(pd_cache.time, 'monotonic', lambda: monotonic)
+
+        assert metadata_cache.get(('host', 'bucket', 'a', None, 'user')) is None
+        assert len(metadata_cache) == 0
+
+    def test_disabled(self):
+        metadata_cache = pd_cache.MetadataCache(0, 3)
+        metadata_cache.set(('host', 'bucket', 'a', None, 'user'), 'a')
+
+        assert metadata_cache.get(('host', 'bucket', 'a', None, 'user')) is None
+
+    def test_lru_eviction(self, metadata_cache):
+        for key in 'abc':
+            metadata_cache.set(('host', 'bucket', key, None, 'user'), key)
+        metadata_cache.get(('host', 'bucket', 'a', None, 'user'))
+        metadata_cache.set(('host', 'bucket', 'd', None, 'user'), 'd')
+
+        assert metadata_cache.get(('host', 'bucket', 'b', None, 'user')) is None
+        assert metadata_cache.get(('host', 'bucket', 'a', None, 'user')) == 'a'
+        assert len(metadata_cache) == 3
+
+    def test_invalidate(self):
+        metadata_cache = pd_cache.MetadataCache(60, 100)
+        keys = [
+            ('host', 'bucket', 'A/B/c', None, 'user'),
+            ('host', 'bucket', 'A/B/c', 'version', 'user'),
+            ('host', 'bucket', 'A/B/', pd_cache.listing_variant(), 'user'),
+            ('host', 'bucket', 'A/', pd_cache.listing_variant('A/0'), 'user'),
+            ('host', 'bucket', '', pd_cache.listing_variant(), 'user'),
+            ('host', 'bucket', 'A/B/d', None, 'user'),
+            ('host', 'bucket', 'A/B/', None, 'user'),
+            ('host', 'other', 'A/B/c', None, 'user'),
+        ]
+        for key in keys:
+            metadata_cache.set(key, 'value')
+
+        metadata_cache.invalidate('host', 'bucket', 'A/B/c')
+
+        assert [key for key in keys if metadata_cache.get(key)] == keys[5:]
+
+    def test_invalidate_recursive(self):
+        metadata_cache = pd_cache.MetadataCache(60, 100)
+        keys = [
+            ('host', 'bucket', 'A/B/c', None, 'user'),
+            ('host', 'bucket', 'A/B/', pd_cache.listing_variant(), 'user'),
+            ('host', 'bucket', 'A/', pd_cache.listing_variant(), 'user'),
+            ('host', 'bucket', 'A/Bc', None, 'user'),
+        ]
+        for key in keys:
+            metadata_cache.set(key, 'value')
+
+        metadata_cache.invalidate('host', 'bucket', 'A/B/', recursive=True)
+
+        assert [key for key in keys if metadata_cache.get(key)] == keys[3:]
+        assert metadata_cache.generation == 1
+
+    def test_changed_since(self):
+        metadata_cache = pd_cache.MetadataCache(60, 100)
+        generation = metadata_cache.generation
+        listing = ('host', 'bucket', 'A/', pd_cache.listing_variant(), 'user')
+
+        metadata_cache.invalidate('host', 'other-bucket', 'A/c')
+        metadata_cache.invalidate('host', 'bucket', 'B/c')
+
+        # Other keys do not count
+        assert not metadata_cache.changed_since(('host', 'bucket', 'A/c', None, 'user'),
+                                                generation)
+        assert not metadata_cache.changed_since(listing, generation)
+
+        metadata_cache.invalidate('host', 'bucket', 'A/c')
+
+        assert metadata_cache.changed_since(('host', 'bucket', 'A/c', None, 'other-user'),
+                                            generation)
+        assert metadata_cache.changed_since(listing, generation)
+        assert not metadata_cache.changed_since(('host', 'bucket', 'A/d', None, 'user'),
+                                                generation)
+        assert not metadata_cache.changed_since(listing, metadata_cache.generation)
+
+    def test_changed_since_recursive(self):
+        metadata_cache = pd_cache.MetadataCache(60, 100)
+        generation = metadata_cache.generation
+
+        metadata_cache.invalidate('host', 'bucket', 'A/', recursive=True)
+
+        assert metadata_cache.changed_since(('host', 'bucket', 'A/B/c', None, 'user'),
+                                            generation)
+        assert not metadata_cache.changed_since(('host', 'bucket', 'Ac', None, 'user'),
+                                                generation)
+
+    def test_changed_since_forgotten(self):
+        metadata_cache = pd_cache.MetadataCache(60, 2)
+        generation = metadata_cache.generation
+
+        metadata_cache.invalidate('host', 'bucket', 'a')
+        metadata_cache.invalidate('host', 'bucket', 'b')
+        metadata_cache.invalidate('host', 'bucket', 'c')
+
+        # Whether 'a' changed is no longer known
+        assert metadata_cache.changed_since(('host', 'bucket', 'd', None, 'user'), generation)
+        assert not metadata_cache.changed_since(('host', 'bucket', 'd', None, 'user'),
+                                                metadata_cache.generation)
+
+    def test_invalidate_all_credentials(self):
+        metadata_cache = pd_cache.MetadataCache(60, 100)
+        keys = [
+            ('host', 'bucket', 'A/c', None, 'user'),
+            ('host', 'bucket', 'A/c', None, 'other-user'),
+            ('host', 'bucket', 'A/', pd_cache.listing_variant(), 'other-user'),
+        ]
+        for key in keys:
+            metadata_cache.set(key, 'value')
+
+        metadata_cache.invalidate('host', 'bucket', 'A/c')
+
+        assert [key for key in keys if metadata_cache.get(key)] == []
+
+    def test_index_follows_entries(self):
+        metadata_cache = pd_cache.MetadataCache(60, 2)
+        for key in ('A/B/c', 'A/d', 'e'):
+            metadata_cache.set(('host', 'bucket', key, None, 'user'), 'value')
+
+        # 'A/B/c' has been evicted
+        assert set(metadata_cache._by_key) == {('host', 'bucket', 'A/d'),
+                                               ('host', 'bucket', 'e')}
+        assert metadata_cache._by_folder == {('host', 'bucket', 'A/'): {'A/d'},
+                                             ('host', 'bucket', ''): {'A/d', 'e'}}
+
+        metadata_cache.invalidate('host', 'bucket', '', recursive=True)
+
+        assert len(metadata_cache) == 0
+        assert metadata_cache._by_key == {}
+        assert metadata_cache._by_folder == {}
+
+    @pytest.mark.parametrize('key,expected', [
+        ('A/B/c', ['A/B/', 'A/', '']),
+        ('A/B/', ['A/', '']),
+        ('c', ['']),
+    ])
+    def test_parent_prefixes(self, key, expected):
+        assert pd_cache.parent_prefixes(key) == expected
+
+
+class TestSingleFlight:
+
+    @pytest.mark.asyncio
+    async def test_shared(self):
+        single_flight = pd_cache.SingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(None)
+            await asyncio.sleep(0.01)
+            return {'Etag': '"a"'}
+
+        results = await asyncio.gather(*[single_flight.run('a', fetch) for _ in range(3)],
+                                       single_flight.run('b', fetch))
+
+        assert results == [{'Etag': '"a"'}] * 4
+        assert len(calls) == 2
+        assert single_flight.shared == 2
+        assert len(single_flight) == 0
+
+        # Calls after the fetch completed fetch again
+        await single_flight.run('a', fetch)
+        assert len(calls) == 3
+
+    @pytest.mark.asyncio
+    async def test_error_is_shared(self):
+        single_flight = pd_cache.SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            raise ValueError('failed')
+
+        results = await asyncio.gather(single_flight.run('a', fetch),
+                                       single_flight.run('a', fetch), return_exceptions=True)
+
+        assert [type(result) for result in results] == [ValueError, ValueError]
+
+    @pytest.mark.asyncio
+    async def test_cancelled_caller(self):
+        single_flight = pd_cache.SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            return 'a'
+
+        first = asyncio.ensure_future(single_flight.run('a', fetch))
+        second = asyncio.ensure_future(single_flight.run('a', fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+
+        assert await second == 'a'
+
+
+class TestNegativeCache:
+
+    @pytest.fixture(params=['memory', 'sqlite'])
+    def negative_cache(self, request, tmpdir):
+        return pd_cache.NEGATIVE_CACHE_BACKENDS[request.param](str(tmpdir.join('negative.db')))
+
+    def test_add_discard(self, negative_cache):
+        assert not negative_cache.contains('host/bucket/a', 'user')
+        negative_cache.add('host/bucket/a', 'user')
+        negative_cache.add('host/bucket/a', 'other-user')
+        negative_cache.add('host/bucket/b/', 'user')
+
+        assert negative_cache.contains('host/bucket/a', 'user')
+        negative_cache.discard(['host/bucket/a', 'host/bucket/c'])
+        assert not negative_cache.contains('host/bucket/a', 'user')
+        assert not negative_cache.contains('host/bucket/a', 'other-user')
+        assert negative_cache.contains('host/bucket/b/', 'user')
+
+        negative_cache.clear()
+        assert not negative_cache.contains('host/bucket/b/', 'user')
+
+    def test_per_credentials(self, negative_cache):
+        negative_cache.add('host/bucket/a', 'user')
+
+        assert negative_cache.contains('host/bucket/a', 'user')
+        assert not negative_cache.contains('host/bucket/a', 'other-user')
+
+    def test_expiry(self, negative_cache, monkeypatch):
+        monkeypatch.setattr(pd_cache.settings, 'NEGATIVE_CACHE_TTL', -1)
+        negative_cache.add('host/bucket/a', 'user')
+
+        assert not negative_cache.contains('host/bucket/a', 'user')
+
+    def test_shared_between_instances(self, tmpdir):
+        path = str(tmpdir.join('negative.db'))
+        pd_cache.SQLiteNegativeCache(path).add('host/bucket/a', 'user')
+
+        other = pd_cache.SQLiteNegativeCache(path)
+        assert other.contains('host/bucket/a', 'user')
+        other.discard(['host/bucket/a'])
+        assert not pd_cache.SQLiteNegativeCache(path).contains('host/bucket/a', 'user')
+
+    def test_previous_table_replaced(self, tmpdir):
+        path = str(tmpdir.join('negative.db'))
+        with sqlite3.connect(path) as connection:
+            connection.execute('CREATE TABLE missing (key TEXT PRIMARY KEY, expiry REAL)')
+
+        negative_cache = pd_cache.SQLiteNegativeCache(path)
+        negative_cache.add('host/bucket/a', 'user')
+
+        assert negative_cache.contains('host/bucket/a', 'user')
@@ -0,0 +1,133 @@
+"""Test the multipart upload journal backends"""
+import time
+from unittest import mock
+
+import pytest
+
+from s3compat.waterbutler_provider import journal
+
+
+@pytest.fixture(params=['sqlite', 'file'])
+def upload_journal(request, tmpdir):
+    if request.param == 'sqlite':
+        return journal.SQLiteUploadJournal(str(tmpdir.join('journal.sqlite3')))
+    return journal.FileUploadJournal(str(tmpdir.join('journal')))
+
+
+class TestUploadJournal:
+
+    def test_blocking(self, upload_journal):
+        # Both backends do I/O, which the provider keeps off the loop
+        assert upload_journal.blocking is True
+
+    def test_get_unknown(self, upload_journal):
+        assert upload_journal.get('host:443/bucket/key:100') is None
+
+    def test_record_parts(self, upload_journal):
+        key = 'host:443/bucket/key:100'
+        upload_journal.start(key, 'upload-id')
+        upload_journal.add_part(key, 1, '"etag1"')
+        upload_journal.add_part(key, 2, '"etag2"')
+
+        assert upload_journal.get(key) == ('upload-id', {1: '"etag1"', 2: '"etag2"'})
+
+    def test_start_replaces_session(self, upload_journal):
+        key = 'host:443/bucket/key:100'
+        upload_journal.start(key, 'upload-id')
+        upload_journal.add_part(key, 1, '"etag1"')
+
+        assert upload_journal.start(key, 'other-upload-id') == 'upload-id'
+        assert upload_journal.get(key) == ('other-upload-id', {})
+
+    def test_start_new_session(self, upload_journal):
+        assert upload_journal.start('host:443/bucket/key:100', 'upload-id') is None
+
+    def test_claim(self, upload_journal):
+        key = 'host:443/bucket/key:100'
+        assert upload_journal.claim(key)
+        assert not upload_journal.claim(key)
+        assert upload_journal.claim('host:443/bucket/key:200')
+
+        upload_journal.release(key)
+
+        assert upload_journal.claim(key)
+
+    def test_claim_kept_by_session(self, upload_journal):
+        key = 'host:443/bucket/key:100'
+        upload_journal.claim(key)
+        upload_journal.start(key, 'upload-id')
+        upload_journal.add_part(key, 1, '"etag1"')
+        upload_journal.remove(key)
+
+        assert not upload_journal.claim(key)
+
+        upload_journal.release(key)
+
+        assert upload_journal.claim(key)
+
+    def test_release_keeps_session(self, upload_journal):
+        key = 'host:443/bucket/key:100'
+        upload_journal.claim(key)
+        upload_journal.start(key, 'upload-id')
+        upload_journal.add_part(key, 1, '"etag1"')
+        upload_journal.release(key)
+
+        assert upload_journal.get(key) == ('upload-id', {1: '"etag1"'})
+
+    def test_lease_runs_out(self, upload_journal, monkeypatch):
+        key = 'host:443/bucket/key:100'
+        monkeypatch.setattr(journal.settings, 'UPLOAD_JOURNAL_LEASE', 60)
+        upload_journal.claim(key)
+
+        with mock.patch('time.time', return_value=time.time() + 61):
+            assert upload_journal.claim(key)
+
+    def test_remove(self, upload_journal):
+        key = 'host:443/bucket/key:100'
+        upload_journal.start(key, 'upload-id')
+        upload_journal.remove(key)
+        upload_journal.remove(key)
+
+        assert upload_journal.get(key) is None
+
+    def test_expired(self, upload_journal, monkeypatch):
+        key = 'host:443/bucket/key:100'
+        upload_journal.start(key, 'upload-id')
+        monkeypatch.setattr(journal.settings, 'RESUMABLE_UPLOAD_TTL', 60)
+
+        with mock.patch('time.time', return_value=time.time() + 61):
+            assert upload_journal.get(key) is None
+
+    def test_list_expired(self, upload_journal, monkeypatch):
+        key = 'host:443/bucket/key:100'
+        upload_journal.start(key, 'upload-id')
+        upload_journal.release(key)
+        upload_journal.start('host:443/other/key:100', 'other-upload-id')
+        upload_journal.release('host:443/other/key:100')
+        monkeypatch.setattr(journal.settings, 'RESUMABLE_UPLOAD_TTL', 60)
+
+        assert upload_journal.expired('host:443/bucket/') == []
+        with mock.patch('time.time', return_value=time.time() + 61):
+            assert upload_journal.expired('host:443/bucket/') == [(key, 'upload-id')]
+
+    def test_claimed_not_expired(self, upload_journal, monkeypatch):
+        key = 'host:443/bucket/key:100'
+        monkeypatch.setattr(journal.settings, 'RESUMABLE_UPLOAD_TTL', 60)
+        monkeypatch.setattr(journal.settings, 'UPLOAD_JOURNAL_LEASE', 120)
+        upload_journal.claim(key)
+        upload_journal.start(key, 'upload-id')
+
+        with mock.patch('time.time', return_value=time.time() + 61):
+            assert upload_journal.expired('host:443/bucket/') == []
+
+
+class TestGetUploadJournal:
+
+    def test_custom_backend(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(journal, '_journal', None)
+        monkeypatch.setattr(journal.settings, 'UPLOAD_JOURNAL',
+                            's3compat.waterbutler_provider.journal.FileUploadJournal')
+        monkeypatch.setattr(journal.settings, 'UPLOAD_JOURNAL_PATH', str(tmpdir))
+
+        assert isinstance(journal.get_upload_journal(), journal.FileUploadJournal)
+        assert journal.get_upload_journal() is journal.get_upload_journal()
@@ -0,0 +1,165 @@
+"""Test the listing parser of the S3 Compatible Storage provider"""
+import pytest
+
+from s3compat.waterbutler_provider import listing as pd_listing
+
+
+LIST_BUCKET_RESULT = b'''<?xml version="1.0" encoding="UTF-8"?>
+<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+    <Name>bucket</Name>
+    <Prefix>photos/</Prefix>
+    <Marker></Marker>
+    <NextMarker>photos/2006/</NextMarker>
+    <IsTruncated>true</IsTruncated>
+    <Contents>
+        <Key>photos/ a &amp; b.jpg</Key>
+        <ETag>&quot;fba9dede5f27731c9771645a39863328&quot;</ETag>
+        <Size>434234</Size>
+        <Owner>
+            <ID>75aa57f09aa0c8caeab4f8c24e99d10f8e7faeebf76c078efc7c6caea54ba06a</ID>
+            <DisplayName>mtd@amazon.com</DisplayName>
+        </Owner>
+    </Contents>
+    <Contents>
+        <Key>photos/</Key>
+        <Size>0</Size>
+    </Contents>
+    <CommonPrefixes>
+        <Prefix>photos/2006/</Prefix>
+    </CommonPrefixes>
+</ListBucketResult>'''
+
+
+class MockContent:
+
+    def __init__(self, body, chunk_size):
+        self.body = body
+        self.chunk_size = chunk_size
+
+    async def read(self, size):
+        chunk, self.body = self.body[:self.chunk_size], self.body[self.chunk_size:]
+        return chunk
+
+
+class MockResponse:
+
+    def __init__(self, body, chunk_size=7):
+        self.content = MockContent(body, chunk_size)
+
+
+class TestListingParser:
+
+    def test_feed(self):
+        parser = pd_listing.ListingParser()
+        records = parser.feed(LIST_BUCKET_RESULT, final=True)
+
+        assert parser.root == 'ListBucketResult'
+        assert parser.fields['IsTruncated'] == 'true'
+        assert parser.fields['NextMarker'] == 'photos/2006/'
+        assert parser.fields['Marker'] is None
+        assert [element for element, record in records] == \
+            ['Contents', 'Contents', 'CommonPrefixes']
+
+        content = records[0][1]
+        assert content['Key'] == 'photos/ a & b.jpg'
+        assert content['ETag'] == '"fba9dede5f27731c9771645a39863328"'
+        assert content['Owner'] == {
+            'ID': '75aa57f09aa0c8caeab4f8c24e99d10f8e7faeebf76c078efc7c6caea54ba06a',
+            'DisplayName': 'mtd@amazon.com',
+        }
+        assert records[2][1] == {'Prefix': 'photos/2006/'}
+
+    def test_feed_chunks(self):
+        parser = pd_listing.ListingParser()
+        records = []
+        for offset in range(len(LIST_BUCKET_RESULT)):
+            records.extend(parser.feed(LIST_BUCKET_RESULT[offset:offset + 1]))
+        records.extend(parser.feed(b'', final=True))
+
+        assert records == pd_listing.ListingParser().feed(LIST_BUCKET_RESULT, final=True)
+
+    def test_feed_versions(self):
+        parser = pd_listing.ListingParser()
+        records = parser.feed(b'''<ListVersionsResult>
+            <Version><Key>a</Key><VersionId>1</VersionId><IsLatest>true</IsLatest></Version>
+            <DeleteMarker><Key>a</Key><VersionId>2</VersionId></DeleteMarker>
+        </ListVersionsResult>''', final=True)
+
+        assert records == [
+            ('Version', {'Key': 'a', 'VersionId': '1', 'IsLatest': 'true'}),
+            ('DeleteMarker', {'Key': 'a', 'VersionId': '2'}),
+        ]
+
+    @pytest.mark.asyncio
+    async def test_read_listing(self):
+        root, fields, records = await pd_listing.read_listing(MockResponse(LIST_BUCKET_RESULT))
+
+        assert root == 'ListBucketResult'
+        assert fields['IsTruncated'] == 'true'
+        assert [record.get('Key') for element, record in records] == \
+            ['photos/ a & b.jpg', 'photos/', None]
+
+
+class TestSplitKeys:
+
+    def test_sequential_keys(self):
+        keys = ['data/run_{:06d}.dat'.format(i) for i in range(1000)]
+
+        assert pd_listing.split_keys(keys, len('data/'), None, 3) == \
+            ['data/run_001', 'data/run_002', 'data/run_003']
+
+    def test_carry(self):
+        keys = ['data/run_{:06d}.dat'.format(i) for i in range(8000, 9000)]
+
+        assert pd_listing.split_keys(keys, len('data/'), None, 2) == \
+            ['data/run_009', 'data/run_010']
+
+    def test_upper(self):
+        keys = ['data/run_{:06d}.dat'.format(i) for i in range(1000)]
+
+        assert pd_listing.split_keys(keys, len('data/'), 'data/run_002', 3) == ['data/run_001']
+
+    def test_varying_first_character(self):
+        keys = ['data/{:04x}'.format(i) for i in range(0, 0x3e8)]
+
+        assert pd_listing.split_keys(keys, len('data/'), None, 2) == ['data/1', 'data/2']
+
+
+class TestShardedListing:
+
+    def list_page_of(self, keys, page_size):
+        calls = []
+
+        async def list_page(start_after, token):
+            calls.append((start_after, token))
+            after = token or start_after or ''
+            listed = [key for key in keys if key > after]
+            page = [{'Key': key} for key in listed[:page_size]]
+            return page, page[-1]['Key'] if len(listed) > page_size else None
+
+        return list_page, calls
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('concurrency', [1, 2, 8])
+    async def test_pages_in_order(self, concurrency):
+        keys = sorted(['data/run_{:06d}.dat'.format(i) for i in range(2500)] +
+                      ['data/{:04x}'.format(i) for i in range(0, 0x800)] +
+                      ['data/été/{}'.format(i) for i in range(300)])
+        list_page, calls = self.list_page_of(keys, 100)
+
+        listing = pd_listing.ShardedListing(list_page, 'data/', concurrency)
+        listed = [record['Key'] async for page in listing.pages() for record in page]
+
+        assert listed == keys
+        if concurrency > 1:
+            assert any(start_after is not None and token is None
+                       for start_after, token in calls)
+
+    @pytest.mark.asyncio
+    async def test_error(self):
+        async def list_page(start_after, token):
+            raise ValueError('listing failed')
+
+        listing = pd_listing.ShardedListing(list_page, 'data/', 4)
+        with pytest.raises(ValueError):
+            [page async for page in listing.pages()]
@@ -0,0 +1,84 @@
+"""Test the metadata of the S3 Compatible Storage provider"""
+import pytest
+
+from s3compat.waterbutler_provider.metadata import (S3CompatFileMetadata,
+                                                    S3CompatFolderMetadata,
+                                                    S3CompatFolderKeyMetadata,
+                                                    S3CompatFileMetadataHeaders)
+
+
+class MockProvider:
+    NAME = 's3compat'
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+
+@pytest.fixture
+def provider():
+    return MockProvider('base/')
+
+
+class TestListingMetadata:
+
+    def test_file(self, provider):
+        content = {'Key': 'base/photos/image.jpg', 'ETag': '"fba9dede5f27731c9771645a39863328"',
+                   'Size': '434234', 'LastModified': '2009-10-12T17:50:30.000Z'}
+        data = S3CompatFileMetadata(provider, content)
+
+        assert data.provider == 's3compat'
+        assert data.path == '/photos/image.jpg'
+        assert data.name == 'image.jpg'
+        assert data.size == 434234
+        assert data.etag == 'fba9dede5f27731c9771645a39863328'
+        assert data.serialized()['path'] == '/photos/image.jpg'
+        # The listed record is shared, not modified
+        assert data.raw is content
+        assert content['Key'] == 'base/photos/image.jpg'
+
+    def test_folder_key(self, provider):
+        data = S3CompatFolderKeyMetadata(provider, {'Key': 'base/photos/2006/'})
+
+        assert data.path == '/photos/2006/'
+        assert data.name == '2006'
+        assert data.serialized()['kind'] == 'folder'
+
+    def test_folder(self, provider):
+        content = {'Prefix': 'base/photos/'}
+        data = S3CompatFolderMetadata(provider, content)
+
+        assert data.path == '/photos/'
+        assert data.name == 'photos'
+        assert content == {'Prefix': 'base/photos/'}
+
+    def test_record_not_modified(self, provider):
+        record = {'Prefix': 'base/photos/'}
+        data = S3CompatFolderMetadata(provider, record)
+
+        assert data.provider == provider.NAME
+        assert data.raw is record
+        assert record == {'Prefix': 'base/photos/'}
+
+
+class TestFileMetadataHeaders:
+
+    def test_content_hashes(self, provider):
+        headers = {
+            'Content-Length': '9001',
+            'Etag': '"3858f62230ac3c915f300c664312c11f-9"',
+            'X-Amz-Meta-Md5': 'fba9dede5f27731c9771645a39863328',
+            'x-amz-meta-sha256': '0b3a2c0ee0b4ebbd84e1d4cb3ffb8dc7b8b4fa5e4a5e4d1c2b7e8e9f8a7b6c5d',
+        }
+        data = S3CompatFileMetadataHeaders(provider, 'base/photos/image.jpg', headers)
+
+        assert data.extra['md5'] == 'fba9dede5f27731c9771645a39863328'
+        assert data.extra['hashes'] == {
+            'md5': 'fba9dede5f27731c9771645a39863328',
+            'sha256': '0b3a2c0ee0b4ebbd84e1d4cb3ffb8dc7b8b4fa5e4a5e4d1c2b7e8e9f8a7b6c5d',
+        }
+
+    def test_without_content_hashes(self, provider):
+        headers = {'Content-Length': '9001', 'Etag': '"fba9dede5f27731c9771645a39863328"'}
+        data = S3CompatFileMetadataHeaders(provider, 'base/photos/image.jpg', headers)
+
+        assert data.extra == {'md5': 'fba9dede5f27731c9771645a39863328', 'encryption': ''}
@@ -0,0 +1,45 @@
+"""Test the planning of multipart uploads"""
+import pytest
+
+from s3compat.waterbutler_provider.multipart import plan_part_sizes, stream_part_sizes
+
+
+class TestPlanPartSizes:
+
+    @pytest.mark.parametrize('size,expected', [
+        (1, [1]),
+        (10, [10]),
+        (25, [13, 12]),
+        (29, [15, 14]),
+        (100, [20] * 5),
+        (1000, [40] * 25),
+    ])
+    def test_plan(self, size, expected):
+        assert plan_part_sizes(size, 10, 40, 5) == expected
+
+    def test_max_parts(self):
+        parts = plan_part_sizes(10 ** 6, 10, 1000, 100000, max_parts=10000)
+
+        assert parts == [100] * 10000
+
+    def test_max_parts_balanced(self):
+        parts = plan_part_sizes(10 ** 6 + 1, 10, 1000, 100000, max_parts=10000)
+
+        assert len(parts) == 9901
+        assert sum(parts) == 10 ** 6 + 1
+        assert max(parts) - min(parts) <= 1
+
+    def test_too_large(self):
+        with pytest.raises(ValueError):
+            plan_part_sizes(10 ** 6 + 1, 10, 100, 5, max_parts=10000)
+
+
+class TestStreamPartSizes:
+
+    def test_growth(self):
+        parts = list(stream_part_sizes(10, 35, max_parts=10, growth_interval=3))
+
+        assert parts == [10, 10, 10, 20, 20, 20, 35, 35, 35, 35]
+
+    def test_max_parts(self):
+        assert len(list(stream_part_sizes(5, 5000))) == 10000
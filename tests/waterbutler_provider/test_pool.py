@@ -0,0 +1,37 @@
+"""Test the connection pools shared by the S3 Compatible Storage providers"""
+import aiohttp
+import pytest
+
+from s3compat.waterbutler_provider import pool as pd_pool
+
+
+class TestGetConnector:
+
+    @pytest.mark.asyncio
+    async def test_shared_per_endpoint(self):
+        connector = pd_pool.get_connector('https', 'securehost', 443)
+
+        assert pd_pool.get_connector('https', 'securehost', 443) is connector
+        assert pd_pool.get_connector('http', 'securehost', 80) is not connector
+        assert pd_pool.get_connector('https', 'otherhost', 443) is not connector
+        await pd_pool.close_connectors()
+
+    @pytest.mark.asyncio
+    async def test_outlives_sessions(self):
+        connector = pd_pool.get_connector('https', 'securehost', 443)
+        session = aiohttp.ClientSession(connector=connector)
+        await session.close()
+
+        assert not connector.closed
+        assert pd_pool.get_connector('https', 'securehost', 443) is connector
+        await pd_pool.close_connectors()
+
+    @pytest.mark.asyncio
+    async def test_close_connectors(self):
+        connector = pd_pool.get_connector('https', 'securehost', 443)
+
+        await pd_pool.close_connectors()
+
+        assert connector.closed
+        assert pd_pool.get_connector('https', 'securehost', 443) is not connector
+        await pd_pool.close_connectors()
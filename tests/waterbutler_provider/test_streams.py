@@ -0,0 +1,206 @@
+"""Test the streams and buffers of the S3 Compatible Storage provider"""
+import gc
+import io
+import asyncio
+import hashlib
+
+import pytest
+
+from waterbutler.core import streams
+
+from s3compat.waterbutler_provider import streams as pd_streams
+
+
+@pytest.fixture
+def file_stream():
+    return streams.FileStreamReader(io.BytesIO(b'sleepy sheep'))
+
+
+class TestThreadedHash:
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('workers', [0, 2])
+    async def test_digest(self, workers, monkeypatch):
+        monkeypatch.setattr(pd_streams.settings, 'HASH_WORKERS', workers)
+        monkeypatch.setattr(pd_streams.settings, 'HASH_THREAD_MIN_SIZE', 4)
+        chunks = [b'ab', b'cdefgh', b'i', b'jklmnopq' * 100, b'r']
+        threaded_hash = pd_streams.ThreadedHash(hashlib.sha256)
+
+        for chunk in chunks:
+            await threaded_hash.update(chunk)
+
+        expected = hashlib.sha256(b''.join(chunks))
+        assert await threaded_hash.digest() == expected.digest()
+        assert await threaded_hash.hexdigest() == expected.hexdigest()
+
+    @pytest.mark.asyncio
+    async def test_queue_is_bounded(self, monkeypatch):
+        monkeypatch.setattr(pd_streams.settings, 'HASH_THREAD_MIN_SIZE', 0)
+        monkeypatch.setattr(pd_streams.settings, 'HASH_QUEUE_MAX_SIZE', 10)
+        threaded_hash = pd_streams.ThreadedHash(hashlib.md5)
+
+        for _ in range(20):
+            await threaded_hash.update(b'sleepy')
+            assert threaded_hash._queued <= 10
+
+        assert await threaded_hash.hexdigest() == hashlib.md5(b'sleepy' * 20).hexdigest()
+
+
+class TestHashingStream:
+
+    @pytest.mark.asyncio
+    async def test_read(self, file_stream):
+        hashes = {'md5': pd_streams.ThreadedHash(hashlib.md5),
+                  'sha256': pd_streams.ThreadedHash(hashlib.sha256)}
+        stream = pd_streams.HashingStream(file_stream, hashes)
+
+        assert stream.size == 12
+        assert await stream.read(6) == b'sleepy'
+        assert await stream.read() == b' sheep'
+        assert await stream.read() == b''
+
+        assert await hashes['md5'].hexdigest() == hashlib.md5(b'sleepy sheep').hexdigest()
+        assert await hashes['sha256'].hexdigest() == \
+            hashlib.sha256(b'sleepy sheep').hexdigest()
+
+
+class TestPartBuffer:
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('memory_limit', [0, 1024])
+    async def test_fill(self, file_stream, memory_limit, monkeypatch):
+        monkeypatch.setattr(pd_streams.settings, 'PART_SPOOL_MEMORY_LIMIT', memory_limit)
+        part = pd_streams.PartBuffer()
+
+        assert await part.fill(file_stream, 6) == 6
+        assert part.md5 == hashlib.md5(b'sleepy').hexdigest()
+
+        # The buffer can be read more than once
+        assert await part.stream().read() == b'sleepy'
+        assert await part.stream().read() == b'sleepy'
+        part.close()
+
+    @pytest.mark.asyncio
+    async def test_fill_short_stream(self, file_stream):
+        part = pd_streams.PartBuffer()
+
+        assert await part.fill(file_stream, 100) == 12
+        assert part.size == 12
+        part.close()
+
+    @pytest.mark.asyncio
+    async def test_spooled_part_read_in_executor(self, file_stream, monkeypatch):
+        monkeypatch.setattr(pd_streams.settings, 'PART_SPOOL_MEMORY_LIMIT', 4)
+        part = pd_streams.PartBuffer()
+        await part.fill(file_stream, 6)
+
+        stream = part.stream()
+
+        assert isinstance(stream, pd_streams.SpooledFileStream)
+        assert stream.size == 6
+        assert await stream.read(4) == b'slee'
+        assert await stream.read() == b'py'
+        part.close()
+
+    @pytest.mark.asyncio
+    async def test_tee(self, file_stream):
+        part = pd_streams.PartBuffer()
+        tee = part.tee(file_stream, 6)
+
+        assert tee.size == 6
+        assert await tee.read(4) == b'slee'
+        await tee.drain()
+
+        assert part.size == 6
+        assert part.md5 == hashlib.md5(b'sleepy').hexdigest()
+        assert await part.stream().read() == b'sleepy'
+        # The rest of the stream is left for the next part
+        assert await file_stream.read() == b' sheep'
+        part.close()
+
+
+class TestRangeDownloadStream:
+
+    @pytest.mark.asyncio
+    async def test_read_in_order(self):
+        content = bytes(range(100))
+        in_flight = []
+        max_in_flight = 0
+
+        async def fetch(start, end):
+            nonlocal max_in_flight
+            in_flight.append(start)
+            max_in_flight = max(max_in_flight, len(in_flight))
+            # Later ranges complete first
+            await asyncio.sleep(0.001 * (100 - start) / 10)
+            in_flight.remove(start)
+            return content[start:end + 1]
+
+        stream = pd_streams.RangeDownloadStream(fetch, 100, 10, 3, first_part=content[:10])
+        data = b''
+        while True:
+            chunk = await stream.read(7)
+            if not chunk:
+                break
+            data += chunk
+
+        assert data == content
+        assert stream.size == 100
+        assert max_in_flight <= 3
+        assert stream.at_eof()
+
+    @pytest.mark.asyncio
+    async def test_read_all(self):
+        content = b'sleepy sheep'
+
+        async def fetch(start, end):
+            return content[start:end + 1]
+
+        stream = pd_streams.RangeDownloadStream(fetch, 12, 5, 2, first_part=content[:5])
+
+        assert await stream.read() == content
+
+    @pytest.mark.asyncio
+    async def test_fetch_error(self):
+        async def fetch(start, end):
+            raise ValueError(start)
+
+        stream = pd_streams.RangeDownloadStream(fetch, 12, 5, 2, first_part=b'sleep')
+
+        assert await stream.read(5) == b'sleep'
+        with pytest.raises(ValueError):
+            await stream.read(5)
+
+    @pytest.mark.asyncio
+    async def test_close_cancels_fetches(self):
+        async def fetch(start, end):
+            await asyncio.sleep(10)
+
+        stream = pd_streams.RangeDownloadStream(fetch, 12, 5, 2, first_part=b'sleep')
+        tasks = list(stream._pending)
+        await asyncio.sleep(0)
+
+        stream.close()
+        await asyncio.sleep(0)
+
+        assert len(tasks) == 2
+        assert all(task.cancelled() for task in tasks)
+        assert await stream.read(5) == b''
+
+    @pytest.mark.asyncio
+    async def test_abandoned_stream_cancels_fetches(self):
+        started = asyncio.Event()
+
+        async def fetch(start, end):
+            started.set()
+            await asyncio.sleep(10)
+
+        stream = pd_streams.RangeDownloadStream(fetch, 12, 5, 1, first_part=b'sleep')
+        task = stream._pending[0]
+        await started.wait()
+
+        del stream
+        gc.collect()
+        await asyncio.sleep(0)
+
+        assert task.cancelled()